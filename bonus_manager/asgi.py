@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bonus_manager.settings')
+# Асинхронные представления core (core/async_views.py); ASYNC_VIEWS=0 — синхронные
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -0,0 +1,57 @@
+import atexit
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Кладёт записи лога в очередь в памяти; запись в файл и консоль делает
+    фоновый поток QueueListener, поэтому запрос не ждёт дискового I/O.
+
+    ``handlers`` — ссылки вида ``'cfg://handlers.file'``. dictConfig создаёт
+    обработчики в алфавитном порядке, поэтому имя этого обработчика в
+    LOGGING должно идти после имён тех, на которые он ссылается.
+    """
+
+    def __init__(self, handlers, respect_handler_level=True):
+        super().__init__(queue.SimpleQueue())
+        # Индексация, а не итерация: ConvertingList из dictConfig разрешает
+        # 'cfg://' только в __getitem__
+        self.listener = QueueListener(
+            self.queue, *[handlers[i] for i in range(len(handlers))],
+            respect_handler_level=respect_handler_level,
+        )
+        self.listener.start()
+        atexit.register(self._stop_listener)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def prepare(self, record):
+        # Сообщение форматируется в фоновом потоке, а не в запросе.
+        # Очередь живёт в том же процессе, поэтому args и exc_info
+        # передаются как есть.
+        return record
+
+    def _after_fork(self):
+        # В дочернем процессе (manage.py run_rules --workers) фонового потока
+        # нет: запускаем свой со своей очередью. Процессы multiprocessing
+        # завершаются без atexit, поэтому остановка — ещё и их финализатором
+        if self.listener._thread is None:
+            return
+        self.queue = queue.SimpleQueue()
+        self.listener = QueueListener(
+            self.queue, *self.listener.handlers, respect_handler_level=self.listener.respect_handler_level,
+        )
+        self.listener.start()
+        from multiprocessing import util
+        util.Finalize(self, self._stop_listener, exitpriority=10)
+
+    def _stop_listener(self):
+        # Дописывает оставшиеся в очереди записи и останавливает поток
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self._stop_listener()
+        super().close()
+
@@ -1,5 +1,9 @@
+import os
+import sys
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Базовая директория
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -9,6 +13,9 @@ SECRET_KEY = '6=z!9v1q2tr($yk*^)-8w=da@7w7az+o2uto8@wx(v@tpc%y$k'  # python -c '
 # Отладка отключена для продакшена
 DEBUG = False
 
+# manage.py test: тестовые значения по умолчанию (транспорт уведомлений)
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
 # Разрешённые хосты
 ALLOWED_HOSTS = ['109.235.119.125', 'cash.inbrain.kz','bonus.inbrain.kz', 'localhost', '127.0.0.1']
 
@@ -26,21 +33,29 @@ INSTALLED_APPS = [
 
 # Middleware
 MIDDLEWARE = [
+    # Замеры запросов (core/metrics.py), включается METRICS_SAMPLE_RATE
+    'core.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Запросы к данным организации пользователя идут в её базу (core/shards.py)
+    'core.shards.TenantMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'bonus_manager.urls'
+# Под ASGI (bonus_manager/asgi.py выставляет ASYNC_VIEWS=1) страницы core
+# отдаются асинхронными представлениями, см. core/async_views.py
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
+ROOT_URLCONF = 'bonus_manager.urls_async' if ASYNC_VIEWS else 'bonus_manager.urls'
 
 # Настройка шаблонов
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates с замером времени рендеринга для core/metrics.py
+        'BACKEND': 'core.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],  # Если есть общие шаблоны
         'APP_DIRS': True,
         'OPTIONS': {
@@ -56,13 +71,61 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'bonus_manager.wsgi.application'
 
-# База данных
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# База данных: DB_ENGINE=sqlite (по умолчанию) или DB_ENGINE=postgres
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'bonus_manager'),
+            'USER': os.environ.get('DB_USER', 'bonus_manager'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # Соединение переживает запрос и проверяется перед повторным использованием
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))},
+        }
+    }
+    if os.environ.get('DB_PGBOUNCER') == '1':
+        # Пул PgBouncer в режиме transaction: серверные курсоры (iterator() в
+        # экспорте CSV) не переживают транзакцию и должны быть выключены
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            # Ожидание блокировки записи — PRAGMA busy_timeout, см. core/db.py
+        }
     }
-}
+
+# Шарды данных организаций (core/shards.py): DB_SHARDS=shard1,shard2 добавляет
+# базы с настройками default — для SQLite отдельный файл (DB_NAME_SHARD1 или
+# db_shard1.sqlite3), для PostgreSQL схема с именем шарда в той же базе
+# (создаётся заранее: CREATE SCHEMA shard1). Каждую базу мигрируют отдельно:
+# manage.py migrate --database shard1. Новые организации создаются в
+# NEW_ORGANIZATION_DATABASE, переносит их manage.py move_organization.
+DB_SHARDS = [alias for alias in os.environ.get('DB_SHARDS', '').split(',') if alias]
+for alias in DB_SHARDS:
+    shard = dict(DATABASES['default'], OPTIONS=dict(DATABASES['default'].get('OPTIONS', {})))
+    if DB_ENGINE == 'postgres':
+        shard['OPTIONS']['options'] = f'-c search_path={alias}'
+    else:
+        shard['NAME'] = os.environ.get(f'DB_NAME_{alias.upper()}', BASE_DIR / f'db_{alias}.sqlite3')
+    DATABASES[alias] = shard
+TENANT_DATABASES = ['default', *DB_SHARDS]
+NEW_ORGANIZATION_DATABASE = os.environ.get('NEW_ORGANIZATION_DATABASE', 'default')
+DATABASE_ROUTERS = ['core.shards.TenantRouter']
+# Сколько секунд процессы помнят размещение организации
+SHARD_PLACEMENT_TIMEOUT = int(os.environ.get('SHARD_PLACEMENT_TIMEOUT', '5'))
+
+# Переопределения PRAGMA соединений SQLite; значения по умолчанию
+# (WAL, busy_timeout и т.д.) — DEFAULT_SQLITE_PRAGMAS в core/db.py
+SQLITE_PRAGMAS = {}
+if 'SQLITE_MMAP_SIZE' in os.environ:
+    SQLITE_PRAGMAS['mmap_size'] = int(os.environ['SQLITE_MMAP_SIZE'])
 
 # Валидаторы паролей
 AUTH_PASSWORD_VALIDATORS = [
@@ -94,24 +157,145 @@ LOGOUT_REDIRECT_URL = '/login/'
 
 AUTH_USER_MODEL = 'core.User'  # Проверь, что модель User определена в core/models.py
 
+# Количество клиентов на одной странице дашборда
+DASHBOARD_PAGE_SIZE = 50
+# Количество записей истории на одной странице (модальное окно и /history/)
+HISTORY_PAGE_SIZE = 50
+
+# Кэш: шаблоны сообщений, таблица клиентов и итоги дашборда (core/pagecache.py).
+# CACHE_BACKEND=locmem (по умолчанию) — отдельный кэш в каждом процессе: версия
+# фрагментов дашборда читается из БД, но шаблоны сообщений и сессии при
+# нескольких воркерах требуют общего кэша: redis или memcached (адрес в
+# CACHE_URL, нужен пакет redis или pymemcache) либо file (каталог CACHE_DIR,
+# общий только для воркеров на одном сервере).
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CACHE_URL', 'redis://127.0.0.1:6379/1'),
+        },
+    }
+elif CACHE_BACKEND == 'memcached':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': os.environ.get('CACHE_URL', '127.0.0.1:11211'),
+        },
+    }
+elif CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', BASE_DIR / 'cache'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+SHARED_CACHE = CACHE_BACKEND in ('redis', 'memcached', 'file')
+
+# Число номеров в кэше балансов /api/balance/ (core/balances.py), в каждом
+# процессе, и как часто (секунд) перечитывать версию данных организации: на
+# столько баланс может отставать от проводки, сделанной в другом воркере
+BALANCE_CACHE_MAX_ENTRIES = int(os.environ.get('BALANCE_CACHE_MAX_ENTRIES', '50000'))
+BALANCE_VERSION_TTL = float(os.environ.get('BALANCE_VERSION_TTL', '1'))
+
+# Сессии: SESSION_BACKEND=db — только БД; cached_db — сессия читается из
+# кэша, а в БД пишется только при изменении (вход, выход); cookies — подписанная
+# cookie, БД не используется совсем (данные сессии видны браузеру, но подделать
+# их нельзя). По умолчанию cached_db только при общем кэше (SHARED_CACHE), иначе
+# db: с LocMemCache сессия, удалённая при выходе в одном воркере, продолжала бы
+# работать в других до истечения их кэша. Просроченные сессии удаляет
+# manage.py purge_sessions.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cached_db' if SHARED_CACHE else 'db')
+if SESSION_BACKEND == 'cached_db' and not SHARED_CACHE:
+    raise ImproperlyConfigured(
+        'SESSION_BACKEND=cached_db needs a shared cache: set CACHE_BACKEND=redis, memcached or file'
+    )
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cookies': 'django.contrib.sessions.backends.signed_cookies',
+}[SESSION_BACKEND]
+# Всплывающие сообщения хранятся в cookie и не трогают сессию
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# Метрики запросов (core/metrics.py): доля замеряемых запросов (0 — выключено),
+# порог SQL-запросов для предупреждения о N+1 и доступ к /metrics/: токен
+# для заголовка Authorization: Bearer и/или адреса через запятую. Без них
+# /metrics/ закрыт (за прокси все запросы приходят с адреса прокси)
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0'))
+METRICS_QUERY_WARNING_THRESHOLD = int(os.environ.get('METRICS_QUERY_WARNING_THRESHOLD', '20'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip.strip()]
+
+# Уведомления клиентам (core/notifications.py): запрос только ставит сообщение
+# в очередь, отправляет manage.py send_notifications. Транспорт обязателен:
+# NOTIFICATION_TRANSPORT=core.notifications.WhatsAppCloudTransport и WHATSAPP_*.
+# Без него manage.py check/migrate/send_notifications завершаются ошибкой.
+# LocalTransport ничего не отправляет и по умолчанию включён только в тестах
+NOTIFICATION_TRANSPORT = os.environ.get(
+    'NOTIFICATION_TRANSPORT', 'core.notifications.LocalTransport' if TESTING else '',
+)
+NOTIFICATION_RATE_PER_SECOND = float(os.environ.get('NOTIFICATION_RATE_PER_SECOND', '10'))
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 60  # секунд, удваивается с каждой попыткой
+WHATSAPP_API_URL = os.environ.get('WHATSAPP_API_URL', 'https://graph.facebook.com/v19.0')
+WHATSAPP_PHONE_NUMBER_ID = os.environ.get('WHATSAPP_PHONE_NUMBER_ID', '')
+WHATSAPP_TOKEN = os.environ.get('WHATSAPP_TOKEN', '')
+
 # Логирование
-LOGGING = {    'version': 1,
+# Запись на диск и в консоль идёт через очередь в фоновом потоке
+# (bonus_manager/log.py); уровни задаются по подсистемам и переопределяются
+# переменными окружения.
+LOG_DIR = Path(os.environ.get('LOG_DIR', BASE_DIR))
+
+LOGGING = {
+    'version': 1,
     'disable_existing_loggers': False,
-    'handlers': {
-        'file': {
-            'level': 'DEBUG',
-            'class': 'logging.FileHandler',
-            'filename': BASE_DIR / 'debug.log',
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s %(levelname)s %(name)s [%(process)d:%(threadName)s] %(message)s',
         },
+    },
+    'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
+            'formatter': 'standard',
+        },
+        'file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOG_DIR / 'bonus_manager.log',
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'encoding': 'utf-8',
+            'formatter': 'standard',
+        },
+        # Имя должно идти по алфавиту после 'console' и 'file', см. log.py
+        'queue': {
+            '()': 'bonus_manager.log.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file', 'cfg://handlers.console'],
         },
     },
+    'root': {
+        'handlers': ['queue'],
+        'level': os.environ.get('LOG_LEVEL', 'WARNING'),
+    },
     'loggers': {
         'django': {
-            'handlers': ['file', 'console'],
-            'level': 'DEBUG',
-            'propagate': True,
+            'level': os.environ.get('LOG_LEVEL_DJANGO', 'INFO'),
+        },
+        # SQL-запросы логируются только при DEBUG=True и только если включить явно
+        'django.db.backends': {
+            'level': os.environ.get('LOG_LEVEL_SQL', 'WARNING'),
+        },
+        'core': {
+            'level': os.environ.get('LOG_LEVEL_CORE', 'INFO'),
         },
     },
 }
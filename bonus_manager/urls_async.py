@@ -0,0 +1,8 @@
+# Корневые маршруты для ASGI: страницы core отдаются асинхронными представлениями
+from django.urls import path, include
+
+from .urls import base_urlpatterns
+
+urlpatterns = base_urlpatterns + [
+    path('', include('core.urls_async')),
+]
@@ -1,10 +1,44 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from .models import Organization, Client, BonusHistory, MessageTemplate, User
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+
+from . import ledger, message_templates, pagecache, shards
+from .db import estimated_count
+from .models import (
+    ApiToken, BonusRule, Organization, Client, BonusHistory, BonusHistoryArchive, MessageTemplate, OutboundMessage, User,
+    default_database,
+)
+from .normalize import phone_digits, search_name
+from .search import MIN_SUBSTRING_LENGTH, _name_substring_filter, _prefix_range
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор для больших таблиц: без фильтров число строк берётся из оценки
+    СУБД (core/db.py), с фильтрами — ``COUNT`` не дальше ``limit`` строк.
+    Последние страницы при завышенной оценке могут оказаться пустыми.
+    """
+    limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.limit:
+                return estimate
+        return queryset.order_by()[:self.limit].count()
+
 
 class CustomUserAdmin(UserAdmin):
     list_display = ('username', 'email', 'organization', 'is_staff')
     list_filter = ('organization', 'is_staff')
+    list_select_related = ('organization',)
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
         ('Personal info', {'fields': ('first_name', 'last_name', 'email', 'organization')}),
@@ -18,8 +52,204 @@ class CustomUserAdmin(UserAdmin):
         }),
     )
 
-admin.site.register(Organization)
-admin.site.register(Client)
-admin.site.register(BonusHistory)
-admin.site.register(MessageTemplate)
-admin.site.register(User, CustomUserAdmin)
\ No newline at end of file
+class OrganizationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'database', 'clients', 'balance')
+    search_fields = ('name',)
+
+    def get_readonly_fields(self, request, obj=None):
+        # Базу меняет только manage.py move_organization, см. core/shards.py
+        return ('database', 'move_state') if obj is not None else ()
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name == 'database':
+            return forms.ChoiceField(
+                choices=[(alias, alias) for alias in shards.databases()],
+                initial=default_database, label=db_field.verbose_name,
+            )
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    @staticmethod
+    def _local(obj):
+        # Счётчики организации ведутся в её базе: одна строка на обе колонки
+        if not hasattr(obj, '_local_organization'):
+            obj._local_organization = shards.local_organization(obj)
+        return obj._local_organization
+
+    @admin.display(description='Клиентов')
+    def clients(self, obj):
+        return self._local(obj).client_count
+
+    @admin.display(description='Сумма бонусов')
+    def balance(self, obj):
+        return self._local(obj).total_balance
+
+class ClientAdmin(admin.ModelAdmin):
+    # Баланс меняется только проводками core/ledger.py: при редактировании он
+    # и организация только для чтения, создание и удаление идут через ledger
+    list_display = ('name', 'phone', 'organization', 'balance', 'history_link')
+    list_filter = ('organization',)
+    list_select_related = ('organization',)
+    autocomplete_fields = ('organization',)
+    # Поиск по индексированным колонкам, см. get_search_results
+    search_fields = ('name_search',)
+    search_help_text = 'Начало номера телефона или имени, часть имени'
+    ordering = ('organization', 'name', 'id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('reset_balances', 'delete_clients')
+
+    def get_readonly_fields(self, request, obj=None):
+        return ('organization', 'balance') if obj is not None else ()
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # Стандартное удаление не уменьшает счётчики организации
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_search_results(self, request, queryset, search_term):
+        query = search_term.strip()
+        if not query:
+            return queryset, False
+        digits = phone_digits(query)
+        if digits and len(digits) * 2 >= len(query.replace(' ', '')):
+            condition = Q(phone_digits=digits) | Q(**_prefix_range('phone_digits_reversed', digits[::-1]))
+            return queryset.filter(condition | Q(**_prefix_range('phone_digits', digits))), False
+        term = search_name(query)
+        found = queryset.filter(**_prefix_range('name_search', term))
+        if len(term) >= MIN_SUBSTRING_LENGTH:
+            found = found | _name_substring_filter(queryset, term)
+        return found, False
+
+    @admin.display(description='История')
+    def history_link(self, obj):
+        url = reverse('admin:core_bonushistory_changelist')
+        return format_html('<a href="{}?client__id__exact={}">История</a>', url, obj.pk)
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            ledger.create_client(obj)
+            return
+        super().save_model(request, obj, form, change)
+        pagecache.bump(obj.organization_id)
+
+    def delete_model(self, request, obj):
+        try:
+            ledger.delete_client(obj)
+        except ledger.LedgerConflict:
+            self.message_user(
+                request, f'Клиент {obj} не удалён: его баланс всё время меняется. Повторите позже.', messages.ERROR,
+            )
+
+    def get_deleted_objects(self, objs, request):
+        # Историю клиента не перечисляем построчно (её могут быть тысячи записей)
+        # и не требуем права на удаление истории, закрытого в BonusHistoryAdmin
+        objs = list(objs)
+        model_count = {Client._meta.verbose_name_plural: len(objs)}
+        for model in (BonusHistory, BonusHistoryArchive):
+            entries = model.objects.filter(client__in=objs).count()
+            if entries:
+                model_count[model._meta.verbose_name_plural] = entries
+        return [str(obj) for obj in objs], model_count, set(), []
+
+    @admin.action(description='Обнулить баланс выбранных клиентов', permissions=['change'])
+    def reset_balances(self, request, queryset):
+        reset = 0
+        skipped = []
+        for client in queryset.filter(balance__gt=0).iterator():
+            try:
+                ledger.reset_balance(client)
+            except ledger.LedgerConflict:
+                skipped.append(client)
+                continue
+            reset += 1
+        self.message_user(request, f'Обнулён баланс {reset} клиентов.', messages.SUCCESS)
+        self._report_skipped(request, skipped, 'Баланс не обнулён')
+
+    @admin.action(description='Удалить выбранных клиентов вместе с историей', permissions=['delete'])
+    def delete_clients(self, request, queryset):
+        deleted = 0
+        skipped = []
+        for client in queryset.iterator():
+            try:
+                deleted += ledger.delete_client(client)
+            except ledger.LedgerConflict:
+                skipped.append(client)
+        self.message_user(request, f'Удалено {deleted} клиентов.', messages.SUCCESS)
+        self._report_skipped(request, skipped, 'Не удалены')
+
+    def _report_skipped(self, request, clients, action):
+        # Баланс этих клиентов менялся на каждой попытке (core/ledger.py)
+        if clients:
+            names = ', '.join(str(client) for client in clients)
+            self.message_user(
+                request, f'{action} (баланс всё время меняется, повторите позже): {names}.', messages.WARNING,
+            )
+
+class BonusHistoryAdmin(admin.ModelAdmin):
+    # Записи создаёт только core/ledger.py, в админке история только для просмотра.
+    # Сортировка и date_hierarchy идут по индексу history_date_id_idx, отбор
+    # клиента (?client__id__exact=) — по history_client_date_id_idx
+    list_display = ('date', 'client', 'amount', 'balance_after', 'description')
+    list_select_related = ('client',)
+    date_hierarchy = 'date'
+    ordering = ('-date', '-id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class MessageTemplateAdmin(admin.ModelAdmin):
+    list_display = ('user',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('user__username',)
+
+    def save_model(self, request, obj, form, change):
+        organization_id = obj.user.organization_id
+        with shards.use(organization_id):
+            super().save_model(request, obj, form, change)
+        message_templates.invalidate(obj.user_id)
+        if organization_id:
+            pagecache.bump(organization_id)
+
+class ApiTokenAdmin(admin.ModelAdmin):
+    # Ключ выдаёт manage.py create_api_token; здесь токен можно только отключить
+    list_display = ('name', 'organization', 'is_active', 'created_at')
+    list_filter = ('is_active',)
+    list_select_related = ('organization',)
+    fields = ('organization', 'name', 'is_active')
+
+    def has_add_permission(self, request):
+        return False
+
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ('phone', 'organization', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    list_select_related = ('organization',)
+    readonly_fields = ('organization', 'client', 'phone', 'text', 'attempts', 'last_error', 'created_at', 'sent_at')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class BonusRuleAdmin(admin.ModelAdmin):
+    # Правила выполняет manage.py run_rules, см. core/rules.py
+    list_display = ('organization', 'kind', 'amount', 'days', 'start_date', 'is_active')
+    list_filter = ('kind', 'is_active')
+    list_select_related = ('organization',)
+    autocomplete_fields = ('organization',)
+
+admin.site.register(Organization, OrganizationAdmin)
+admin.site.register(Client, ClientAdmin)
+admin.site.register(BonusHistory, BonusHistoryAdmin)
+admin.site.register(MessageTemplate, MessageTemplateAdmin)
+admin.site.register(User, CustomUserAdmin)
+admin.site.register(ApiToken, ApiTokenAdmin)
+admin.site.register(OutboundMessage, OutboundMessageAdmin)
+admin.site.register(BonusRule, BonusRuleAdmin)
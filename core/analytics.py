@@ -0,0 +1,299 @@
+"""
+Аналитика клиентов: частота визитов, начисления и списания по месяцам,
+обязательства во времени, когорты и «уснувшие» клиенты с остатком бонусов.
+
+История организации (архив и живая таблица, core/archive.py) читается
+пачками в колоночные массивы NumPy и сворачивается векторными group-by
+(``np.add.at``, ``np.minimum.at``, ``np.maximum.at``) в ``AnalyticsState``:
+итоги по клиентам и по месяцам. Состояние лежит в кэше Django по организации
+вместе с id последней учтённой записи, поэтому ``refresh`` дочитывает только
+новые записи, а отчёты считаются по состоянию без обращения к истории.
+
+Записи по id идут в хронологическом порядке (так их пишет core/ledger.py).
+Удалённые клиенты и правки истории в обход проводок учитываются только при
+полном пересчёте ``manage.py refresh_analytics --full``.
+
+NumPy указан в requirements.txt. Если в окружении его всё же нет, отчёты
+недоступны (``AnalyticsUnavailable``), страница аналитики сообщает об этом,
+остальное приложение работает.
+"""
+import logging
+from datetime import date
+from decimal import Decimal
+from itertools import islice
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import archive
+from .models import Client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50000
+DEFAULT_DORMANT_DAYS = 90
+DEFAULT_DORMANT_LIMIT = 50
+DEFAULT_COHORTS = 12
+HISTORY_FIELDS = ('id', 'client_id', 'date', 'amount')
+# Группы клиентов по числу операций: (от, до включительно)
+FREQUENCY_BUCKETS = ((1, 1), (2, 3), (4, 7), (8, 15), (16, None))
+# Меняется вместе со структурой AnalyticsState: старое состояние в кэше пересчитывается
+STATE_VERSION = 1
+
+
+class AnalyticsUnavailable(Exception):
+    pass
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise AnalyticsUnavailable('Analytics requires the numpy package')
+    return numpy
+
+
+def _money(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def _month_start(month):
+    return date(int(month) // 12, int(month) % 12 + 1, 1)
+
+
+class AnalyticsState:
+    """
+    Свёртка истории организации. Суммы — в сотых долях (int64), дни —
+    ``date.toordinal()``, месяцы — ``год * 12 + месяц - 1``. Массивы по
+    клиентам индексируются слотом (``slots``), по месяцам — смещением от
+    ``month_base``.
+    """
+
+    def __init__(self, organization_id):
+        np = _numpy()
+        self.version = STATE_VERSION
+        self.organization_id = organization_id
+        self.last_id = 0
+        self.slots = {}
+        self.client_ids = np.zeros(0, np.int64)
+        self.visits = np.zeros(0, np.int64)
+        self.accrued = np.zeros(0, np.int64)
+        self.redeemed = np.zeros(0, np.int64)
+        self.first_day = np.zeros(0, np.int64)
+        self.last_day = np.zeros(0, np.int64)
+        self.first_month = np.zeros(0, np.int64)
+        self.last_month = np.zeros(0, np.int64)
+        self.month_base = None
+        self.month_accrued = np.zeros(0, np.int64)
+        self.month_redeemed = np.zeros(0, np.int64)
+        self.month_operations = np.zeros(0, np.int64)
+        self.month_active = np.zeros(0, np.int64)
+        self.month_new = np.zeros(0, np.int64)
+        # [месяц первой операции, месяц активности] -> число клиентов
+        self.cohorts = np.zeros((0, 0), np.int64)
+
+    def _add_clients(self, client_ids):
+        np = _numpy()
+        start = len(self.client_ids)
+        for offset, client_id in enumerate(client_ids):
+            self.slots[client_id] = start + offset
+        count = len(client_ids)
+        never = np.iinfo(np.int64)
+        self.client_ids = np.concatenate([self.client_ids, np.array(client_ids, np.int64)])
+        for name, initial in (
+            ('visits', 0), ('accrued', 0), ('redeemed', 0),
+            ('first_day', never.max), ('last_day', never.min),
+            ('first_month', never.max), ('last_month', never.min),
+        ):
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(count, initial, np.int64)]))
+        return np.arange(start, start + count)
+
+    def _ensure_months(self, first, last):
+        np = _numpy()
+        if self.month_base is None:
+            self.month_base = first
+        before = max(self.month_base - first, 0)
+        after = max(last - (self.month_base + len(self.month_active) - 1), 0)
+        if not before and not after:
+            return
+        for name in ('month_accrued', 'month_redeemed', 'month_operations', 'month_active', 'month_new'):
+            setattr(self, name, np.pad(getattr(self, name), (before, after)))
+        self.cohorts = np.pad(self.cohorts, ((before, after), (before, after)))
+        self.month_base -= before
+
+    def ingest(self, rows):
+        """Добавляет пачку записей истории: кортежи ``HISTORY_FIELDS`` по возрастанию id."""
+        np = _numpy()
+        count = len(rows)
+        ids = np.fromiter((row[0] for row in rows), np.int64, count)
+        clients = np.fromiter((row[1] for row in rows), np.int64, count)
+        local = [timezone.localtime(row[2]) for row in rows]
+        days = np.fromiter((moment.toordinal() for moment in local), np.int64, count)
+        months = np.fromiter((moment.year * 12 + moment.month - 1 for moment in local), np.int64, count)
+        cents = np.fromiter((int(row[3] * 100) for row in rows), np.int64, count)
+        accrued = np.where(cents > 0, cents, 0)
+        redeemed = np.where(cents < 0, -cents, 0)
+
+        unique, inverse = np.unique(clients, return_inverse=True)
+        unique = unique.tolist()
+        new_slots = self._add_clients([client_id for client_id in unique if client_id not in self.slots])
+        slot = np.fromiter((self.slots[client_id] for client_id in unique), np.int64, len(unique))[inverse]
+
+        np.add.at(self.visits, slot, 1)
+        np.add.at(self.accrued, slot, accrued)
+        np.add.at(self.redeemed, slot, redeemed)
+        np.minimum.at(self.first_day, slot, days)
+        np.maximum.at(self.last_day, slot, days)
+        np.minimum.at(self.first_month, slot, months)
+
+        self._ensure_months(int(months.min()), int(months.max()))
+        month = months - self.month_base
+        np.add.at(self.month_accrued, month, accrued)
+        np.add.at(self.month_redeemed, month, redeemed)
+        np.add.at(self.month_operations, month, 1)
+        np.add.at(self.month_new, self.first_month[new_slots] - self.month_base, 1)
+
+        # Уникальные пары (клиент, месяц) пачки. Месяцы клиента идут по
+        # возрастанию, поэтому пара новая, если месяц позже последнего учтённого
+        width = len(self.month_active)
+        pairs = np.unique(slot * width + month)
+        pair_slot, pair_month = pairs // width, pairs % width
+        fresh = pair_month + self.month_base > self.last_month[pair_slot]
+        pair_slot, pair_month = pair_slot[fresh], pair_month[fresh]
+        np.add.at(self.month_active, pair_month, 1)
+        np.add.at(self.cohorts, (self.first_month[pair_slot] - self.month_base, pair_month), 1)
+        np.maximum.at(self.last_month, slot, months)
+
+        self.last_id = max(self.last_id, int(ids.max()))
+
+
+def _cache_key(organization_id):
+    return f'analytics:{organization_id}:state'
+
+
+def refresh(organization_id, full=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Дочитывает в состояние организации записи истории после ``last_id``."""
+    state = None if full else cache.get(_cache_key(organization_id))
+    cached = state is not None and getattr(state, 'version', None) == STATE_VERSION
+    if not cached:
+        state = AnalyticsState(organization_id)
+
+    rows = archive.all_history(
+        {'client__organization_id': organization_id, 'id__gt': state.last_id}, HISTORY_FIELDS, chunk_size,
+    )
+    processed = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        state.ingest(chunk)
+        processed += len(chunk)
+
+    if processed or not cached:
+        cache.set(_cache_key(organization_id), state, None)
+    if processed:
+        logger.info(
+            "Analytics for organization %s: %d history entries added, last id %d",
+            organization_id, processed, state.last_id,
+        )
+    return state
+
+
+def summary(state, today):
+    np = _numpy()
+    day = today.toordinal()
+    return {
+        'clients': len(state.client_ids),
+        'active_30': int(np.count_nonzero(state.last_day > day - 30)),
+        'active_90': int(np.count_nonzero(state.last_day > day - 90)),
+        'operations': int(state.visits.sum()),
+        'accrued': _money(state.accrued.sum()),
+        'redeemed': _money(state.redeemed.sum()),
+    }
+
+
+def monthly(state):
+    """Начисления, списания, активные и новые клиенты по месяцам; обязательства на конец месяца."""
+    np = _numpy()
+    liability = np.cumsum(state.month_accrued - state.month_redeemed)
+    return [
+        {
+            'month': _month_start(state.month_base + i),
+            'accrued': _money(state.month_accrued[i]),
+            'redeemed': _money(state.month_redeemed[i]),
+            'operations': int(state.month_operations[i]),
+            'active': int(state.month_active[i]),
+            'new': int(state.month_new[i]),
+            'liability': _money(liability[i]),
+        }
+        for i in range(len(state.month_active))
+    ]
+
+
+def frequency(state):
+    """Распределение клиентов по числу операций и средний интервал между визитами."""
+    np = _numpy()
+    visits = state.visits
+    buckets = []
+    for low, high in FREQUENCY_BUCKETS:
+        mask = visits >= low if high is None else (visits >= low) & (visits <= high)
+        label = f'{low}+' if high is None else str(low) if low == high else f'{low}–{high}'
+        buckets.append({'label': label, 'clients': int(np.count_nonzero(mask))})
+    repeat = visits > 1
+    intervals = (state.last_day[repeat] - state.first_day[repeat]) / (visits[repeat] - 1)
+    return {
+        'buckets': buckets,
+        'median_visits': float(np.median(visits)) if len(visits) else 0,
+        'mean_interval_days': round(float(intervals.mean()), 1) if len(intervals) else None,
+    }
+
+
+def dormant(state, today, days=DEFAULT_DORMANT_DAYS, limit=DEFAULT_DORMANT_LIMIT):
+    """Клиенты без операций ``days`` дней с положительным остатком, крупные остатки первыми."""
+    np = _numpy()
+    balance = state.accrued - state.redeemed
+    mask = (state.last_day <= today.toordinal() - days) & (balance > 0)
+    candidates = np.flatnonzero(mask)
+    top = candidates[np.argsort(-balance[candidates], kind='stable')][:limit]
+    clients = Client.objects.filter(organization_id=state.organization_id).in_bulk(state.client_ids[top].tolist())
+    return {
+        'days': days,
+        'count': len(candidates),
+        'liability': _money(balance[mask].sum()),
+        'clients': [
+            {
+                'client': clients[client_id],
+                'balance': _money(balance[slot]),
+                'last_visit': date.fromordinal(int(state.last_day[slot])),
+            }
+            for slot, client_id in zip(top.tolist(), state.client_ids[top].tolist())
+            if client_id in clients
+        ],
+    }
+
+
+def cohorts(state, limit=DEFAULT_COHORTS):
+    """Удержание последних ``limit`` когорт: доля клиентов когорты, активных через N месяцев."""
+    rows = []
+    for cohort in range(max(len(state.month_active) - limit, 0), len(state.month_active)):
+        size = int(state.cohorts[cohort, cohort])
+        if not size:
+            continue
+        rows.append({
+            'month': _month_start(state.month_base + cohort),
+            'size': size,
+            'retention': [round(100 * int(active) / size) for active in state.cohorts[cohort, cohort:]],
+        })
+    return rows
+
+
+def report(organization, today=None, dormant_days=DEFAULT_DORMANT_DAYS):
+    state = refresh(organization.pk)
+    today = today or timezone.localdate()
+    return {
+        'summary': summary(state, today),
+        'months': monthly(state),
+        'frequency': frequency(state),
+        'dormant': dormant(state, today, dormant_days),
+        'cohorts': cohorts(state),
+    }
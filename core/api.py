@@ -0,0 +1,239 @@
+"""
+JSON API для касс (POS).
+
+Авторизация — заголовок ``Authorization: Token <ключ>``; токен привязан к
+организации (``ApiToken``, ключ выдаёт ``manage.py create_api_token``), и все
+запросы видят только её клиентов.
+
+* ``GET  /api/clients/?phone=...`` — клиент и баланс по номеру телефона;
+* ``GET  /api/balance/?phone=...`` — только id и баланс: ``{"id": 12,
+  "balance": "150.00"}``. Отвечает из кэша в памяти процесса
+  (core/balances.py) и для частых проверок на кассе предпочтительнее;
+* ``GET  /api/clients/<id>/history/?after=...`` — история бонусов постранично;
+* ``POST /api/operations/`` — пачка операций за один запрос::
+
+      {"operations": [
+          {"phone": "+77001234567", "type": "accrual", "amount": "150.00"},
+          {"client_id": 12, "type": "deduction", "amount": "40"},
+          {"client_id": 12, "type": "reset"}
+      ]}
+
+  Каждая операция — отдельная проводка core/ledger.py; в ответе для каждой
+  новый баланс или ошибка. С заголовком ``Idempotency-Key`` операции и
+  сохранённый ответ фиксируются одной транзакцией: повтор запроса с тем же
+  ключом возвращает прежний ответ и ничего не проводит повторно.
+"""
+import hashlib
+import json
+import logging
+import secrets
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from . import balances, ledger, shards
+from .forms import BonusForm
+from .models import ApiToken, Client, IdempotencyRecord
+from .normalize import normalize_phone
+from .views import _history_page
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_OPERATIONS = 100
+DEFAULT_TOKEN_CACHE_SECONDS = 30
+OPERATION_TYPES = ('accrual', 'deduction', 'reset')
+
+# Хэш ключа -> (организация, время проверки), см. _organization_for_key
+_token_cache = {}
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def create_token(organization, name):
+    """Создаёт токен и возвращает (ApiToken, ключ). Ключ больше нигде не сохраняется."""
+    key = secrets.token_urlsafe(32)
+    token = ApiToken.objects.create(organization=organization, name=name, key_hash=hash_key(key))
+    return token, key
+
+
+def _error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _organization_for_key(key):
+    """
+    Организация действующего токена или None. Проверенные токены помнятся в
+    процессе ``API_TOKEN_CACHE_SECONDS`` секунд: частые запросы касс не читают
+    ``core_apitoken``, а отключённый токен перестаёт работать не позже чем
+    через это время.
+    """
+    key_hash = hash_key(key)
+    timeout = getattr(settings, 'API_TOKEN_CACHE_SECONDS', DEFAULT_TOKEN_CACHE_SECONDS)
+    now = time.monotonic()
+    cached = _token_cache.get(key_hash)
+    if cached is not None and now - cached[1] < timeout:
+        return cached[0]
+    token = ApiToken.objects.select_related('organization').filter(key_hash=key_hash, is_active=True).first()
+    if token is None:
+        _token_cache.pop(key_hash, None)
+        return None
+    _token_cache[key_hash] = (token.organization, now)
+    return token.organization
+
+
+def token_required(view):
+    """Проверяет токен и передаёт организацию в представление как ``request.api_organization``."""
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'token' or not key:
+            return _error('authentication required', 401)
+        organization = _organization_for_key(key.strip())
+        if organization is None:
+            return _error('invalid token', 401)
+        request.api_organization = organization
+        # Запросы к данным идут в базу организации токена (core/shards.py)
+        with shards.use(organization.pk):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+def _client_json(client):
+    return {'id': client.id, 'name': client.name, 'phone': client.phone, 'balance': client.balance}
+
+
+@token_required
+@require_GET
+def client_lookup(request):
+    phone = normalize_phone(request.GET.get('phone', ''))
+    client = Client.objects.filter(organization=request.api_organization, phone=phone).first()
+    if client is None:
+        return _error('client not found', 404)
+    return JsonResponse({'client': _client_json(client)})
+
+
+@token_required
+@require_GET
+def balance_lookup(request):
+    client_id, balance = balances.lookup(request.api_organization.pk, request.GET.get('phone', ''))
+    if client_id is None:
+        return _error('client not found', 404)
+    return JsonResponse({'id': client_id, 'balance': balance})
+
+
+@token_required
+@require_GET
+def client_history(request, client_id):
+    client = Client.objects.filter(id=client_id, organization=request.api_organization).only('id').first()
+    if client is None:
+        return _error('client not found', 404)
+    page = _history_page(request, client)
+    return JsonResponse({'entries': page.items, 'next': page.next_cursor})
+
+
+def _resolve_clients(org, operations):
+    """Все клиенты пачки одним запросом: словари по id и по телефону."""
+    ids = {op['client_id'] for op in operations if isinstance(op.get('client_id'), int)}
+    phones = {normalize_phone(str(op['phone'])) for op in operations if op.get('phone')}
+    clients = Client.objects.filter(organization=org).filter(Q(id__in=ids) | Q(phone__in=phones))
+    by_id = {client.id: client for client in clients}
+    return by_id, {client.phone: client for client in by_id.values()}
+
+
+def _apply(op, by_id, by_phone):
+    """Проводит одну операцию, возвращает элемент ``results``."""
+    client_id = op.get('client_id')
+    if client_id is not None:
+        client = by_id.get(client_id) if isinstance(client_id, int) else None
+    else:
+        client = by_phone.get(normalize_phone(str(op.get('phone') or '')))
+    if client is None:
+        return {'error': 'client not found'}
+
+    typ = op.get('type')
+    if typ == 'reset':
+        entry = ledger.reset_balance(client)
+    elif typ in OPERATION_TYPES:
+        form = BonusForm({'amount': op.get('amount'), 'type': typ})
+        if not form.is_valid():
+            return {'error': 'invalid amount', 'client_id': client.id}
+        amount = form.cleaned_data['amount']
+        entry = ledger.post_bonus(client, -amount if typ == 'deduction' else amount, op.get('description') or None)
+    else:
+        return {'error': f'unknown type {typ!r}', 'client_id': client.id}
+    return {'client_id': client.id, 'entry_id': entry.id, 'amount': entry.amount, 'balance': client.balance}
+
+
+def _run_operations(org, payload):
+    operations = payload.get('operations') if isinstance(payload, dict) else None
+    if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+        return 400, {'error': '"operations" must be a list of objects'}
+    limit = getattr(settings, 'API_MAX_OPERATIONS', DEFAULT_MAX_OPERATIONS)
+    if len(operations) > limit:
+        return 400, {'error': f'at most {limit} operations per request'}
+
+    by_id, by_phone = _resolve_clients(org, operations)
+    results = []
+    for op in operations:
+        try:
+            results.append(_apply(op, by_id, by_phone))
+        except ledger.LedgerConflict as e:
+            results.append({'error': str(e)})
+    return 200, {'results': results}
+
+
+def _as_json(body):
+    # Decimal превращается в строку, как в JsonResponse: повтор из
+    # IdempotencyRecord отдаёт ровно тот же ответ
+    return json.loads(json.dumps(body, cls=DjangoJSONEncoder))
+
+
+@token_required
+@require_POST
+def operations(request):
+    org = request.api_organization
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return _error('invalid JSON', 400)
+
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        status, body = _run_operations(org, payload)
+        return JsonResponse(body, status=status)
+    if len(key) > 255:
+        return _error('Idempotency-Key is too long', 400)
+
+    request_hash = hashlib.sha256(request.body).hexdigest()
+    records = IdempotencyRecord.objects.filter(organization=org, key=key)
+    record = records.first()
+    if record is None:
+        try:
+            with transaction.atomic(using=shards.database_for(org.pk, write=True)):
+                status, body = _run_operations(org, payload)
+                body = _as_json(body)
+                IdempotencyRecord.objects.create(
+                    organization=org, key=key, request_hash=request_hash, status_code=status, response=body
+                )
+            logger.info("API operations for organization %s stored under key %r", org.pk, key)
+            return JsonResponse(body, status=status)
+        except IntegrityError:
+            # Параллельный запрос с тем же ключом успел закоммитить свой ответ,
+            # наши проводки откатились вместе с транзакцией
+            record = records.get()
+
+    if record.request_hash != request_hash:
+        return _error('Idempotency-Key was already used with a different request', 422)
+    response = JsonResponse(record.response, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from . import notifications, shards
+        from .db import configure_connection
+        from .models import Organization
+        from .search import ensure_search_indexes_after_migrate
+        checks.register(notifications.check_transport)
+        connection_created.connect(configure_connection)
+        post_migrate.connect(ensure_search_indexes_after_migrate, sender=self)
+        post_migrate.connect(shards.reserve_ids_after_migrate, sender=self)
+        post_save.connect(shards.sync_organization, sender=Organization)
+        post_delete.connect(shards.delete_organization, sender=Organization)
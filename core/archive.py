@@ -0,0 +1,154 @@
+"""
+Архивация истории бонусов.
+
+Записи ``BonusHistory`` старше горизонта хранения переносятся пачками в
+``BonusHistoryArchive`` (``manage.py archive_history``). Каждая пачка —
+одна транзакция: вставка в архив, удаление из живой таблицы и обновление
+``BalanceSnapshot`` клиентов пачки. Прерванный прогон просто запускается
+снова: перенесённых строк в живой таблице уже нет.
+
+Снимок хранит ``balance_after`` последней заархивированной записи клиента,
+поэтому цепочка балансов проверяется без чтения архива: первая живая запись
+после снимка должна начинаться с его баланса (``verify``).
+
+Все архивные записи клиента старше живых, поэтому история читается одной
+курсорной выборкой: сначала живая таблица, затем, когда она кончилась, архив
+с тем же курсором (``history_page``).
+"""
+import logging
+from itertools import chain
+
+from django.db import transaction
+
+from . import shards
+from .models import BalanceSnapshot, BonusHistory, BonusHistoryArchive, Client
+from .pagination import KeysetPage, encode_cursor, get_page_size, keyset_paginate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5000
+HISTORY_ORDER = ('date', 'id')
+ARCHIVED_FIELDS = ('id', 'client_id', 'date', 'amount', 'description', 'balance_after', 'batch_id')
+
+
+def history_page(client_id, fields, after=None, page_size=None):
+    """Страница истории клиента (новые первыми) по живой таблице и архиву."""
+    page_size = page_size or get_page_size()
+    live = keyset_paginate(
+        BonusHistory.objects.filter(client_id=client_id).values(*fields), HISTORY_ORDER,
+        after=after, page_size=page_size, descending=True,
+    )
+    if live.has_next:
+        return live
+
+    remaining = page_size - len(live.items)
+    last = live.items[-1] if live.items else None
+    cursor = encode_cursor((last['date'], last['id'])) if last else after
+    archived = keyset_paginate(
+        BonusHistoryArchive.objects.filter(client_id=client_id).values(*fields), HISTORY_ORDER,
+        after=cursor, page_size=max(remaining, 1), descending=True,
+    )
+    if not remaining:
+        # Живая страница заполнена целиком: архив нужен только для ссылки «дальше»
+        return KeysetPage(live.items, next_cursor=cursor if archived.items else None, prev_cursor=live.prev_cursor)
+    return KeysetPage(live.items + archived.items, next_cursor=archived.next_cursor, prev_cursor=live.prev_cursor)
+
+
+def all_history(queryset_filter, fields, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Итератор по архиву и живой истории (в порядке id) с общим фильтром."""
+    return chain(
+        BonusHistoryArchive.objects.filter(**queryset_filter).order_by('id').values_list(*fields)
+        .iterator(chunk_size=chunk_size),
+        BonusHistory.objects.filter(**queryset_filter).order_by('id').values_list(*fields)
+        .iterator(chunk_size=chunk_size),
+    )
+
+
+def _update_snapshots(rows, as_of):
+    last_by_client = {}
+    counts = {}
+    for row in rows:
+        last_by_client[row['client_id']] = row  # строки идут по возрастанию id
+        counts[row['client_id']] = counts.get(row['client_id'], 0) + 1
+
+    existing = {
+        snapshot.client_id: snapshot
+        for snapshot in BalanceSnapshot.objects.filter(client_id__in=list(last_by_client), as_of=as_of)
+    }
+    created, updated = [], []
+    for client_id, row in last_by_client.items():
+        snapshot = existing.get(client_id)
+        if snapshot is None:
+            snapshot = BalanceSnapshot(client_id=client_id, as_of=as_of, entries=0)
+            created.append(snapshot)
+        else:
+            updated.append(snapshot)
+        snapshot.balance = row['balance_after']
+        snapshot.last_entry_id = row['id']
+        snapshot.last_entry_date = row['date']
+        snapshot.entries += counts[client_id]
+    BalanceSnapshot.objects.bulk_create(created)
+    BalanceSnapshot.objects.bulk_update(updated, ['balance', 'last_entry_id', 'last_entry_date', 'entries'])
+
+
+def archive_chunk(organization_id, before, chunk_size=DEFAULT_CHUNK_SIZE, after_id=0):
+    """
+    Переносит в архив до ``chunk_size`` записей организации с датой раньше
+    ``before`` и id больше ``after_id``. Возвращает (число записей, id
+    последней из них); (0, None), если переносить больше нечего.
+    Во время переноса организации в другую базу — OrganizationMoving: команда
+    переноса дописывает только новые записи и не увидит перемещённых в архив.
+    """
+    database, move_state = shards.placement(organization_id)
+    if move_state:
+        raise shards.OrganizationMoving(organization_id)
+    with shards.use(organization_id):
+        return _archive_chunk(organization_id, before, chunk_size, after_id, database)
+
+
+def _archive_chunk(organization_id, before, chunk_size, after_id, database):
+    rows = list(
+        BonusHistory.objects.filter(client__organization_id=organization_id, date__lt=before, id__gt=after_id)
+        .order_by('id')
+        .values(*ARCHIVED_FIELDS)[:chunk_size]
+    )
+    if not rows:
+        return 0, None
+    with transaction.atomic(using=database):
+        # ignore_conflicts: строка могла попасть в архив в прогоне, упавшем после коммита
+        BonusHistoryArchive.objects.bulk_create([BonusHistoryArchive(**row) for row in rows], ignore_conflicts=True)
+        BonusHistory.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        _update_snapshots(rows, before.date())
+    logger.info("Archived %d history entries of organization %s up to id %d", len(rows), organization_id, rows[-1]['id'])
+    return len(rows), rows[-1]['id']
+
+
+def archive_organization(organization_id, before, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Переносит в архив всю историю организации старше ``before``. Возвращает число записей."""
+    archived = 0
+    last_id = 0
+    while True:
+        moved, last_id = archive_chunk(organization_id, before, chunk_size, last_id)
+        if not moved:
+            return archived
+        archived += moved
+        if progress:
+            progress(archived)
+
+
+def verify(client):
+    """
+    Проверяет, что живая история продолжает последний снимок баланса:
+    ``balance_after - amount`` первой живой записи после снимка равен его
+    балансу. Возвращает True, если снимка нет или цепочка сходится.
+    """
+    snapshot = BalanceSnapshot.objects.filter(client=client).order_by('-last_entry_id').first()
+    if snapshot is None:
+        return True
+    first = (
+        BonusHistory.objects.filter(client=client, id__gt=snapshot.last_entry_id)
+        .order_by('date', 'id').values('amount', 'balance_after').first()
+    )
+    if first is None:
+        return Client.objects.filter(id=client.pk, balance=snapshot.balance).exists()
+    return first['balance_after'] - first['amount'] == snapshot.balance
@@ -0,0 +1,194 @@
+"""
+Асинхронные версии страниц для запуска под ASGI (bonus_manager/asgi.py).
+
+Под ASGI каждое синхронное представление занимает поток из пула на всё время
+запроса. Здесь независимые чтения одного запроса — шаблон сообщений, итог
+«потрачено за месяц», таблица клиентов; клиент и страница его истории —
+запускаются одновременно через ``asyncio.gather``, а медленный клиент держит
+только корутину.
+
+Запросы к БД по-прежнему синхронные (Django ORM), поэтому при
+``ASYNC_PARALLEL_QUERIES`` каждый из них идёт в отдельном потоке со своим
+соединением. Для SQLite параллельность по умолчанию выключена: файл всё равно
+читается одним соединением за раз, и запросы выполняются по очереди в потоке
+запроса.
+
+POST-запросы и проводки через API выполняются синхронными представлениями
+core/views.py и core/api.py.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections, connection
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+from django.shortcuts import render
+
+from . import api, message_templates, shards, views
+from .models import ApiToken, Client
+
+
+def _parallel():
+    return getattr(settings, 'ASYNC_PARALLEL_QUERIES', connection.vendor != 'sqlite')
+
+
+def _db(func, *args):
+    """Синхронная функция с запросами к БД как awaitable."""
+    if not _parallel():
+        return sync_to_async(func)(*args)
+
+    def run():
+        try:
+            return func(*args)
+        finally:
+            # Соединение этого потока закрывается по тем же правилам, что и в
+            # конце обычного запроса (CONN_MAX_AGE)
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)()
+
+
+def _login_gate(request):
+    """Общая часть представлений: вход и организация пользователя. (ответ, организация)."""
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path()), None
+    return views._dashboard_gate(request), request.user.organization
+
+
+def _start_dashboard(request):
+    """
+    Синхронная часть GET дашборда (сессия, пользователь, условный GET).
+    Возвращает (ответ, состояние): ответ — редирект или 304.
+    """
+    response, org = _login_gate(request)
+    if response is not None:
+        return response, None
+    local = shards.local_organization(org)
+    search_query = request.GET.get('search', '')
+    etag = views._dashboard_etag(request, local, search_query)
+    response = views._not_modified(request, local, etag)
+    state = {'org': org, 'local': local, 'search_query': search_query, 'etag': etag}
+    return response, state
+
+
+def _finish_dashboard(request, state, template, spent, client_table):
+    org = state['org']
+    context = {
+        'add_form': views.AddClientForm(), 'bonus_form': views.BonusForm(),
+        'template_form': views.TemplateForm(instance=template), 'spent': spent, 'business_name': org.name,
+        'search_query': state['search_query'], 'client_table': client_table,
+    }
+    response = views._render_dashboard(request, org, state['local'], state['search_query'], context)
+    return views._with_validators(response, state['local'], state['etag'])
+
+
+async def dashboard(request):
+    if request.method != 'GET':
+        return await sync_to_async(views.dashboard)(request)
+
+    response, state = await sync_to_async(_start_dashboard)(request)
+    if response is not None:
+        return response
+
+    org, local = state['org'], state['local']
+    template, spent, client_table = await asyncio.gather(
+        _db(message_templates.get_for_user, request.user),
+        _db(views._dashboard_spent, org, local),
+        _db(views._client_table, request, org, local, state['search_query']),
+    )
+    return await sync_to_async(_finish_dashboard)(request, state, template, spent, client_table)
+
+
+async def _client_and_history(org, request, client_id, client_fields):
+    """
+    Клиент организации и страница его истории одновременно. История читается
+    по id ещё до проверки владельца и отбрасывается, если клиент чужой.
+    """
+    client, page = await asyncio.gather(
+        _db(lambda: Client.objects.filter(id=client_id, organization=org).only(*client_fields).first()),
+        _db(views._history_page, request, Client(id=client_id)),
+    )
+    if client is None:
+        raise Http404('Client not found')
+    return client, page
+
+
+async def history(request, client_id):
+    response, org = await sync_to_async(_login_gate)(request)
+    if response is not None:
+        return response
+    client, page = await _client_and_history(org, request, client_id, ('id', 'name', 'phone', 'balance'))
+    return await sync_to_async(render)(request, 'core/history.html', {'history': page, 'client': client})
+
+
+def _json_gate(request):
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path()), None
+    if request.user.is_superuser:
+        return JsonResponse({'error': 'superuser'}, status=403), None
+    org = request.user.organization
+    if not org:
+        return JsonResponse({'error': 'no organization'}, status=403), None
+    return None, org
+
+
+async def history_json(request, client_id):
+    response, org = await sync_to_async(_json_gate)(request)
+    if response is not None:
+        return response
+    client, page = await _client_and_history(org, request, client_id, ('id', 'name'))
+    return JsonResponse({
+        'client': {'id': client.id, 'name': client.name},
+        'entries': page.items,
+        'next': page.next_cursor,
+    })
+
+
+async def _api_organization(request):
+    """(организация, ответ 401) по заголовку Authorization, как api.token_required."""
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'token' or not key:
+        return None, api._error('authentication required', 401)
+    token = await (
+        ApiToken.objects.select_related('organization')
+        .filter(key_hash=api.hash_key(key.strip()), is_active=True)
+        .afirst()
+    )
+    if token is None:
+        return None, api._error('invalid token', 401)
+    return token.organization, None
+
+
+async def api_client_lookup(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    org, response = await _api_organization(request)
+    if response is not None:
+        return response
+    phone = api.normalize_phone(request.GET.get('phone', ''))
+    with shards.use(org.pk):
+        client = await Client.objects.filter(organization=org, phone=phone).afirst()
+    if client is None:
+        return api._error('client not found', 404)
+    return JsonResponse({'client': api._client_json(client)})
+
+
+async def api_client_history(request, client_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    org, response = await _api_organization(request)
+    if response is not None:
+        return response
+    try:
+        with shards.use(org.pk):
+            _, page = await _client_and_history(org, request, client_id, ('id',))
+    except Http404:
+        return api._error('client not found', 404)
+    return JsonResponse({'entries': page.items, 'next': page.next_cursor})
+
+
+# csrf_exempt в Django 4.2 оборачивает представление синхронной функцией,
+# поэтому для корутин флаг ставится напрямую
+api_client_lookup.csrf_exempt = True
+api_client_history.csrf_exempt = True
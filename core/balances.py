@@ -0,0 +1,98 @@
+"""
+Быстрый ответ кассе на вопрос «какой баланс у этого номера».
+
+В памяти процесса лежит ограниченный LRU-словарь
+(организация, нормализованный номер) -> (id клиента, баланс, версия). Версия —
+версия данных организации из core/pagecache.py (``Organization.data_version``):
+её меняет в транзакции записи каждая проводка core/ledger.py, а также создание,
+удаление и импорт клиентов (core/counters.py). Запись, сохранённая до
+изменения, перечитывается одним запросом по индексу, свежая отдаётся без
+обращения к БД. Отсутствующий номер тоже кэшируется: появление клиента меняет
+версию.
+
+Версию процесс перечитывает из БД не чаще раза в ``BALANCE_VERSION_TTL``
+секунд (``pagecache.recent_version``): попадание в кэш обходится без запросов,
+а запись в другом воркере становится видна не позже чем через этот срок.
+Запись в этом же процессе видна сразу. Версия читается до запроса к клиенту,
+поэтому проводка, закоммиченная между ними, не оставит в кэше устаревший
+баланс с новой версией.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import pagecache
+from .models import Client
+from .normalize import normalize_phone
+
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_VERSION_TTL = 1.0
+
+
+class BalanceCache:
+    """LRU-словарь с ограничением числа записей; потокобезопасный."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        """(id клиента, баланс) или None, если записи нет или она старше ``version``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def set(self, key, client_id, balance, version):
+        with self._lock:
+            self._entries[key] = (client_id, balance, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+_cache = BalanceCache(getattr(settings, 'BALANCE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+
+
+def lookup(organization_id, phone):
+    """(id клиента, баланс) по номеру телефона или (None, None), если клиента нет."""
+    key = (organization_id, normalize_phone(phone))
+    version = pagecache.recent_version(
+        organization_id, getattr(settings, 'BALANCE_VERSION_TTL', DEFAULT_VERSION_TTL),
+    )
+    found = _cache.get(key, version)
+    if found is not None:
+        return found
+    row = (
+        Client.objects.filter(organization_id=organization_id, phone=key[1])
+        .values_list('id', 'balance').first()
+    )
+    client_id, balance = row or (None, None)
+    _cache.set(key, client_id, balance, version)
+    return client_id, balance
+
+
+def stats():
+    """Для /metrics/: (попадания, промахи, записей в кэше)."""
+    return _cache.hits, _cache.misses, len(_cache)
+
+
+def clear():
+    _cache.clear()
+    pagecache.forget()
@@ -0,0 +1,166 @@
+"""
+Массовые начисления и списания (``BonusBatch``).
+
+Выборка клиентов хранится в ``BonusBatch.selection``:
+
+* ``{'client_ids': [1, 2, 3]}`` — явный список;
+* ``{'active_days': 30}`` — клиенты с операциями за последние N дней;
+* ``{'all': True}`` — все клиенты организации;
+* ``{'birthdays': ['03-08']}`` — клиенты с днём рождения в эти дни (MM-DD);
+* ``{'expire_before': '<ISO datetime>'}`` — сгорание по FIFO начислений до
+  этого момента (core/expiration.py): у каждого клиента своя сумма, поле
+  ``amount`` проводки не используется.
+
+Правила из core/rules.py создают такие проводки каждую ночь, дашборд — по
+запросу кассира. Выполняет их фоновый ``manage.py run_batches --loop``: запрос
+только создаёт проводку в статусе ``pending`` и отдаёт страницу её прогресса.
+
+Клиенты обрабатываются пачками по ``chunk_size`` в порядке id; каждая пачка —
+отдельная короткая транзакция (core.ledger.post_many). Клиенты, у которых
+уже есть запись истории с этой проводкой, пропускаются, поэтому повторный
+запуск той же проводки ничего не начисляет дважды и продолжает с места
+остановки. Клиенты, у которых баланс меньше списания, не проводятся и
+считаются в ``BonusBatch.skipped``.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import expiration, ledger, pagecache, shards
+from .models import BonusBatch, BonusHistory, Client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def select_clients(batch):
+    clients = Client.objects.filter(organization_id=batch.organization_id)
+    selection = batch.selection or {}
+    if 'client_ids' in selection:
+        return clients.filter(id__in=selection['client_ids'])
+    if 'active_days' in selection:
+        since = batch.created_at - timedelta(days=int(selection['active_days']))
+        return clients.filter(
+            id__in=BonusHistory.objects.filter(
+                client__organization_id=batch.organization_id, date__gte=since
+            ).values('client_id')
+        )
+    if 'birthdays' in selection:
+        condition = Q()
+        for day in selection['birthdays']:
+            month, day = day.split('-')
+            condition |= Q(birthday__month=int(month), birthday__day=int(day))
+        return clients.filter(condition) if condition else clients.none()
+    if 'expire_before' in selection:
+        return clients.filter(balance__gt=0)
+    if selection.get('all'):
+        return clients
+    return clients.none()
+
+
+def get_or_create_batch(batch_id, org, amount, selection, description=None, user=None):
+    """
+    Возвращает (batch, created). Повторный запрос с тем же batch_id отдаёт уже
+    существующую проводку; чужой организации она не видна.
+    """
+    defaults = {
+        'organization': org,
+        'amount': amount,
+        'description': description or (ledger.DESCRIPTION_ACCRUAL if amount > 0 else ledger.DESCRIPTION_DEDUCTION),
+        'selection': selection,
+        'created_by': user,
+    }
+    using = shards.database_for(org.pk, write=True)
+    try:
+        with transaction.atomic(using=using):
+            batch, created = BonusBatch.objects.using(using).get_or_create(id=batch_id, defaults=defaults)
+    except IntegrityError:
+        batch, created = BonusBatch.objects.using(using).get(id=batch_id), False
+    if batch.organization_id != org.pk:
+        raise BonusBatch.DoesNotExist(f'Batch {batch_id} does not exist')
+    if created:
+        # Форма на закэшированной странице дашборда несёт этот batch_id:
+        # после отправки страница должна получить новый
+        pagecache.bump(org.pk)
+    return batch, created
+
+
+def claim(batch):
+    """Переводит проводку pending -> running; False, если её уже кто-то выполняет."""
+    claimed = BonusBatch.objects.using(batch._state.db).filter(id=batch.id, status=BonusBatch.STATUS_PENDING).update(
+        status=BonusBatch.STATUS_RUNNING, updated_at=timezone.now()
+    )
+    if claimed:
+        batch.status = BonusBatch.STATUS_RUNNING
+    return bool(claimed)
+
+
+def requeue_stale(batch, stale_before):
+    """
+    Возвращает в очередь проводку, застрявшую в ``running`` без прогресса с
+    ``stale_before`` (процесс упал). True, если проводку можно забирать.
+    """
+    if batch.status == BonusBatch.STATUS_RUNNING and batch.updated_at < stale_before:
+        BonusBatch.objects.using(batch._state.db).filter(id=batch.id, updated_at=batch.updated_at).update(status=BonusBatch.STATUS_PENDING)
+        batch.status = BonusBatch.STATUS_PENDING
+    return batch.status == BonusBatch.STATUS_PENDING
+
+
+def _post_chunk(batch, client_ids):
+    """Проводит пачку клиентов. Возвращает (проведено, пропущено)."""
+    expire_before = (batch.selection or {}).get('expire_before')
+    if expire_before is None:
+        posted = ledger.post_many(batch.organization_id, client_ids, batch.amount, batch.description, batch=batch)
+        # Списание больше баланса ledger не проводит
+        return posted, len(client_ids) - posted
+    using = shards.database_for(batch.organization_id, write=True)
+    with transaction.atomic(using=using):
+        amounts = expiration.expired_amounts(client_ids, datetime.fromisoformat(expire_before), using)
+        return len(ledger.post_amounts(batch.organization_id, amounts, batch.description, batch=batch)), 0
+
+
+def run(batch, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Проводит batch по выбранным клиентам. ``progress(batch)`` вызывается после
+    каждой пачки. Возвращает batch с обновлёнными processed/status.
+    """
+    with shards.use(batch.organization_id):
+        return _run(batch, chunk_size, progress)
+
+
+def _run(batch, chunk_size, progress):
+    clients = select_clients(batch)
+    batch.total = clients.count()
+    BonusBatch.objects.filter(id=batch.id).update(total=batch.total, updated_at=timezone.now())
+
+    batch.processed = BonusHistory.objects.filter(batch=batch).count()
+    # Пропущенные клиенты не оставляют истории и при повторе проверяются заново
+    batch.skipped = 0
+    last_id = 0
+    while True:
+        ids = list(clients.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        done = set(BonusHistory.objects.filter(batch=batch, client_id__in=ids).values_list('client_id', flat=True))
+        pending = [client_id for client_id in ids if client_id not in done]
+        posted, skipped = _post_chunk(batch, pending)
+        batch.processed += posted
+        batch.skipped += skipped
+        BonusBatch.objects.filter(id=batch.id).update(
+            processed=batch.processed, skipped=batch.skipped, updated_at=timezone.now(),
+        )
+        logger.info(
+            "Batch %s: posted %d, skipped %d, progress %d/%d",
+            batch.id, posted, skipped, batch.processed + batch.skipped, batch.total,
+        )
+        if progress:
+            progress(batch)
+
+    batch.status = BonusBatch.STATUS_DONE
+    BonusBatch.objects.filter(id=batch.id).update(status=batch.status, updated_at=timezone.now())
+    return batch
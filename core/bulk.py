@@ -0,0 +1,268 @@
+"""
+Массовый импорт и экспорт клиентов.
+
+Импорт читает файл потоково и обрабатывает его пачками: номера
+нормализуются по тем же правилам, что и в форме добавления клиента,
+дубликаты отсекаются одним запросом ``phone__in`` на пачку, новые клиенты
+вставляются через ``bulk_create``. Экспорт отдаёт CSV построчно из
+``iterator()``, поэтому память не растёт с размером организации.
+
+CSV читается в UTF-8, а если начало файла в UTF-8 не декодируется — в
+Windows-1251 (так сохраняет CSV русский Excel). Нечитаемый файл любого
+формата даёт ``ImportFormatError``, а не ошибку сервера.
+"""
+import codecs
+import csv
+import io
+import logging
+import zipfile
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+from .models import Client
+from .normalize import is_valid_phone, normalize_phone
+from . import archive, counters, shards
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+# Сколько байт начала CSV проверяется при выборе кодировки
+ENCODING_SAMPLE_SIZE = 64 * 1024
+FALLBACK_ENCODING = 'cp1251'
+
+# Заголовки колонок, которые понимает импорт (регистр не важен)
+COLUMN_ALIASES = {
+    'name': 'name', 'имя': 'name',
+    'phone': 'phone', 'телефон': 'phone',
+    'balance': 'balance', 'баланс': 'balance',
+}
+
+CLIENT_EXPORT_HEADER = ['id', 'name', 'phone', 'balance']
+HISTORY_EXPORT_HEADER = ['id', 'client_id', 'phone', 'date', 'amount', 'description', 'balance_after']
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    duplicates: int = 0
+    invalid: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'{line}: {message}')
+
+
+def _normalize_header(header):
+    columns = [COLUMN_ALIASES.get(str(h or '').strip().lower()) for h in header]
+    if 'name' not in columns or 'phone' not in columns:
+        raise ImportFormatError('File must have "name" and "phone" columns')
+    return columns
+
+
+def _rows_from_table(rows):
+    rows = iter(rows)
+    try:
+        columns = _normalize_header(next(rows))
+    except StopIteration:
+        return
+    for values in rows:
+        yield {column: value for column, value in zip(columns, values) if column}
+
+
+def _detect_encoding(binary_file):
+    head = binary_file.read(ENCODING_SAMPLE_SIZE)
+    binary_file.seek(0)
+    try:
+        # final=False: последний символ мог обрезаться на границе образца
+        codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    return 'utf-8-sig'
+
+
+def _checked_rows(rows, error):
+    """Перехватывает ошибки разбора, которые возникают при чтении строк файла."""
+    try:
+        yield from rows
+    except ImportFormatError:
+        raise
+    except error as e:
+        raise ImportFormatError(f'invalid file: {e}')
+
+
+def read_csv(binary_file, encoding=None):
+    """Строки CSV как словари name/phone/balance. Разделитель определяется автоматически."""
+    encoding = encoding or _detect_encoding(binary_file)
+    text = codecs.getreader(encoding)(binary_file)
+    try:
+        sample = text.read(4096)
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f'invalid file: {e}')
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    rows = csv.reader(_chain_text(sample, text), dialect)
+    return _checked_rows(_rows_from_table(rows), (UnicodeDecodeError, csv.Error))
+
+
+def _chain_text(head, rest):
+    yield from io.StringIO(head + rest.readline())
+    yield from rest
+
+
+def read_xlsx(binary_file):
+    """Строки первого листа XLSX. Требует openpyxl."""
+    try:
+        from openpyxl import load_workbook
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        raise ImportFormatError('XLSX import requires the openpyxl package')
+    # Не XLSX, повреждённый архив или книга без листов
+    errors = (zipfile.BadZipFile, InvalidFileException, KeyError, IndexError, ValueError, OSError)
+    try:
+        workbook = load_workbook(binary_file, read_only=True, data_only=True)
+        sheet = workbook.worksheets[0]
+    except errors as e:
+        raise ImportFormatError(f'invalid XLSX file: {e}')
+    return _checked_rows(_rows_from_table(sheet.iter_rows(values_only=True)), errors)
+
+
+def read_rows(binary_file, filename):
+    if filename.lower().endswith('.xlsx'):
+        return read_xlsx(binary_file)
+    return read_csv(binary_file)
+
+
+def _parse_balance(value):
+    if value in (None, ''):
+        return Decimal(0)
+    try:
+        balance = Decimal(str(value).replace(' ', '').replace(',', '.'))
+        if not balance.is_finite():
+            raise InvalidOperation
+        balance = balance.quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'invalid balance {value!r}')
+    if abs(balance) >= Decimal('1e8'):
+        raise ValueError(f'balance {value!r} is too large')
+    return balance
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _insert_chunk(org, candidates, batch_size):
+    """Вставляет новых клиентов пачки, возвращает (создано, дубликатов)."""
+    using = shards.database_for(org.pk, write=True)
+    for attempt in range(2):
+        existing = set(
+            Client.objects.using(using).filter(organization=org, phone__in=list(candidates)).values_list('phone', flat=True)
+        )
+        new_clients = [c for phone, c in candidates.items() if phone not in existing]
+        try:
+            with transaction.atomic(using=using):
+                Client.objects.using(using).bulk_create(new_clients, batch_size=batch_size)
+                counters.clients_added(org.pk, len(new_clients), sum(c.balance for c in new_clients), using)
+        except IntegrityError:
+            # Клиента успели добавить параллельно через дашборд — перечитываем дубликаты
+            if attempt:
+                raise
+            continue
+        return len(new_clients), len(existing)
+
+
+def import_clients(org, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Импортирует клиентов в организацию и возвращает ``ImportResult``."""
+    result = ImportResult()
+    seen = set()
+    line = 1  # строка заголовка
+    for chunk in _chunks(rows, chunk_size):
+        candidates = {}
+        for row in chunk:
+            line += 1
+            name = str(row.get('name') or '').strip()
+            raw_phone = row.get('phone')
+            if isinstance(raw_phone, float) and raw_phone.is_integer():
+                # XLSX хранит номер без форматирования как число
+                raw_phone = int(raw_phone)
+            phone = normalize_phone(str(raw_phone or ''))
+            if not name:
+                result.add_error(line, 'empty name')
+                continue
+            if not is_valid_phone(phone):
+                result.add_error(line, f'invalid phone {row.get("phone")!r}')
+                continue
+            try:
+                balance = _parse_balance(row.get('balance'))
+            except ValueError as e:
+                result.add_error(line, str(e))
+                continue
+            if phone in seen:
+                result.duplicates += 1
+                continue
+            seen.add(phone)
+            client = Client(organization=org, name=name[:255], phone=phone, balance=balance)
+            client.fill_search_fields()
+            candidates[phone] = client
+
+        if not candidates:
+            continue
+        created, duplicates = _insert_chunk(org, candidates, chunk_size)
+        result.created += created
+        result.duplicates += duplicates
+        logger.info("Imported %d clients into organization %s (line %d)", created, org.pk, line)
+
+    return result
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _csv_lines(org, header, rows):
+    writer = csv.writer(_Echo())
+    yield '\ufeff' + writer.writerow(header)
+    # Ответ читается после выхода из TenantMiddleware: базу организации
+    # для ленивых запросов задаём здесь, иначе они уйдут в default
+    with shards.use(org.pk):
+        for row in rows:
+            yield writer.writerow(row)
+
+
+def export_clients(org, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Генератор строк CSV со всеми клиентами организации."""
+    rows = (
+        Client.objects.filter(organization=org)
+        .order_by('id')
+        .values_list(*CLIENT_EXPORT_HEADER)
+        .iterator(chunk_size=chunk_size)
+    )
+    return _csv_lines(org, CLIENT_EXPORT_HEADER, rows)
+
+
+def export_history(org, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Генератор строк CSV со всей историей бонусов организации, включая архив."""
+    rows = archive.all_history(
+        {'client__organization': org},
+        ('id', 'client_id', 'client__phone', 'date', 'amount', 'description', 'balance_after'),
+        chunk_size=chunk_size,
+    )
+    return _csv_lines(org, HISTORY_EXPORT_HEADER, rows)
@@ -0,0 +1,68 @@
+"""
+Счётчики организации: число клиентов и сумма бонусных балансов (обязательства).
+
+Функции вызываются внутри той же транзакции, что и изменение клиентов или
+проводка в core/ledger.py, и меняют счётчик одним ``UPDATE ... F()``.
+Изменения в обход этих путей (ручной SQL, правка данных в shell) исправляет
+``manage.py reconcile_counters``.
+
+Тем же ``UPDATE`` меняется версия кэша дашборда (core/pagecache.py): любое
+изменение клиентов или баланса проходит через эти функции.
+"""
+from decimal import Decimal
+
+from django.db.models import Count, F, Sum
+
+from . import pagecache, shards
+from .models import Client, Organization
+
+
+def clients_added(organization_id, count, balance, using=None):
+    # Счётчики ведутся в копии организации в её базе, см. core/shards.py
+    using = using or shards.database_for(organization_id, write=True)
+    Organization.objects.using(using).filter(id=organization_id).update(
+        client_count=F('client_count') + count,
+        total_balance=F('total_balance') + Decimal(balance),
+        data_version=pagecache.next_version(),
+    )
+    pagecache.forget_on_commit(organization_id, using)
+
+
+def clients_removed(organization_id, count, balance, using=None):
+    clients_added(organization_id, -count, -Decimal(balance), using)
+
+
+def balance_changed(organization_id, delta, using=None):
+    using = using or shards.database_for(organization_id, write=True)
+    Organization.objects.using(using).filter(id=organization_id).update(
+        total_balance=F('total_balance') + Decimal(delta),
+        data_version=pagecache.next_version(),
+    )
+    pagecache.forget_on_commit(organization_id, using)
+
+
+def actual(organization_id):
+    """Счётчики, посчитанные по таблице клиентов: (count, total_balance)."""
+    clients = Client.objects.using(shards.database_for(organization_id)).filter(organization_id=organization_id)
+    totals = clients.aggregate(count=Count('id'), total=Sum('balance'))
+    return totals['count'], totals['total'] or Decimal(0)
+
+
+def reconcile(organization, fix=False):
+    """
+    Сравнивает сохранённые счётчики с фактическими. Возвращает словарь
+    расхождений (пустой, если всё сходится); при ``fix=True`` исправляет.
+    """
+    organization = shards.local_organization(organization)
+    count, total = actual(organization.pk)
+    mismatches = {}
+    if organization.client_count != count:
+        mismatches['client_count'] = (organization.client_count, count)
+    if organization.total_balance != total:
+        mismatches['total_balance'] = (organization.total_balance, total)
+    if mismatches and fix:
+        Organization.objects.using(organization._state.db).filter(id=organization.pk).update(
+            client_count=count, total_balance=total, data_version=pagecache.next_version(),
+        )
+        pagecache.forget_on_commit(organization.pk, organization._state.db)
+    return mismatches
@@ -0,0 +1,86 @@
+"""
+Настройка соединений с БД и вспомогательные функции для массового копирования
+и оценки размера таблиц.
+
+Для SQLite каждое новое соединение получает PRAGMA из ``DEFAULT_SQLITE_PRAGMAS``
+с переопределениями из ``settings.SQLITE_PRAGMAS``: WAL позволяет читать во
+время записи, ``busy_timeout`` заставляет ждать блокировку, а не сразу падать
+с «database is locked». База может задать свой набор ключом ``SQLITE_PRAGMAS``
+в ``DATABASES`` (пустой словарь — без PRAGMA, так открывается исходный файл
+manage.py copy_from_sqlite). Профили PostgreSQL и SQLite задаются переменными
+окружения в bonus_manager/settings.py.
+"""
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_SQLITE_PRAGMAS = {
+    # Первым: следующие PRAGMA (смена журнала) тоже ждут блокировку
+    'busy_timeout': 20000,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,  # в КиБ
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_pragmas(settings_dict):
+    """PRAGMA для соединения с базой ``settings_dict`` из ``DATABASES``."""
+    if 'SQLITE_PRAGMAS' in settings_dict:
+        return settings_dict['SQLITE_PRAGMAS']
+    return {**DEFAULT_SQLITE_PRAGMAS, **getattr(settings, 'SQLITE_PRAGMAS', {})}
+
+
+def configure_connection(sender, connection, **kwargs):
+    """Обработчик connection_created: PRAGMA для новых соединений SQLite."""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(connection.settings_dict)
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@contextmanager
+def explicit_timestamps(model):
+    """
+    Отключает auto_now/auto_now_add у полей модели, чтобы ``bulk_create``
+    сохранил даты из объектов (копирование, синтетические данные).
+    """
+    fields = [
+        (field, field.auto_now, field.auto_now_add)
+        for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    for field, _, _ in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in fields:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def estimated_count(model, using='default'):
+    """
+    Приблизительное число строк таблицы без полного ``COUNT(*)`` или None,
+    если СУБД его не даёт. PostgreSQL — ``reltuples`` из статистики
+    планировщика, SQLite — наибольший id (удалённые строки не вычитаются).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            # -1: таблицу ещё ни разу не анализировали
+            return int(row[0]) if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            pk = connection.ops.quote_name(model._meta.pk.column)
+            cursor.execute(f'SELECT MAX({pk}) - MIN({pk}) + 1 FROM {connection.ops.quote_name(table)}')
+            return cursor.fetchone()[0] or 0
+    return None
@@ -0,0 +1,56 @@
+"""
+Сгорание бонусов по FIFO.
+
+Списания (в том числе прежние сгорания и обнуления) гасят самые старые
+начисления, поэтому к дате ``before`` у клиента сгорает
+
+    max(0, начислено до before − списано за всё время),
+
+но не больше текущего баланса. Обе суммы считаются одной группировкой по
+пачке клиентов в живой истории и в архиве (core/archive.py); отдельные
+записи начислений не перебираются.
+
+Баланс, появившийся без записи в истории (начальный баланс при создании
+клиента и импорте), в начислениях не участвует и не сгорает.
+"""
+from decimal import Decimal
+
+from django.db import router
+from django.db.models import Case, DecimalField, F, Sum, Value, When
+
+from .models import BonusHistory, BonusHistoryArchive, Client
+
+DESCRIPTION_EXPIRATION = 'Сгорание бонусов'
+
+_ZERO = Value(Decimal(0), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def _totals(model, client_ids, before, using):
+    return (
+        model.objects.using(using).filter(client_id__in=client_ids)
+        .values('client_id')
+        .annotate(
+            accrued=Sum(Case(When(amount__gt=0, date__lt=before, then=F('amount')), default=_ZERO)),
+            debited=Sum(Case(When(amount__lt=0, then=-F('amount')), default=_ZERO)),
+        )
+        .order_by()
+    )
+
+
+def expired_amounts(client_ids, before, using=None):
+    """Суммы к списанию по клиентам пачки: {client_id: отрицательная сумма}, без нулевых."""
+    using = using or router.db_for_read(Client)
+    accrued = dict.fromkeys(client_ids, Decimal(0))
+    debited = dict.fromkeys(client_ids, Decimal(0))
+    for model in (BonusHistoryArchive, BonusHistory):
+        for row in _totals(model, client_ids, before, using):
+            accrued[row['client_id']] += Decimal(row['accrued'])
+            debited[row['client_id']] += Decimal(row['debited'])
+
+    balances = dict(Client.objects.using(using).filter(id__in=client_ids).values_list('id', 'balance'))
+    amounts = {}
+    for client_id, balance in balances.items():
+        expired = min(accrued[client_id] - debited[client_id], balance)
+        if expired > 0:
+            amounts[client_id] = -expired.quantize(Decimal('0.01'))
+    return amounts
@@ -1,18 +1,72 @@
+import uuid
+
 from django import forms
+from . import message_templates, pagecache
 from .models import Client, MessageTemplate
 
 class AddClientForm(forms.ModelForm):
     class Meta:
         model = Client
-        fields = ['name', 'phone', 'balance']
+        fields = ['name', 'phone', 'balance', 'birthday']
         widgets = {
             'phone': forms.TextInput(attrs={'data-inputmask': "'mask': '+7(999)-999-99-99'"}),
+            'birthday': forms.DateInput(attrs={'type': 'date'}, format='%Y-%m-%d'),
         }
 
 class BonusForm(forms.Form):
     amount = forms.DecimalField(min_value=0.01, decimal_places=2)
     type = forms.ChoiceField(choices=[('accrual', 'Начисление'), ('deduction', 'Списание')])
 
+class IdListField(forms.Field):
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        try:
+            return [int(v) for v in value or []]
+        except (TypeError, ValueError):
+            raise forms.ValidationError('Некорректный список клиентов.')
+
+class BatchBonusForm(forms.Form):
+    TARGET_SELECTED = 'selected'
+    TARGET_ACTIVE = 'active'
+    TARGET_ALL = 'all'
+
+    batch_id = forms.UUIDField(widget=forms.HiddenInput, initial=uuid.uuid4)
+    amount = forms.DecimalField(min_value=0.01, decimal_places=2)
+    type = forms.ChoiceField(choices=[('accrual', 'Начисление'), ('deduction', 'Списание')])
+    target = forms.ChoiceField(choices=[
+        (TARGET_SELECTED, 'Отмеченные клиенты'),
+        (TARGET_ACTIVE, 'Клиенты с операциями за N дней'),
+        (TARGET_ALL, 'Все клиенты'),
+    ])
+    active_days = forms.IntegerField(min_value=1, max_value=3650, initial=30, required=False)
+    # Принадлежность отмеченных id организации проверяется в core/batches.py
+    client_ids = IdListField(required=False)
+
+    def clean(self):
+        cleaned = super().clean()
+        target = cleaned.get('target')
+        if target == self.TARGET_SELECTED and not cleaned.get('client_ids'):
+            self.add_error('client_ids', 'Отметьте хотя бы одного клиента.')
+        if target == self.TARGET_ACTIVE and not cleaned.get('active_days'):
+            self.add_error('active_days', 'Укажите количество дней.')
+        return cleaned
+
+    def selection(self):
+        target = self.cleaned_data['target']
+        if target == self.TARGET_SELECTED:
+            return {'client_ids': sorted(set(self.cleaned_data['client_ids']))}
+        if target == self.TARGET_ACTIVE:
+            return {'active_days': self.cleaned_data['active_days']}
+        return {'all': True}
+
+    def signed_amount(self):
+        amount = self.cleaned_data['amount']
+        return -amount if self.cleaned_data['type'] == 'deduction' else amount
+
+class ImportClientsForm(forms.Form):
+    file = forms.FileField(help_text='CSV или XLSX с колонками name/имя, phone/телефон, balance/баланс')
+
 class TemplateForm(forms.ModelForm):
     class Meta:
         model = MessageTemplate
@@ -21,4 +75,14 @@ class TemplateForm(forms.ModelForm):
             'accrual_template': forms.Textarea(attrs={'rows': 3}),
             'deduction_template': forms.Textarea(attrs={'rows': 3}),
             'reset_template': forms.Textarea(attrs={'rows': 3}),
-        }
\ No newline at end of file
+        }
+
+    def save(self, commit=True):
+        template = super().save(commit=commit)
+        if commit:
+            message_templates.invalidate(template.user_id)
+            # Шаблоны входят в страницу дашборда, см. core/pagecache.py
+            organization_id = template.user.organization_id
+            if organization_id:
+                pagecache.bump(organization_id)
+        return template
@@ -0,0 +1,278 @@
+"""
+Проводки по бонусному счёту клиента.
+
+Баланс меняется одним UPDATE на стороне БД (``balance = balance + x``), а не
+через чтение/изменение/``save()`` в Python, поэтому два кассира, проводящие
+бонусы одновременно, не затирают изменения друг друга. Запись в историю и
+изменение баланса выполняются в одной короткой транзакции, ``balance_after``
+берётся из БД. Списание больше баланса не проходит: условие ``balance >= x``
+стоит в том же UPDATE (``InsufficientBalance``; массовая проводка ``post_many``
+такого клиента пропускает). ``select_for_update`` не используется. В той же
+транзакции обновляются дневные итоги организации (core/rollups.py) и её
+счётчики (core/counters.py).
+"""
+from decimal import Decimal
+
+from django.db import connections, router, transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+
+from . import counters, rollups, shards
+from .models import BonusHistory, Client
+
+CENT = Decimal('0.01')
+
+DESCRIPTION_ACCRUAL = 'Начисление'
+DESCRIPTION_DEDUCTION = 'Списание'
+DESCRIPTION_RESET = 'Обнуление'
+
+# Сколько раз повторять обнуление, если баланс изменился между чтением и UPDATE
+RESET_MAX_ATTEMPTS = 10
+
+
+class LedgerConflict(Exception):
+    pass
+
+
+class InsufficientBalance(LedgerConflict):
+    """Списание больше текущего баланса клиента."""
+
+
+def _add_to_balance(client_id, amount, using):
+    """Прибавляет amount к балансу и возвращает новый баланс из БД."""
+    connection = connections[using]
+    clients = Client.objects.using(using).filter(id=client_id)
+    if connection.features.can_return_columns_from_insert:
+        # SQLite >= 3.35 и PostgreSQL поддерживают UPDATE ... RETURNING
+        table = connection.ops.quote_name(Client._meta.db_table)
+        sql = f'UPDATE {table} SET "balance" = "balance" + %s WHERE "id" = %s'
+        params = [amount, client_id]
+        if amount < 0:
+            sql += ' AND "balance" >= %s'
+            params.append(-amount)
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ' RETURNING "balance"', params)
+            row = cursor.fetchone()
+        if row is None:
+            _refused(clients, client_id, amount)
+        # SQLite возвращает число с плавающей точкой, PostgreSQL — Decimal
+        return Decimal(str(row[0])).quantize(CENT)
+
+    target = clients.filter(balance__gte=-amount) if amount < 0 else clients
+    if not target.update(balance=F('balance') + amount):
+        _refused(clients, client_id, amount)
+    # Строка уже заблокирована нашим UPDATE до конца транзакции
+    return clients.values_list('balance', flat=True).get()
+
+
+def _refused(clients, client_id, amount):
+    """UPDATE не затронул строку: клиента нет или списание больше баланса."""
+    if not clients.exists():
+        raise Client.DoesNotExist(f'Client {client_id} does not exist')
+    raise InsufficientBalance(f'Balance of client {client_id} is less than {-amount}')
+
+
+def _add_to_balances(client_ids, amount, using):
+    """
+    Прибавляет amount к балансам клиентов, возвращает {id: новый баланс}.
+    Списание больше баланса клиента не проводится, его id в ответе нет.
+    """
+    connection = connections[using]
+    if connection.features.can_return_columns_from_insert:
+        table = connection.ops.quote_name(Client._meta.db_table)
+        placeholders = ', '.join(['%s'] * len(client_ids))
+        sql = f'UPDATE {table} SET "balance" = "balance" + %s WHERE "id" IN ({placeholders})'
+        params = [amount, *client_ids]
+        if amount < 0:
+            sql += ' AND "balance" >= %s'
+            params.append(-amount)
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ' RETURNING "id", "balance"', params)
+            return {row[0]: Decimal(str(row[1])).quantize(CENT) for row in cursor.fetchall()}
+
+    if amount < 0:
+        # Без RETURNING не узнать, чьи строки обновил условный UPDATE: по одному
+        balances = {}
+        for client_id in client_ids:
+            try:
+                balances[client_id] = _add_to_balance(client_id, amount, using)
+            except (InsufficientBalance, Client.DoesNotExist):
+                pass
+        return balances
+    clients = Client.objects.using(using).filter(id__in=client_ids)
+    clients.update(balance=F('balance') + amount)
+    return dict(clients.values_list('id', 'balance'))
+
+
+def _add_amounts_to_balances(amounts, using):
+    """Прибавляет к балансам разные суммы одним UPDATE ... CASE, возвращает {id: новый баланс}."""
+    connection = connections[using]
+    if connection.features.can_return_columns_from_insert:
+        table = connection.ops.quote_name(Client._meta.db_table)
+        cases = ' '.join(['WHEN %s THEN %s'] * len(amounts))
+        placeholders = ', '.join(['%s'] * len(amounts))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET "balance" = "balance" + CASE "id" {cases} END '
+                f'WHERE "id" IN ({placeholders}) RETURNING "id", "balance"',
+                [value for item in amounts.items() for value in item] + list(amounts),
+            )
+            return {row[0]: Decimal(str(row[1])).quantize(CENT) for row in cursor.fetchall()}
+
+    clients = Client.objects.using(using).filter(id__in=list(amounts))
+    clients.update(balance=F('balance') + Case(
+        *[When(id=client_id, then=Value(amount)) for client_id, amount in amounts.items()],
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    ))
+    return dict(clients.values_list('id', 'balance'))
+
+
+def post_many(organization_id, client_ids, amount, description=None, batch=None, using=None):
+    """
+    Проводит одинаковую сумму по списку клиентов одним UPDATE и одним
+    ``bulk_create`` истории. Вызывающий код ограничивает размер списка.
+    Клиенты, у которых баланс меньше списания, пропускаются.
+    Возвращает число проведённых клиентов.
+    """
+    amount = Decimal(amount)
+    if description is None:
+        description = DESCRIPTION_ACCRUAL if amount > 0 else DESCRIPTION_DEDUCTION
+    if not client_ids:
+        return 0
+    using = using or shards.database_for(organization_id, write=True)
+    with transaction.atomic(using=using):
+        # Чужие и удалённые клиенты отбрасываются до UPDATE
+        client_ids = list(
+            Client.objects.using(using)
+            .filter(id__in=client_ids, organization_id=organization_id)
+            .values_list('id', flat=True)
+        )
+        if not client_ids:
+            return 0
+        balances = _add_to_balances(client_ids, amount, using)
+        if not balances:
+            return 0
+        now = timezone.now()
+        BonusHistory.objects.using(using).bulk_create([
+            BonusHistory(
+                client_id=client_id, date=now, amount=amount, description=description,
+                balance_after=balance, batch=batch,
+            )
+            for client_id, balance in balances.items()
+        ])
+        rollups.record_entry(organization_id, now, amount, using, count=len(balances))
+        counters.balance_changed(organization_id, amount * len(balances), using)
+    return len(balances)
+
+
+def post_amounts(organization_id, amounts, description, batch=None, using=None):
+    """
+    Проводит по каждому клиенту свою сумму (``{client_id: amount}``) одним
+    UPDATE и одним ``bulk_create`` истории. Вызывающий код ограничивает
+    размер словаря. Возвращает {client_id: проведённая сумма}.
+    """
+    amounts = {client_id: Decimal(amount) for client_id, amount in amounts.items() if amount}
+    if not amounts:
+        return {}
+    using = using or shards.database_for(organization_id, write=True)
+    with transaction.atomic(using=using):
+        amounts = {
+            client_id: amounts[client_id]
+            for client_id in Client.objects.using(using)
+            .filter(id__in=list(amounts), organization_id=organization_id)
+            .values_list('id', flat=True)
+        }
+        if not amounts:
+            return {}
+        balances = _add_amounts_to_balances(amounts, using)
+        now = timezone.now()
+        BonusHistory.objects.using(using).bulk_create([
+            BonusHistory(
+                client_id=client_id, date=now, amount=amounts[client_id], description=description,
+                balance_after=balance, batch=batch,
+            )
+            for client_id, balance in balances.items()
+        ])
+        posted = {client_id: amounts[client_id] for client_id in balances}
+        rollups.record_totals(
+            organization_id, now,
+            accrued=sum((a for a in posted.values() if a > 0), Decimal(0)),
+            spent=sum((-a for a in posted.values() if a < 0), Decimal(0)),
+            operations=len(posted), using=using,
+        )
+        counters.balance_changed(organization_id, sum(posted.values(), Decimal(0)), using)
+    return posted
+
+
+def post_bonus(client, amount, description=None):
+    """
+    Проводит начисление (amount > 0) или списание (amount < 0) и возвращает
+    созданную запись ``BonusHistory``. ``client.balance`` обновляется значением
+    из БД.
+    """
+    amount = Decimal(amount)
+    if description is None:
+        description = DESCRIPTION_ACCRUAL if amount > 0 else DESCRIPTION_DEDUCTION
+    using = router.db_for_write(Client, instance=client)
+    with transaction.atomic(using=using):
+        balance = _add_to_balance(client.pk, amount, using)
+        entry = BonusHistory.objects.using(using).create(
+            client=client, amount=amount, description=description, balance_after=balance
+        )
+        rollups.record_entry(client.organization_id, entry.date, amount, using)
+        counters.balance_changed(client.organization_id, amount, using)
+    client.balance = balance
+    return entry
+
+
+def reset_balance(client):
+    """
+    Обнуляет баланс клиента и возвращает запись ``BonusHistory``.
+
+    Обнуление — условный UPDATE ``WHERE balance = <прочитанное значение>``:
+    если баланс успели изменить, чтение и UPDATE повторяются.
+    """
+    using = router.db_for_write(Client, instance=client)
+    clients = Client.objects.using(using).filter(id=client.pk)
+    for _ in range(RESET_MAX_ATTEMPTS):
+        with transaction.atomic(using=using):
+            old_balance = clients.values_list('balance', flat=True).get()
+            if not clients.filter(balance=old_balance).update(balance=0):
+                continue
+            entry = BonusHistory.objects.using(using).create(
+                client=client, amount=-old_balance, description=DESCRIPTION_RESET, balance_after=0
+            )
+            rollups.record_entry(client.organization_id, entry.date, -old_balance, using)
+            counters.balance_changed(client.organization_id, -old_balance, using)
+        client.balance = Decimal(0)
+        return entry
+    raise LedgerConflict(f'Balance of client {client.pk} kept changing, reset aborted')
+
+
+def create_client(client):
+    """Сохраняет нового клиента и учитывает его в счётчиках организации."""
+    using = router.db_for_write(Client, instance=client)
+    with transaction.atomic(using=using):
+        client.save(using=using)
+        counters.clients_added(client.organization_id, 1, client.balance, using)
+    return client
+
+
+def delete_client(client):
+    """
+    Удаляет клиента вместе с историей. Как и обнуление — условное удаление
+    ``WHERE balance = <прочитанное значение>``, чтобы счётчик обязательств
+    организации уменьшился ровно на удалённый баланс.
+    """
+    using = router.db_for_write(Client, instance=client)
+    clients = Client.objects.using(using).filter(id=client.pk)
+    for _ in range(RESET_MAX_ATTEMPTS):
+        with transaction.atomic(using=using):
+            balance = clients.values_list('balance', flat=True).first()
+            if balance is None:
+                return False
+            if not clients.filter(balance=balance).delete()[0]:
+                continue
+            counters.clients_removed(client.organization_id, 1, balance, using)
+        return True
+    raise LedgerConflict(f'Balance of client {client.pk} kept changing, delete aborted')
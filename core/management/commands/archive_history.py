@@ -0,0 +1,66 @@
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core import archive, shards
+from core.models import BalanceSnapshot, Client, Organization
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит историю бонусов старше горизонта хранения в архив пачками. '
+        'Прерванный прогон можно просто запустить снова.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help='Горизонт хранения в днях (по умолчанию 365)')
+        parser.add_argument('--before', help='Архивировать записи раньше этой даты (YYYY-MM-DD) вместо --days')
+        parser.add_argument('--org', type=int, action='append', dest='org_ids',
+                            help='ID организации (можно указать несколько раз). По умолчанию — все.')
+        parser.add_argument('--chunk-size', type=int, default=archive.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--verify', action='store_true',
+                            help='После переноса проверить, что живая история продолжает снимки балансов')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            try:
+                day = datetime.strptime(options['before'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--before must be a date in YYYY-MM-DD format')
+        else:
+            day = timezone.localdate() - timedelta(days=options['days'])
+        # Граница — полночь, чтобы повторный запуск в тот же день брал ту же дату
+        before = timezone.make_aware(datetime.combine(day, time.min))
+
+        organizations = Organization.objects.order_by('id')
+        if options['org_ids']:
+            organizations = organizations.filter(id__in=options['org_ids'])
+
+        total = 0
+        for org in organizations.iterator():
+            try:
+                archived = archive.archive_organization(
+                    org.pk, before, options['chunk_size'],
+                    progress=lambda count, org=org: self.stdout.write(f'Organization {org.pk}: {count} entries archived'),
+                )
+            except shards.OrganizationMoving:
+                self.stdout.write(self.style.WARNING(f'Organization {org.pk}: skipped, being moved to another database'))
+                continue
+            total += archived
+            if options['verify']:
+                with shards.use(org.pk):
+                    self.verify(org, before)
+        self.stdout.write(self.style.SUCCESS(f'Archived {total} entries older than {day}'))
+
+    def verify(self, org, before):
+        clients = Client.objects.filter(
+            organization=org, id__in=BalanceSnapshot.objects.filter(as_of=before.date()).values('client_id')
+        )
+        broken = [client.pk for client in clients.iterator() if not archive.verify(client)]
+        if broken:
+            self.stdout.write(self.style.WARNING(
+                f'Organization {org.pk}: balance chain broken for clients {", ".join(map(str, broken[:20]))}'
+            ))
+        else:
+            self.stdout.write(f'Organization {org.pk}: balance snapshots verified')
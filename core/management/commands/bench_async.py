@@ -0,0 +1,107 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import clear_url_caches
+
+DEFAULT_PATHS = ['/dashboard/']
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает синхронные представления под WSGI с асинхронными под ASGI: '
+        'N запросов с заданной параллельностью через тестовые клиенты Django'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Пользователь, от имени которого идут запросы')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Адрес страницы (можно указать несколько раз). По умолчанию /dashboard/')
+        parser.add_argument('-n', '--requests', type=int, default=200, help='Запросов на каждый адрес')
+        parser.add_argument('-c', '--concurrency', type=int, default=10, help='Одновременных запросов')
+
+    def handle(self, *args, **options):
+        try:
+            self.user = get_user_model().objects.get(username=options['username'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'User {options["username"]} does not exist')
+
+        hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+        for path in options['paths'] or DEFAULT_PATHS:
+            for mode, urlconf, bench in (
+                ('wsgi', 'bonus_manager.urls', self.bench_wsgi),
+                ('asgi', 'bonus_manager.urls_async', self.bench_asgi),
+            ):
+                with override_settings(ROOT_URLCONF=urlconf, ALLOWED_HOSTS=hosts):
+                    clear_url_caches()
+                    started = time.perf_counter()
+                    latencies = bench(path, options['requests'], options['concurrency'])
+                    elapsed = time.perf_counter() - started
+                clear_url_caches()
+                self.report(mode, path, latencies, elapsed)
+
+    def _client(self, client_class):
+        client = client_class()
+        client.force_login(self.user)
+        return client
+
+    def bench_wsgi(self, path, requests, concurrency):
+        clients = [self._client(Client) for _ in range(concurrency)]
+
+        def worker(client, count):
+            latencies = []
+            for _ in range(count):
+                started = time.perf_counter()
+                response = client.get(path)
+                latencies.append(time.perf_counter() - started)
+                self.check_response(response, path)
+            return latencies
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = pool.map(worker, clients, self.split(requests, concurrency))
+        return [latency for result in results for latency in result]
+
+    def bench_asgi(self, path, requests, concurrency):
+        clients = [self._client(AsyncClient) for _ in range(concurrency)]
+
+        async def worker(client, count):
+            latencies = []
+            for _ in range(count):
+                started = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - started)
+                self.check_response(response, path)
+            return latencies
+
+        async def run():
+            return await asyncio.gather(*map(worker, clients, self.split(requests, concurrency)))
+
+        return [latency for result in asyncio.run(run()) for latency in result]
+
+    @staticmethod
+    def split(requests, concurrency):
+        return [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+
+    @staticmethod
+    def check_response(response, path):
+        if response.status_code != 200:
+            raise CommandError(f'{path} returned {response.status_code}')
+
+    def report(self, mode, path, latencies, elapsed):
+        self.stdout.write(
+            f'{mode} {path}: {len(latencies)} requests in {elapsed:.2f}s '
+            f'({len(latencies) / elapsed:.1f} req/s), '
+            f'p50 {statistics.median(latencies) * 1000:.1f} ms, '
+            f'p95 {_percentile(latencies, 95) * 1000:.1f} ms'
+        )
@@ -0,0 +1,204 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client as TestClient
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core import synthetic
+from core.models import BonusHistory, Client, Organization, User
+
+# Порядок важен: delete_client удаляет клиентов, добавленных add_client
+SCENARIOS = (
+    'dashboard', 'dashboard_cached', 'dashboard_next_page', 'search_phone', 'search_name',
+    'add_client', 'add_bonus', 'reset_balance', 'delete_client', 'history', 'history_json',
+)
+# Перед каждым запросом этих сценариев кэш дашборда очищается
+COLD_SCENARIOS = {'dashboard', 'dashboard_next_page', 'search_phone', 'search_name'}
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет ветки дашборда и историю на данных generate_data: p50/p95 времени '
+        'ответа и число SQL-запросов на запрос. Сценарии с записью меняют данные.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', help='Название организации (по умолчанию первая "Bench N")')
+        parser.add_argument('-n', '--iterations', type=int, default=50, help='Запросов на сценарий')
+        parser.add_argument('--warmup', type=int, default=3, help='Прогревочных запросов (не учитываются)')
+        parser.add_argument('--only', action='append', choices=SCENARIOS, help='Только эти сценарии')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+        parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+
+    def handle(self, *args, **options):
+        orgs = Organization.objects.order_by('id')
+        org = (orgs.filter(name=options['org']) if options['org'] else
+               orgs.filter(name__startswith=f'{synthetic.ORGANIZATION_PREFIX} ')).first()
+        if org is None:
+            raise CommandError('No benchmark organization, run manage.py generate_data first')
+        user = User.objects.filter(organization=org, is_superuser=False).order_by('id').first()
+        if user is None:
+            raise CommandError(f'Organization {org.pk} has no users')
+
+        self.org = org
+        self.rng = random.Random(options['seed'])
+        self.client_ids = list(Client.objects.filter(organization=org).values_list('id', flat=True))
+        if not self.client_ids:
+            raise CommandError(f'Organization {org.pk} has no clients')
+        self.added_phones = []
+        self.http = TestClient()
+        self.http.force_login(user)
+        self.run_tag = f'{self.rng.randrange(10000):04d}'
+
+        report = {
+            'commit': _git_commit(),
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'organization': {
+                'id': org.pk, 'clients': org.client_count,
+                'history': BonusHistory.objects.filter(client__organization=org).count(),
+            },
+            'iterations': options['iterations'],
+            'results': {},
+        }
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name in SCENARIOS:
+                if options['only'] and name not in options['only']:
+                    continue
+                report['results'][name] = self.measure(name, options['iterations'], options['warmup'])
+                self.print_result(name, report['results'][name])
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results saved to {options["output"]}'))
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                self.print_comparison(json.load(f), report)
+
+    def measure(self, name, iterations, warmup):
+        scenario = getattr(self, f'scenario_{name}')
+        latencies, queries = [], []
+        for i in range(warmup + iterations):
+            if name in COLD_SCENARIOS:
+                cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                response = scenario(i)
+                elapsed = time.perf_counter() - started
+            if response.status_code not in (200, 302):
+                raise CommandError(f'{name} returned {response.status_code}')
+            if i >= warmup:
+                latencies.append(elapsed * 1000)
+                queries.append(len(ctx.captured_queries))
+        return {
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(_percentile(latencies, 95), 2),
+            'mean_ms': round(statistics.fmean(latencies), 2),
+            'max_ms': round(max(latencies), 2),
+            'queries': statistics.median_low(queries),
+            'queries_max': max(queries),
+        }
+
+    def random_client(self):
+        return self.rng.choice(self.client_ids)
+
+    # Сценарии: один запрос на итерацию i
+
+    def scenario_dashboard(self, i):
+        return self.http.get(reverse('dashboard'))
+
+    def scenario_dashboard_cached(self, i):
+        return self.http.get(reverse('dashboard'))
+
+    def scenario_dashboard_next_page(self, i):
+        if i == 0 or not getattr(self, 'next_cursor', None):
+            response = self.http.get(reverse('dashboard'))
+        else:
+            response = self.http.get(reverse('dashboard'), {'after': self.next_cursor})
+        # Курсор берётся из ссылки «Вперёд» в ответе
+        content = response.content.decode()
+        marker = '?after='
+        start = content.find(marker)
+        self.next_cursor = content[start + len(marker):content.find('"', start)] if start >= 0 else None
+        return response
+
+    def scenario_search_phone(self, i):
+        return self.http.get(reverse('dashboard'), {'search': f'{self.rng.randrange(10000):04d}'})
+
+    def scenario_search_name(self, i):
+        return self.http.get(reverse('dashboard'), {'search': self.rng.choice(synthetic.LAST_NAMES)[:5]})
+
+    def scenario_add_client(self, i):
+        phone = f'+79{self.run_tag}{i:05d}'
+        self.added_phones.append(phone)
+        return self.http.post(reverse('dashboard'), {
+            'add_client': '1', 'name': f'Bench client {i}', 'phone': phone, 'balance': '100',
+        })
+
+    def scenario_add_bonus(self, i):
+        return self.http.post(reverse('dashboard'), {
+            'add_bonus': '1', 'client_id': self.random_client(),
+            'amount': str(self.rng.randrange(1, 1000)), 'type': self.rng.choice(['accrual', 'deduction']),
+        })
+
+    def scenario_reset_balance(self, i):
+        return self.http.post(reverse('dashboard'), {'reset_balance': '1', 'client_id': self.random_client()})
+
+    def scenario_delete_client(self, i):
+        if not hasattr(self, 'delete_ids'):
+            self.delete_ids = list(
+                Client.objects.filter(organization=self.org, phone__in=self.added_phones).values_list('id', flat=True)
+            )
+        # Без add_client удаляются сгенерированные клиенты с историей
+        client_id = self.delete_ids.pop() if self.delete_ids else self.client_ids.pop()
+        return self.http.post(reverse('dashboard'), {'delete_client': '1', 'client_id': client_id})
+
+    def scenario_history(self, i):
+        return self.http.get(reverse('history', args=[self.random_client()]))
+
+    def scenario_history_json(self, i):
+        return self.http.get(reverse('history_json', args=[self.random_client()]))
+
+    def print_result(self, name, result):
+        self.stdout.write(
+            f'{name:20} p50 {result["p50_ms"]:8.2f} ms  p95 {result["p95_ms"]:8.2f} ms  '
+            f'queries {result["queries"]} (max {result["queries_max"]})'
+        )
+
+    def print_comparison(self, baseline, report):
+        self.stdout.write(f'Compared with {baseline.get("commit") or "baseline"}:')
+        for name, result in report['results'].items():
+            old = baseline.get('results', {}).get(name)
+            if not old:
+                continue
+            change = (result['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+            self.stdout.write(
+                f'{name:20} p50 {old["p50_ms"]:8.2f} -> {result["p50_ms"]:8.2f} ms ({change:+.0f}%)  '
+                f'queries {old["queries"]} -> {result["queries"]}'
+            )
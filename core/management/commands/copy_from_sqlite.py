@@ -0,0 +1,93 @@
+import time
+from pathlib import Path
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.serializers import sort_dependencies
+from django.db import connections, transaction
+
+from core.db import explicit_timestamps
+
+SOURCE_ALIAS = 'sqlite_source'
+DEFAULT_BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит данные приложения core (организации, пользователи, клиенты, история и т.д.) '
+        'из файла SQLite в текущую БД (обычно PostgreSQL) пачками через bulk_create. '
+        'Целевая БД должна быть пустой и с применёнными миграциями; всё копируется одной '
+        'транзакцией. Сессии, группы и права пользователей не переносятся.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к исходному db.sqlite3')
+        parser.add_argument('--database', default='default', help='Целевая БД (по умолчанию default)')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        target = options['database']
+        if connections[target].vendor == 'sqlite' and str(connections[target].settings_dict['NAME']) == options['path']:
+            raise CommandError('Source and target are the same database')
+
+        # Временное соединение с исходным файлом только для чтения и без PRAGMA
+        # core/db.py (иначе файл перевёлся бы в WAL). configure_settings
+        # дополняет настройки значениями по умолчанию и требует ключ 'default'
+        connections.settings[SOURCE_ALIAS] = connections.configure_settings({
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': Path(options['path']).resolve().as_uri() + '?mode=ro',
+                'SQLITE_PRAGMAS': {},
+            },
+        })['default']
+        try:
+            models = sort_dependencies([(apps.get_app_config('core'), None)])
+            not_empty = [m._meta.label for m in models if m._default_manager.using(target).exists()]
+            if not_empty:
+                raise CommandError(f'Target database is not empty: {", ".join(not_empty)}')
+
+            # Одна транзакция: sort_dependencies не учитывает внешние ключи
+            # (BonusHistory идёт раньше BonusBatch), а отложенные ограничения
+            # проверяются при коммите, когда все таблицы уже скопированы.
+            # Прерванный перенос не оставляет частично заполненную базу.
+            with transaction.atomic(using=target):
+                for model in models:
+                    started = time.perf_counter()
+                    copied = self.copy_model(model, target, options['batch_size'])
+                    self.stdout.write(f'{model._meta.label}: {copied} rows in {time.perf_counter() - started:.1f}s')
+
+                self.reset_sequences(models, target)
+        finally:
+            connections[SOURCE_ALIAS].close()
+            del connections[SOURCE_ALIAS]
+            del connections.settings[SOURCE_ALIAS]
+        self.stdout.write(self.style.SUCCESS('Copy finished'))
+
+    def copy_model(self, model, target, batch_size):
+        manager = model._base_manager
+        rows = manager.using(SOURCE_ALIAS).order_by('pk').iterator(chunk_size=batch_size)
+        copied = 0
+        batch = []
+        # Даты создания и изменения копируются как есть
+        with explicit_timestamps(model):
+            for obj in rows:
+                obj._state.db = target
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    manager.using(target).bulk_create(batch)
+                    copied += len(batch)
+                    batch = []
+            if batch:
+                manager.using(target).bulk_create(batch)
+                copied += len(batch)
+        return copied
+
+    def reset_sequences(self, models, target):
+        # Явные id не сдвигают последовательности PostgreSQL
+        connection = connections[target]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
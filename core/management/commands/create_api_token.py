@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import api
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Создаёт токен JSON API для кассы организации и печатает ключ'
+
+    def add_arguments(self, parser):
+        parser.add_argument('org_id', type=int, help='ID организации')
+        parser.add_argument('--name', default='POS', help='Название кассы (по умолчанию POS)')
+
+    def handle(self, *args, **options):
+        try:
+            org = Organization.objects.get(id=options['org_id'])
+        except Organization.DoesNotExist:
+            raise CommandError(f'Organization {options["org_id"]} does not exist')
+
+        token, key = api.create_token(org, options['name'])
+        self.stdout.write(f'Token {token.pk} for organization {org.pk} ({token.name}):')
+        self.stdout.write(key)
+        self.stdout.write(self.style.WARNING('The key is shown only once, store it on the POS terminal now'))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import synthetic
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Создаёт синтетические организации, клиентов и историю для нагрузочных тестов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orgs', type=int, default=1, help='Сколько организаций создать')
+        parser.add_argument('--clients', type=int, default=10000, help='Клиентов в каждой организации')
+        parser.add_argument('--history', type=int, default=10,
+                            help='Среднее число записей истории на клиента')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора (данные воспроизводимы)')
+        parser.add_argument('--batch-size', type=int, default=synthetic.DEFAULT_BATCH_SIZE)
+        parser.add_argument('--clear', action='store_true', help='Сначала удалить ранее сгенерированные данные')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted = synthetic.delete_generated()
+            self.stdout.write(f'Deleted {deleted} generated objects')
+
+        first = Organization.objects.filter(name__startswith=f'{synthetic.ORGANIZATION_PREFIX} ').count()
+        for org_index in range(first, first + options['orgs']):
+            started = time.perf_counter()
+            org = synthetic.generate_organization(
+                org_index, options['clients'], options['history'],
+                seed=options['seed'], batch_size=options['batch_size'],
+            )
+            self.stdout.write(
+                f'Organization {org.pk} ({org.name}, user {synthetic.USER_PREFIX}{org_index}): '
+                f'{org.client_count} clients in {time.perf_counter() - started:.1f}s'
+            )
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import bulk
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Импортирует клиентов организации из CSV или XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('org_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--chunk-size', type=int, default=bulk.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            org = Organization.objects.get(pk=options['org_id'])
+        except Organization.DoesNotExist:
+            raise CommandError(f"Organization {options['org_id']} does not exist")
+
+        with open(options['path'], 'rb') as f:
+            try:
+                result = bulk.import_clients(org, bulk.read_rows(f, options['path']), options['chunk_size'])
+            except bulk.ImportFormatError as e:
+                raise CommandError(str(e))
+
+        for error in result.errors:
+            self.stderr.write(error)
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {result.created}, duplicates {result.duplicates}, invalid {result.invalid}'
+        ))
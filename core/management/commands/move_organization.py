@@ -0,0 +1,199 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Max, Q
+
+from core import message_templates, pagecache, shards
+from core.db import explicit_timestamps
+from core.models import (
+    BalanceSnapshot, BonusBatch, BonusHistory, BonusHistoryArchive, Client, DailyStats, IdempotencyRecord,
+    MessageTemplate, Organization, OutboundMessage, User,
+)
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит данные организации в другую базу (core/shards.py), не останавливая работу: '
+        'данные копируются на ходу, запись останавливается только на время дописывания изменений. '
+        'Прерванный перенос можно запустить снова — уже скопированное не копируется повторно.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('org_id', type=int)
+        parser.add_argument('database', help='Целевая база из TENANT_DATABASES')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--grace', type=float, default=None,
+                            help='Сколько секунд ждать, пока процессы перечитают размещение '
+                                 '(по умолчанию SHARD_PLACEMENT_TIMEOUT + 5)')
+        parser.add_argument('--keep-source', action='store_true', help='Не удалять данные в старой базе')
+
+    def handle(self, *args, **options):
+        try:
+            org = Organization.objects.using(DEFAULT_DB_ALIAS).get(pk=options['org_id'])
+        except Organization.DoesNotExist:
+            raise CommandError(f"Organization {options['org_id']} does not exist")
+        source, target = org.database, options['database']
+        if target not in shards.databases():
+            raise CommandError(f'Unknown database {target!r}, expected one of: {", ".join(shards.databases())}')
+        if source == target:
+            raise CommandError(f'Organization {org.pk} is already in {target}')
+        if org.move_state:
+            self.stdout.write(self.style.WARNING(f'Organization {org.pk}: resuming interrupted move'))
+        self.chunk_size = options['chunk_size']
+        grace = options['grace']
+        if grace is None:
+            grace = shards.placement_timeout() + 5
+        tables = self.tables(org)
+
+        try:
+            # Архивация останавливается, запись продолжается в старую базу
+            shards.set_placement(org.pk, source, Organization.MOVE_COPYING)
+            marks = {
+                model: self.last_pk(model, condition, source) for model, condition, immutable in tables if immutable
+            }
+            self.wait(grace, 'archiving stops')
+            self.copy(org, tables, source, target)
+
+            shards.set_placement(org.pk, source, Organization.MOVE_FROZEN)
+            self.wait(grace, 'writes stop')
+            started = time.perf_counter()
+            self.copy(org, tables, source, target, marks)
+            counters = Organization.objects.using(source).values(
+                'client_count', 'total_balance', 'data_version',
+            ).get(pk=org.pk)
+            Organization.objects.using(target).filter(pk=org.pk).update(**counters)
+            shards.set_placement(org.pk, target)
+        except Exception:
+            # Запись продолжается в старой базе, скопированное будет досинхронизировано при повторе
+            shards.set_placement(org.pk, source)
+            raise
+        self.stdout.write(f'Organization {org.pk}: switched to {target}, writes stopped for '
+                          f'{time.perf_counter() - started:.1f}s')
+        pagecache.bump(org.pk)
+        for user_id in User.objects.filter(organization=org).values_list('id', flat=True):
+            message_templates.invalidate(user_id)
+
+        if not options['keep_source']:
+            # Процессы со старым размещением ещё могут читать из старой базы
+            self.wait(grace, 'reads from the old database stop')
+            self.delete(org, tables, source)
+        self.stdout.write(self.style.SUCCESS(f'Organization {org.pk} moved from {source} to {target}'))
+
+    def tables(self, org):
+        """(модель, условие отбора строк организации, строки не меняются) в порядке зависимостей."""
+        users = list(User.objects.filter(organization=org).values_list('id', flat=True))
+        return [
+            (Client, Q(organization_id=org.pk), False),
+            (BonusBatch, Q(organization_id=org.pk), False),
+            (BonusHistory, Q(client__organization_id=org.pk), True),
+            (BonusHistoryArchive, Q(client__organization_id=org.pk), True),
+            (BalanceSnapshot, Q(client__organization_id=org.pk), False),
+            (DailyStats, Q(organization_id=org.pk), False),
+            (MessageTemplate, Q(user_id__in=users), False),
+            (OutboundMessage, Q(organization_id=org.pk), False),
+            (IdempotencyRecord, Q(organization_id=org.pk), True),
+        ]
+
+    def wait(self, grace, reason):
+        self.stdout.write(f'Waiting {grace:g}s until {reason}')
+        time.sleep(grace)
+
+    @staticmethod
+    def last_pk(model, condition, database):
+        return model._base_manager.using(database).filter(condition).aggregate(last=Max('pk'))['last']
+
+    def copy(self, org, tables, source, target, marks=None):
+        """
+        Первый проход (``marks`` нет): неизменяемые таблицы копируются после
+        последней уже скопированной строки, остальные сверяются целиком.
+        Второй проход при остановленной записи: неизменяемые таблицы сверяются
+        после отметок, снятых до первого прохода.
+        """
+        if target != DEFAULT_DB_ALIAS:
+            Organization.objects.using(target).update_or_create(
+                pk=org.pk, defaults={'name': org.name, 'database': target},
+            )
+        for model, condition, immutable in tables:
+            started = time.perf_counter()
+            if not immutable:
+                after = None
+            elif marks is None:
+                after = self.last_pk(model, condition, target)
+            else:
+                after = marks[model]
+            try:
+                copied, updated, deleted = self.sync(model, condition, source, target, after, compare=not immutable)
+            except IntegrityError as e:
+                raise CommandError(
+                    f'{model._meta.label}: id conflict in {target} ({e}); '
+                    f'run "manage.py migrate --database {target}" to reserve its id range'
+                )
+            self.stdout.write(
+                f'{model._meta.label}: copied {copied}, updated {updated}, deleted {deleted} '
+                f'in {time.perf_counter() - started:.1f}s'
+            )
+
+    def sync(self, model, condition, source, target, after, compare):
+        """
+        Приводит строки организации в ``target`` с ключом больше ``after`` к
+        ``source`` пачками по ключу: добавляет недостающие, удаляет лишние, при
+        ``compare`` обновляет изменившиеся. Возвращает (добавлено, обновлено, удалено).
+        """
+        manager = model._base_manager
+        fields = [field.attname for field in model._meta.concrete_fields]
+        key = model._meta.pk.attname
+        columns = fields if compare else [key]
+        copied = updated = deleted = 0
+        last = after
+        while True:
+            rows = manager.using(source).filter(condition)
+            existing = manager.using(target).filter(condition)
+            if last is not None:
+                rows = rows.filter(pk__gt=last)
+                existing = existing.filter(pk__gt=last)
+            chunk = list(rows.order_by('pk').values(*columns)[:self.chunk_size])
+            if chunk:
+                existing = existing.filter(pk__lte=chunk[-1][key])
+            existing = {row[key]: row for row in existing.values(*columns)}
+            present = {row[key] for row in chunk}
+
+            with transaction.atomic(using=target), explicit_timestamps(model):
+                stale = [pk for pk in existing if pk not in present]
+                if stale:
+                    deleted += manager.using(target).filter(pk__in=stale).delete()[1].get(model._meta.label, 0)
+                missing = [pk for pk in present if pk not in existing]
+                if missing:
+                    if compare:
+                        new = [row for row in chunk if row[key] in missing]
+                    else:
+                        new = manager.using(source).filter(pk__in=missing).values(*fields)
+                    manager.using(target).bulk_create([model(**row) for row in new])
+                    copied += len(missing)
+                if compare:
+                    changed = [
+                        model(**row) for row in chunk if row[key] in existing and existing[row[key]] != row
+                    ]
+                    if changed:
+                        manager.using(target).bulk_update(changed, [name for name in fields if name != key])
+                        updated += len(changed)
+            if not chunk:
+                return copied, updated, deleted
+            last = chunk[-1][key]
+
+    def delete(self, org, tables, source):
+        """Удаляет данные организации в старой базе пачками, от зависимых таблиц к клиентам."""
+        for model, condition, _ in reversed(tables):
+            manager = model._base_manager
+            deleted = 0
+            while True:
+                pks = list(manager.using(source).filter(condition).values_list('pk', flat=True)[:self.chunk_size])
+                if not pks:
+                    break
+                manager.using(source).filter(pk__in=pks).delete()
+                deleted += len(pks)
+            self.stdout.write(f'{model._meta.label}: {deleted} rows deleted from {source}')
+        if source != DEFAULT_DB_ALIAS:
+            Organization.objects.using(source).filter(pk=org.pk).delete()
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core import shards
+from core.models import IdempotencyRecord
+
+
+class Command(BaseCommand):
+    help = 'Удаляет сохранённые ответы API для старых ключей Idempotency-Key'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Хранить ответы N дней (по умолчанию 7)')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted = sum(
+            IdempotencyRecord.objects.using(database).filter(created_at__lt=cutoff).delete()[0]
+            for database in shards.databases()
+        )
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} idempotency records'))
@@ -0,0 +1,39 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет просроченные сессии короткими пачками, чтобы не держать блокировку '
+        'записи в БД, куда пишут кассы (в отличие от одного DELETE в clearsessions).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза в секундах между пачками')
+
+    def handle(self, *args, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(store, 'get_model_class'):
+            # Сессии в подписанных cookie: в БД удалять нечего
+            self.stdout.write(f'{settings.SESSION_ENGINE} keeps no sessions in the database')
+            return
+
+        # Копии в кэше (cached_db) истекают сами вместе с сессией
+        sessions = store.get_model_class().objects.filter(expire_date__lt=timezone.now())
+        deleted = 0
+        while True:
+            keys = list(sessions.values_list('session_key', flat=True)[:options['batch_size']])
+            if not keys:
+                break
+            deleted += store.get_model_class().objects.filter(session_key__in=keys).delete()[0]
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired sessions'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core import rollups
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневные итоги (DailyStats) по истории бонусов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, action='append', dest='org_ids',
+                            help='ID организации (можно указать несколько раз). По умолчанию — все.')
+
+    def handle(self, *args, **options):
+        org_ids = options['org_ids'] or list(Organization.objects.values_list('id', flat=True))
+        for org_id in org_ids:
+            count = rollups.rebuild([org_id])
+            self.stdout.write(f'Organization {org_id}: {count} days')
+        self.stdout.write(self.style.SUCCESS('Rollups rebuilt'))
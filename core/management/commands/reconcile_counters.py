@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from core import counters
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Сверяет счётчики организаций (клиенты, сумма балансов) с таблицей клиентов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, action='append', dest='org_ids',
+                            help='ID организации (можно указать несколько раз). По умолчанию — все.')
+        parser.add_argument('--fix', action='store_true', help='Исправить найденные расхождения')
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.order_by('id')
+        if options['org_ids']:
+            organizations = organizations.filter(id__in=options['org_ids'])
+
+        mismatched = 0
+        for org in organizations.iterator():
+            mismatches = counters.reconcile(org, fix=options['fix'])
+            if not mismatches:
+                continue
+            mismatched += 1
+            for field, (stored, actual) in mismatches.items():
+                self.stdout.write(f'Organization {org.pk}: {field} stored={stored} actual={actual}')
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS('All counters match'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {mismatched} organizations'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{mismatched} organizations mismatched, run with --fix'))
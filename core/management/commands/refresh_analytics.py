@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import analytics, shards
+from core.models import Organization
+
+
+class Command(BaseCommand):
+    help = (
+        'Дочитывает новые записи истории в кэш аналитики организаций '
+        '(запускайте по расписанию, чтобы страница аналитики открывалась сразу). '
+        'С --full пересчитывает с нуля.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, action='append', dest='org_ids',
+                            help='ID организации (можно указать несколько раз). По умолчанию — все.')
+        parser.add_argument('--full', action='store_true', help='Пересчитать всю историю заново')
+        parser.add_argument('--chunk-size', type=int, default=analytics.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.order_by('id')
+        if options['org_ids']:
+            organizations = organizations.filter(id__in=options['org_ids'])
+        for org in organizations.iterator():
+            started = time.perf_counter()
+            try:
+                with shards.use(org.pk):
+                    state = analytics.refresh(org.pk, full=options['full'], chunk_size=options['chunk_size'])
+            except analytics.AnalyticsUnavailable as e:
+                raise CommandError(str(e))
+            self.stdout.write(
+                f'Organization {org.pk}: {len(state.client_ids)} clients, last history id {state.last_id}, '
+                f'{time.perf_counter() - started:.2f}s'
+            )
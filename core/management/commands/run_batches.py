@@ -0,0 +1,62 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from core import batches, shards
+from core.models import BonusBatch
+
+
+class Command(BaseCommand):
+    help = (
+        'Выполняет массовые проводки из очереди (их ставит дашборд и run_rules) и доводит до конца '
+        'прерванные на середине. С --loop работает постоянно как фоновый обработчик.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-minutes', type=int, default=10,
+                            help='Через сколько минут без прогресса проводка считается прерванной')
+        parser.add_argument('--chunk-size', type=int, default=batches.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--loop', action='store_true',
+                            help='Не завершаться, проверять очередь каждые --interval секунд')
+        parser.add_argument('--interval', type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                stale = timezone.now() - timedelta(minutes=options['stale_minutes'])
+                done = sum(self.run_pending(database, stale, options) for database in shards.databases())
+                if not options['loop']:
+                    break
+                if not done:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+    def run_pending(self, database, stale, options):
+        """Выполняет проводки очереди в базе ``database``, возвращает их число."""
+        done = 0
+        pending = BonusBatch.objects.using(database).filter(
+            Q(status=BonusBatch.STATUS_PENDING)
+            | Q(status=BonusBatch.STATUS_RUNNING, updated_at__lt=stale)
+        ).order_by('created_at')
+        for batch in pending:
+            # Прерванную проводку возвращаем в очередь и забираем заново
+            if not batches.requeue_stale(batch, stale) or not batches.claim(batch):
+                continue
+            try:
+                batches.run(
+                    batch, options['chunk_size'],
+                    progress=lambda b: self.stdout.write(f'{b.id}: {b.processed}/{b.total}, skipped {b.skipped}'),
+                )
+            except shards.OrganizationMoving as e:
+                # Проводка останется в running и вернётся в очередь через --stale-minutes
+                self.stdout.write(self.style.WARNING(f'{batch.id}: {e}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'{batch.id}: done, {batch.processed}/{batch.total}, skipped {batch.skipped}'
+            ))
+            done += 1
+        return done
@@ -0,0 +1,65 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from core import rules
+
+
+class Command(BaseCommand):
+    help = (
+        'Ночной прогон правил бонусов: сгорание по FIFO, дни рождения, начисления по '
+        'расписанию. Организации обрабатываются параллельно в --workers процессах; '
+        'прерванный прогон за ту же дату продолжает с места остановки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Дата прогона YYYY-MM-DD (по умолчанию сегодня)')
+        parser.add_argument('--org', type=int, action='append', dest='org_ids',
+                            help='ID организации (можно указать несколько раз). По умолчанию — все с правилами.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Число процессов (PostgreSQL). На SQLite организации идут по очереди')
+        parser.add_argument('--chunk-size', type=int, default=rules.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--stale-minutes', type=int, default=rules.DEFAULT_STALE_MINUTES,
+                            help='Через сколько минут без прогресса проводка правила считается прерванной')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--date must be in YYYY-MM-DD format')
+        else:
+            day = timezone.localdate()
+
+        org_ids = rules.organizations_with_rules()
+        if options['org_ids']:
+            org_ids = [org_id for org_id in org_ids if org_id in options['org_ids']]
+        args = (org_ids, repeat(day), repeat(options['chunk_size']), repeat(options['stale_minutes']))
+
+        workers = options['workers']
+        if workers > 1 and connections['default'].vendor == 'sqlite':
+            # Писатель в SQLite один, а параллельные транзакции падают с «database is locked»
+            self.stdout.write(self.style.WARNING('SQLite allows a single writer, running organizations sequentially'))
+            workers = 1
+
+        if workers > 1 and len(org_ids) > 1:
+            # Дочерние процессы не должны унаследовать открытые соединения с БД
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+            ) as pool:
+                results = pool.map(rules.run_organization, *args)
+                self.report(org_ids, results)
+        else:
+            self.report(org_ids, map(rules.run_organization, *args))
+        self.stdout.write(self.style.SUCCESS(f'Rules for {day} done: {len(org_ids)} organizations'))
+
+    def report(self, org_ids, results):
+        for org_id, organization_results in zip(org_ids, results):
+            for rule_id, kind, status, processed, total in organization_results:
+                self.stdout.write(f'Organization {org_id}, rule {rule_id} ({kind}): {status}, {processed}/{total}')
@@ -0,0 +1,50 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import notifications, shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Отправляет уведомления клиентам из очереди пачками. Без --loop разбирает '
+        'созревшие сообщения и завершается (для cron), с --loop работает как воркер.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=notifications.DEFAULT_BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help='Не завершаться, ждать новые сообщения')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Пауза в секундах, когда очередь пуста (для --loop)')
+
+    def handle(self, *args, **options):
+        transport = notifications.get_transport()
+        limiter = notifications.RateLimiter(
+            getattr(settings, 'NOTIFICATION_RATE_PER_SECOND', notifications.DEFAULT_RATE_PER_SECOND)
+        )
+        total_sent = total_failed = 0
+        try:
+            while True:
+                sent = failed = 0
+                # Очередь сообщений своя в каждой базе организаций (core/shards.py)
+                for database in shards.databases():
+                    with shards.use(database=database):
+                        requeued = notifications.requeue_stale()
+                        if requeued:
+                            self.stdout.write(self.style.WARNING(
+                                f'{database}: {requeued} stale messages returned to the queue'
+                            ))
+                        database_sent, database_failed = notifications.dispatch(transport, options['batch_size'], limiter)
+                    sent += database_sent
+                    failed += database_failed
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Sent {total_sent}, failed {total_failed}'))
@@ -0,0 +1,68 @@
+"""
+Кэш шаблонов сообщений клиентам.
+
+``MessageTemplate`` пользователя читается из кэша Django (сбрасывается при
+сохранении ``TemplateForm``), а текст шаблона один раз разбирается на части
+и дальше подставляет значения за один проход, без цепочки ``.replace()``.
+"""
+import re
+from functools import lru_cache
+
+from django.core.cache import cache
+
+from . import shards
+from .models import MessageTemplate
+
+PLACEHOLDERS = {
+    '[имя]': 'name',
+    '[сумма]': 'amount',
+    '[баланс]': 'balance',
+}
+_PLACEHOLDER_RE = re.compile('|'.join(re.escape(p) for p in PLACEHOLDERS))
+
+CACHE_TIMEOUT = 60 * 60
+
+
+class CompiledTemplate:
+    """Шаблон, разобранный на литералы и имена подстановок."""
+
+    def __init__(self, text):
+        self.parts = []
+        position = 0
+        for match in _PLACEHOLDER_RE.finditer(text):
+            if match.start() > position:
+                self.parts.append((False, text[position:match.start()]))
+            self.parts.append((True, PLACEHOLDERS[match.group()]))
+            position = match.end()
+        if position < len(text):
+            self.parts.append((False, text[position:]))
+
+    def render(self, **values):
+        return ''.join(str(values.get(part, '')) if is_field else part for is_field, part in self.parts)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(text):
+    return CompiledTemplate(text)
+
+
+def render(text, **values):
+    return compile_template(text).render(**values)
+
+
+def _cache_key(user_id):
+    return f'message_template:{user_id}'
+
+
+def get_for_user(user):
+    template = cache.get(_cache_key(user.pk))
+    if template is None:
+        # Шаблон лежит в базе организации пользователя, см. core/shards.py
+        with shards.use(user.organization_id):
+            template, _ = MessageTemplate.objects.get_or_create(user=user)
+        cache.set(_cache_key(user.pk), template, CACHE_TIMEOUT)
+    return template
+
+
+def invalidate(user_id):
+    cache.delete(_cache_key(user_id))
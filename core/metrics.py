@@ -0,0 +1,270 @@
+"""
+Метрики запросов: число SQL-запросов, время в БД, время рендеринга шаблонов и
+общее время ответа по имени маршрута.
+
+Замеряется доля запросов ``settings.METRICS_SAMPLE_RATE`` (0 — выключено,
+тогда middleware не подключается вовсе). Состояние текущего запроса лежит в
+``ContextVar``, поэтому замеры работают и для асинхронных представлений:
+asgiref переносит контекст в потоки ``sync_to_async``.
+
+* SQL — обёртка ``connection.execute_wrapper`` на каждом соединении;
+* шаблоны — бэкенд ``TimedDjangoTemplates`` (settings.TEMPLATES);
+* итоги копятся в памяти процесса и отдаются в формате Prometheus по адресу
+  ``/metrics/`` только по заголовку ``Authorization: Bearer <METRICS_TOKEN>``
+  или с адресов ``METRICS_ALLOWED_IPS``. Оба параметра по умолчанию пусты, и
+  адрес закрыт: за обратным прокси REMOTE_ADDR у всех запросов — адрес прокси.
+  При нескольких воркерах каждый отдаёт свои цифры.
+
+Если запрос сделал больше ``METRICS_QUERY_WARNING_THRESHOLD`` SQL-запросов,
+в лог пишется предупреждение о возможном N+1 с самым частым запросом.
+"""
+import hmac
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+from . import balances
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_WARNING_THRESHOLD = 20
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'db_time', 'template_time', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.statements = Counter()
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.requests = Counter()  # по коду ответа
+        self.duration = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+
+
+_lock = threading.Lock()
+_views = defaultdict(ViewMetrics)
+
+
+def sample_rate():
+    return getattr(settings, 'METRICS_SAMPLE_RATE', 0)
+
+
+def reset():
+    with _lock:
+        _views.clear()
+
+
+def record_query(execute, sql, params, many, context):
+    """Обёртка execute: считает запросы и время в БД для замеряемого запроса."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_time += time.perf_counter() - started
+        stats.queries += 1
+        stats.statements[sql] += 1
+
+
+def install(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        if stats is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Бэкенд шаблонов Django, замеряющий время рендеринга для метрик."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def _start():
+    if random.random() >= sample_rate():
+        return None, None
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def _finish(stats, token, request, response):
+    duration = time.perf_counter() - stats.started
+    _current.reset(token)
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unmatched'
+    status = response.status_code if response is not None else 500
+
+    with _lock:
+        metrics = _views[view]
+        metrics.requests[status] += 1
+        metrics.duration += duration
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                metrics.buckets[i] += 1
+        metrics.queries += stats.queries
+        metrics.db_time += stats.db_time
+        metrics.template_time += stats.template_time
+
+    threshold = getattr(settings, 'METRICS_QUERY_WARNING_THRESHOLD', DEFAULT_QUERY_WARNING_THRESHOLD)
+    if stats.queries > threshold:
+        sql, repeated = stats.statements.most_common(1)[0]
+        logger.warning(
+            "Possible N+1 in %s: %d queries (%.1f ms in DB), most repeated %d times: %s",
+            view, stats.queries, stats.db_time * 1000, repeated, sql[:300],
+        )
+
+
+class RequestMetricsMiddleware:
+    """Ставится первым в MIDDLEWARE, чтобы учесть запросы сессии и авторизации."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not sample_rate():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        connection_created.connect(install)
+        for connection in connections.all(initialized_only=True):
+            install(connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token = _start()
+        if stats is None:
+            return self.get_response(request)
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            _finish(stats, token, request, response)
+
+    async def __acall__(self, request):
+        stats, token = _start()
+        if stats is None:
+            return await self.get_response(request)
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            _finish(stats, token, request, response)
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def render_prometheus():
+    with _lock:
+        snapshot = {
+            view: (dict(m.requests), m.duration, list(m.buckets), m.queries, m.db_time, m.template_time)
+            for view, m in _views.items()
+        }
+
+    lines = [
+        '# HELP bonus_metrics_sample_rate Share of requests that are measured.',
+        '# TYPE bonus_metrics_sample_rate gauge',
+        f'bonus_metrics_sample_rate {sample_rate()}',
+        '# HELP bonus_http_requests_total Measured requests by view and status.',
+        '# TYPE bonus_http_requests_total counter',
+    ]
+    for view, (requests, *_) in sorted(snapshot.items()):
+        for status, count in sorted(requests.items()):
+            lines.append(f'bonus_http_requests_total{{{_labels(view=view, status=status)}}} {count}')
+
+    lines += [
+        '# HELP bonus_http_request_duration_seconds Request latency by view.',
+        '# TYPE bonus_http_request_duration_seconds histogram',
+    ]
+    for view, (requests, duration, buckets, *_) in sorted(snapshot.items()):
+        total = sum(requests.values())
+        for bound, count in zip(DURATION_BUCKETS, buckets):
+            lines.append(f'bonus_http_request_duration_seconds_bucket{{{_labels(view=view, le=bound)}}} {count}')
+        lines.append(f'bonus_http_request_duration_seconds_bucket{{{_labels(view=view, le="+Inf")}}} {total}')
+        lines.append(f'bonus_http_request_duration_seconds_sum{{{_labels(view=view)}}} {duration:.6f}')
+        lines.append(f'bonus_http_request_duration_seconds_count{{{_labels(view=view)}}} {total}')
+
+    for name, index, help_text in (
+        ('bonus_http_request_db_queries_total', 3, 'SQL queries made by measured requests.'),
+        ('bonus_http_request_db_seconds_total', 4, 'Time spent in the database by measured requests.'),
+        ('bonus_http_request_template_seconds_total', 5, 'Time spent rendering templates by measured requests.'),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view, values in sorted(snapshot.items()):
+            value = values[index]
+            lines.append(f'{name}{{{_labels(view=view)}}} {value if index == 3 else round(value, 6)}')
+
+    hits, misses, entries = balances.stats()
+    lines += [
+        '# HELP bonus_balance_cache_lookups_total Balance lookups by cache result.',
+        '# TYPE bonus_balance_cache_lookups_total counter',
+        f'bonus_balance_cache_lookups_total{{{_labels(result="hit")}}} {hits}',
+        f'bonus_balance_cache_lookups_total{{{_labels(result="miss")}}} {misses}',
+        '# HELP bonus_balance_cache_entries Entries in the balance lookup cache.',
+        '# TYPE bonus_balance_cache_entries gauge',
+        f'bonus_balance_cache_entries {entries}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_allowed(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        scheme, _, given = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(given.strip().encode(), token.encode()):
+            return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+
+
+def metrics_view(request):
+    if not _metrics_allowed(request):
+        raise Http404
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
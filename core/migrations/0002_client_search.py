@@ -0,0 +1,61 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+from core.normalize import phone_digits, search_name
+
+
+def fill_search_fields(apps, schema_editor):
+    Client = apps.get_model('core', 'Client')
+    # Все запросы — в мигрируемую базу, а не в default
+    clients = Client.objects.using(schema_editor.connection.alias)
+    fields = ['phone_digits', 'phone_digits_reversed', 'name_search']
+    batch = []
+    for client in clients.only('id', 'name', 'phone').iterator():
+        client.phone_digits = phone_digits(client.phone)
+        client.phone_digits_reversed = client.phone_digits[::-1]
+        client.name_search = search_name(client.name)
+        batch.append(client)
+        if len(batch) >= 1000:
+            clients.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        clients.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='name_search',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='phone_digits',
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='phone_digits_reversed',
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_search_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['organization', 'phone_digits'], name='client_org_phone_digits_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['organization', 'phone_digits_reversed'], name='client_org_phone_suffix_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['organization', 'name_search'], name='client_org_name_search_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_client_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('accrued', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('spent', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('operations', models.PositiveIntegerField(default=0)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='core.organization')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailystats',
+            constraint=models.UniqueConstraint(fields=('organization', 'day'), name='daily_stats_org_day_uniq'),
+        ),
+    ]
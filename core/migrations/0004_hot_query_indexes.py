@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:15
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_phones(apps, schema_editor):
+    Client = apps.get_model('core', 'Client')
+    duplicates = list(
+        Client.objects.using(schema_editor.connection.alias)
+        .values('organization_id', 'phone')
+        .annotate(n=Count('id'))
+        .filter(n__gt=1)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            'Duplicate client phones must be merged before adding client_org_phone_uniq: '
+            + ', '.join(f"org {d['organization_id']} phone {d['phone']} x{d['n']}" for d in duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_daily_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bonushistory',
+            index=models.Index(fields=['client', '-date'], name='history_client_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['organization', 'name', 'id'], name='client_org_name_id_idx'),
+        ),
+        migrations.RunPython(check_duplicate_phones, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='client',
+            constraint=models.UniqueConstraint(fields=('organization', 'phone'), name='client_org_phone_uniq'),
+        ),
+    ]
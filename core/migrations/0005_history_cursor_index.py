@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='bonushistory',
+            name='history_client_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='bonushistory',
+            index=models.Index(fields=['client', '-date', '-id'], name='history_client_date_id_idx'),
+        ),
+    ]
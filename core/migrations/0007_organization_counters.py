@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:21
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_counters(apps, schema_editor):
+    Organization = apps.get_model('core', 'Organization')
+    Client = apps.get_model('core', 'Client')
+    db = schema_editor.connection.alias
+    totals = Client.objects.using(db).values('organization_id').annotate(count=Count('id'), total=Sum('balance'))
+    for row in totals:
+        Organization.objects.using(db).filter(id=row['organization_id']).update(
+            client_count=row['count'], total_balance=row['total'] or 0
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_bonus_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='client_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='total_balance',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
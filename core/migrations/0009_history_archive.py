@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_api_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('last_entry_id', models.BigIntegerField()),
+                ('last_entry_date', models.DateTimeField()),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='core.client')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BonusHistoryArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('description', models.CharField(max_length=255)),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('batch_id', models.UUIDField(blank=True, null=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_history', to='core.client')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['client', '-date', '-id'], name='archive_client_date_id_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='balancesnapshot',
+            constraint=models.UniqueConstraint(fields=('client', 'as_of'), name='snapshot_client_as_of_uniq'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_outbound_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='birthday',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='BonusRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expiration', 'Сгорание бонусов через N дней'), ('birthday', 'Начисление в день рождения'), ('recurring', 'Начисление всем клиентам раз в N дней')], max_length=20)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('days', models.PositiveIntegerField(blank=True, null=True)),
+                ('start_date', models.DateField(blank=True, help_text='Первый день начислений по расписанию', null=True)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bonus_rules', to='core.organization')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_bonus_rules'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bonushistory',
+            index=models.Index(fields=['date', 'id'], name='history_date_id_idx'),
+        ),
+    ]
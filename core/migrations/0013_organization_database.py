@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:56
+
+import core.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_history_date_index'),
+    ]
+
+    operations = [
+        # Существующие организации остаются в default, новые получают NEW_ORGANIZATION_DATABASE
+        migrations.AddField(
+            model_name='organization',
+            name='database',
+            field=models.CharField(default='default', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='database',
+            field=models.CharField(default=core.models.default_database, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='move_state',
+            field=models.CharField(blank=True, choices=[('', 'Нет'), ('copying', 'Копирование'), ('frozen', 'Запись остановлена')], default='', editable=False, max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='bonusbatch',
+            name='created_by',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='messagetemplate',
+            name='user',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
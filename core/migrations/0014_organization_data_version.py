@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:16
+
+from django.db import migrations, models
+import time
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_organization_database'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='data_version',
+            field=models.BigIntegerField(default=time.time_ns, editable=False),
+        ),
+    ]
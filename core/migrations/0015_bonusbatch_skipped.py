@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_organization_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bonusbatch',
+            name='skipped',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
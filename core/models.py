@@ -1,8 +1,32 @@
+import time
+import uuid
+
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from .normalize import phone_digits, search_name
+
+def default_database():
+    return getattr(settings, 'NEW_ORGANIZATION_DATABASE', 'default')
 
 class Organization(models.Model):
+    MOVE_COPYING = 'copying'
+    MOVE_FROZEN = 'frozen'
+    MOVE_STATE_CHOICES = [
+        ('', 'Нет'),
+        (MOVE_COPYING, 'Копирование'),
+        (MOVE_FROZEN, 'Запись остановлена'),
+    ]
+
     name = models.CharField(max_length=255)
+    # Денормализованные счётчики, обновляются в транзакциях core/counters.py
+    client_count = models.IntegerField(default=0, editable=False)
+    total_balance = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)
+    # Версия данных для кэша дашборда и балансов, см. core/pagecache.py
+    data_version = models.BigIntegerField(default=time.time_ns, editable=False)
+    # База с клиентами и историей организации и перенос в другую, см. core/shards.py
+    database = models.CharField(max_length=100, default=default_database)
+    move_state = models.CharField(max_length=10, choices=MOVE_STATE_CHOICES, blank=True, default='', editable=False)
     def __str__(self):
         return self.name
 
@@ -14,18 +38,222 @@ class Client(models.Model):
     name = models.CharField(max_length=255)
     phone = models.CharField(max_length=20)
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Для правил «бонус ко дню рождения», см. core/rules.py
+    birthday = models.DateField(null=True, blank=True)
+    # Поисковые колонки, заполняются в save() (см. core/search.py)
+    phone_digits = models.CharField(max_length=20, blank=True, editable=False)
+    phone_digits_reversed = models.CharField(max_length=20, blank=True, editable=False)
+    name_search = models.CharField(max_length=255, blank=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'phone'], name='client_org_phone_uniq'),
+        ]
+        indexes = [
+            # Постраничный вывод на дашборде: WHERE organization ORDER BY name, id
+            models.Index(fields=['organization', 'name', 'id'], name='client_org_name_id_idx'),
+            models.Index(fields=['organization', 'phone_digits'], name='client_org_phone_digits_idx'),
+            models.Index(fields=['organization', 'phone_digits_reversed'], name='client_org_phone_suffix_idx'),
+            models.Index(fields=['organization', 'name_search'], name='client_org_name_search_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    def fill_search_fields(self):
+        self.phone_digits = phone_digits(self.phone)
+        self.phone_digits_reversed = self.phone_digits[::-1]
+        self.name_search = search_name(self.name)
+
+    def save(self, *args, **kwargs):
+        self.fill_search_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'phone' in update_fields:
+                update_fields |= {'phone_digits', 'phone_digits_reversed'}
+            if 'name' in update_fields:
+                update_fields.add('name_search')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
 class BonusHistory(models.Model):
     client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='history')
     date = models.DateTimeField(auto_now_add=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.CharField(max_length=255)
     balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    batch = models.ForeignKey('BonusBatch', null=True, blank=True, on_delete=models.SET_NULL, related_name='entries')
+
+    class Meta:
+        indexes = [
+            # История клиента: WHERE client ORDER BY date DESC, id DESC
+            models.Index(fields=['client', '-date', '-id'], name='history_client_date_id_idx'),
+            # Админка (date_hierarchy, сортировка по дате) и отбор в архив по дате
+            models.Index(fields=['date', 'id'], name='history_date_id_idx'),
+        ]
+
+class BonusBatch(models.Model):
+    """Массовая проводка; id передаётся клиентом и делает повтор запроса безопасным."""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Завершена'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='bonus_batches')
+    # Пользователи живут в базе default, проводка — в базе организации
+    created_by = models.ForeignKey('User', null=True, blank=True, on_delete=models.SET_NULL, db_constraint=False)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    description = models.CharField(max_length=255)
+    # Какие клиенты попадают в проводку, см. core/batches.py
+    selection = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    # Клиенты, у которых баланс меньше списания, см. core.ledger.post_many
+    skipped = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BonusRule(models.Model):
+    """Правило организации для ночного прогона ``manage.py run_rules`` (core/rules.py)."""
+    KIND_EXPIRATION = 'expiration'
+    KIND_BIRTHDAY = 'birthday'
+    KIND_RECURRING = 'recurring'
+    KIND_CHOICES = [
+        (KIND_EXPIRATION, 'Сгорание бонусов через N дней'),
+        (KIND_BIRTHDAY, 'Начисление в день рождения'),
+        (KIND_RECURRING, 'Начисление всем клиентам раз в N дней'),
+    ]
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='bonus_rules')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Сумма начисления; для сгорания не используется
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # Срок жизни начислений (сгорание) или интервал (начисление по расписанию)
+    days = models.PositiveIntegerField(null=True, blank=True)
+    start_date = models.DateField(null=True, blank=True, help_text='Первый день начислений по расписанию')
+    description = models.CharField(max_length=255, blank=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} ({self.organization})'
+
 
 class MessageTemplate(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Шаблон хранится в базе организации пользователя, см. core/shards.py
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False)
     accrual_template = models.TextField(default="Здравствуйте, [имя]! Вам начислено [сумма] бонусов. Текущий баланс: [баланс].")
     deduction_template = models.TextField(default="Здравствуйте, [имя]! С вашего счета списано [сумма] бонусов. Текущий баланс: [баланс].")
-    reset_template = models.TextField(default="Здравствуйте, [имя]! Ваш баланс обнулён. Текущий баланс: 0.")
\ No newline at end of file
+    reset_template = models.TextField(default="Здравствуйте, [имя]! Ваш баланс обнулён. Текущий баланс: 0.")
+
+class DailyStats(models.Model):
+    """Дневные итоги по организации, обновляются при каждой проводке (core/rollups.py)."""
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    accrued = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    spent = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    operations = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'day'], name='daily_stats_org_day_uniq'),
+        ]
+
+class ApiToken(models.Model):
+    """Токен кассы (POS) для JSON API, см. core/api.py. Сам ключ не хранится, только его SHA-256."""
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='api_tokens')
+    name = models.CharField(max_length=100)
+    key_hash = models.CharField(max_length=64, unique=True, editable=False)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.organization}: {self.name}'
+
+class IdempotencyRecord(models.Model):
+    """Сохранённый ответ API на запрос с заголовком Idempotency-Key."""
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    # SHA-256 тела запроса: тот же ключ с другим телом — ошибка клиента
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'key'], name='idempotency_org_key_uniq'),
+        ]
+
+class BonusHistoryArchive(models.Model):
+    """
+    Записи BonusHistory старше горизонта хранения, перенесённые
+    ``manage.py archive_history`` (core/archive.py). id сохраняются.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='archived_history')
+    date = models.DateTimeField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    description = models.CharField(max_length=255)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    # Без внешнего ключа: проводки живут меньше истории
+    batch_id = models.UUIDField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['client', '-date', '-id'], name='archive_client_date_id_idx'),
+        ]
+
+class BalanceSnapshot(models.Model):
+    """Баланс клиента после последней заархивированной записи, по одной строке на прогон архивации."""
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='balance_snapshots')
+    as_of = models.DateField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+    last_entry_id = models.BigIntegerField()
+    last_entry_date = models.DateTimeField()
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['client', 'as_of'], name='snapshot_client_as_of_uniq'),
+        ]
+
+
+class OutboundMessage(models.Model):
+    """Исходящее уведомление клиенту; очередь разбирает manage.py send_notifications (core/notifications.py)."""
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает'),
+        (STATUS_SENDING, 'Отправляется'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='outbound_messages')
+    client = models.ForeignKey(Client, null=True, blank=True, on_delete=models.SET_NULL, related_name='outbound_messages')
+    phone = models.CharField(max_length=20)
+    text = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Выборка воркера: WHERE status = 'pending' AND next_attempt_at <= now ORDER BY next_attempt_at, id
+            models.Index(fields=['status', 'next_attempt_at', 'id'], name='outbound_due_idx'),
+        ]
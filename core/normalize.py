@@ -0,0 +1,28 @@
+import re
+
+_NON_DIGITS = re.compile(r'\D+')
+_SPACES = re.compile(r'\s+')
+
+PHONE_LENGTH = 12  # +7XXXXXXXXXX
+
+
+def normalize_phone(phone):
+    """Приводит номер к виду +7XXXXXXXXXX (длину проверяет is_valid_phone)."""
+    phone = (phone or '').replace(' ', '').replace('(', '').replace(')', '').replace('-', '')
+    if not phone.startswith('+7'):
+        phone = '+7' + phone
+    return phone
+
+
+def is_valid_phone(phone):
+    return len(phone) == PHONE_LENGTH
+
+
+def phone_digits(phone):
+    """Только цифры номера: '+7(700)-123-45-67' -> '77001234567'."""
+    return _NON_DIGITS.sub('', phone or '')
+
+
+def search_name(name):
+    """Имя в виде для поиска: без регистра, ё -> е, одиночные пробелы."""
+    return _SPACES.sub(' ', (name or '').casefold().replace('ё', 'е')).strip()
@@ -0,0 +1,267 @@
+"""
+Очередь исходящих уведомлений клиентам (WhatsApp).
+
+Запрос кассира только кладёт готовый текст в ``OutboundMessage`` (``enqueue``),
+а отправляет воркер ``manage.py send_notifications``: он забирает пачку
+созревших сообщений, передаёт её транспорту и записывает итог.
+
+* Транспорт задаётся ``settings.NOTIFICATION_TRANSPORT`` (путь к классу):
+  ``WhatsAppCloudTransport`` — WhatsApp Business Cloud API,
+  ``LocalTransport`` — заглушка для тестов, ничего не отправляет. Значения по
+  умолчанию вне тестов нет: без транспорта не проходит проверка
+  ``check_transport`` (manage.py check, migrate, send_notifications), а
+  ``get_transport`` падает с ImproperlyConfigured — иначе сообщения молча
+  помечались бы отправленными.
+* Скорость ограничена ``NOTIFICATION_RATE_PER_SECOND`` сообщений в секунду
+  (``RateLimiter``, на процесс воркера).
+* Временная ошибка откладывает сообщение на ``NOTIFICATION_RETRY_DELAY``
+  секунд, с каждой попыткой вдвое дольше; после ``NOTIFICATION_MAX_ATTEMPTS``
+  попыток или при постоянной ошибке (например, неверный номер) сообщение
+  помечается ``failed``.
+* Сообщения, зависшие в ``sending`` (воркер упал посреди пачки), возвращаются
+  в очередь через ``NOTIFICATION_STALE_SECONDS`` — возможна повторная доставка.
+
+На PostgreSQL пачку забирает ``SELECT ... FOR UPDATE SKIP LOCKED``, поэтому
+воркеров может быть несколько; на SQLite запускайте один воркер.
+
+Очередь своя в каждой базе организаций (core/shards.py). Воркер базы берёт
+только сообщения организаций, размещённых в ней: пока перенос остановил запись,
+очередь организации не трогается, а после переключения её сообщения
+отправляются только из новой базы, хотя копия в старой ещё не удалена.
+"""
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import shards
+from .models import Organization, OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+LOCAL_TRANSPORT = 'core.notifications.LocalTransport'
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_RATE_PER_SECOND = 10
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+DEFAULT_STALE_SECONDS = 10 * 60
+
+
+class TransportError(Exception):
+    """Ошибка отправки; ``permanent`` — повторять бесполезно."""
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class BaseTransport:
+    def send(self, phone, text):
+        raise NotImplementedError
+
+    def send_messages(self, messages):
+        """
+        Отправляет пачку ``OutboundMessage``. Возвращает словарь {id: TransportError}
+        для неотправленных; остальные считаются доставленными.
+        """
+        errors = {}
+        for message in messages:
+            try:
+                self.send(message.phone, message.text)
+            except TransportError as exc:
+                errors[message.pk] = exc
+        return errors
+
+
+class LocalTransport(BaseTransport):
+    """Заглушка для тестов: складывает (телефон, текст) в ``outbox`` процесса."""
+    outbox = []
+    max_outbox = 1000
+
+    def send(self, phone, text):
+        self.outbox.append((phone, text))
+        # Хранятся только последние сообщения, чтобы воркер не рос в памяти
+        del self.outbox[:-self.max_outbox]
+
+
+class WhatsAppCloudTransport(BaseTransport):
+    """Текстовые сообщения через WhatsApp Business Cloud API."""
+
+    def __init__(self):
+        self.url = f"{settings.WHATSAPP_API_URL.rstrip('/')}/{settings.WHATSAPP_PHONE_NUMBER_ID}/messages"
+        self.token = settings.WHATSAPP_TOKEN
+        self.timeout = getattr(settings, 'WHATSAPP_TIMEOUT', 10)
+
+    def send(self, phone, text):
+        body = json.dumps({
+            'messaging_product': 'whatsapp',
+            'to': phone.lstrip('+'),
+            'type': 'text',
+            'text': {'body': text},
+        }).encode()
+        request = urllib.request.Request(self.url, data=body, method='POST', headers={
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json',
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as exc:
+            # 4xx, кроме 429 (превышен лимит), — ошибка в самом сообщении
+            raise TransportError(f'HTTP {exc.code}', permanent=400 <= exc.code < 500 and exc.code != 429) from exc
+        except OSError as exc:
+            raise TransportError(str(exc)) from exc
+
+
+def get_transport():
+    path = getattr(settings, 'NOTIFICATION_TRANSPORT', '')
+    if not path:
+        raise ImproperlyConfigured('NOTIFICATION_TRANSPORT is not set, notifications cannot be sent')
+    return import_string(path)()
+
+
+def check_transport(app_configs=None, **kwargs):
+    """Системная проверка: транспорт задан, заглушка — только в тестах."""
+    path = getattr(settings, 'NOTIFICATION_TRANSPORT', '')
+    if not path:
+        return [checks.Error(
+            'NOTIFICATION_TRANSPORT is not set: queued notifications would never be delivered.',
+            hint='Set NOTIFICATION_TRANSPORT=core.notifications.WhatsAppCloudTransport and WHATSAPP_*.',
+            id='core.E001',
+        )]
+    if path == LOCAL_TRANSPORT and not getattr(settings, 'TESTING', False):
+        return [checks.Warning(
+            'NOTIFICATION_TRANSPORT is LocalTransport: notifications are marked sent but not delivered.',
+            id='core.W001',
+        )]
+    return []
+
+
+class RateLimiter:
+    """Ведро токенов: в среднем не больше ``rate`` сообщений в секунду."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.updated = clock()
+
+    def acquire(self, count=1):
+        if not self.rate:
+            return
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Пачка больше ведра уводит его в минус: ждём, пока долг не погасится
+        self.tokens -= count
+        if self.tokens < 0:
+            self.sleep(-self.tokens / self.rate)
+
+
+def enqueue(client, text):
+    """Ставит уведомление клиенту в очередь; вызывается из запроса кассира."""
+    return OutboundMessage.objects.create(
+        organization_id=client.organization_id, client=client, phone=client.phone, text=text,
+        next_attempt_at=timezone.now(),
+    )
+
+
+def _placed_here(messages, using):
+    """
+    Сообщения организаций, которые размещены в базе ``using`` и пишут в неё:
+    без переносимых с остановленной записью и уже переключённых на другую базу.
+    """
+    if len(shards.databases()) == 1:
+        return messages
+    organization_ids = []
+    for organization_id in messages.order_by().values_list('organization_id', flat=True).distinct():
+        database, move_state = shards.placement(organization_id)
+        if database == using and move_state != Organization.MOVE_FROZEN:
+            organization_ids.append(organization_id)
+    return messages.filter(organization_id__in=organization_ids)
+
+
+def requeue_stale(seconds=None):
+    """Возвращает в очередь сообщения, зависшие в ``sending``. Возвращает их число."""
+    seconds = seconds or getattr(settings, 'NOTIFICATION_STALE_SECONDS', DEFAULT_STALE_SECONDS)
+    using = router.db_for_write(OutboundMessage)
+    stale = OutboundMessage.objects.using(using).filter(
+        status=OutboundMessage.STATUS_SENDING, updated_at__lt=timezone.now() - timedelta(seconds=seconds),
+    )
+    return _placed_here(stale, using).update(status=OutboundMessage.STATUS_PENDING, updated_at=timezone.now())
+
+
+def claim(batch_size=DEFAULT_BATCH_SIZE):
+    """Забирает до ``batch_size`` созревших сообщений и переводит их в ``sending``."""
+    using = router.db_for_write(OutboundMessage)
+    now = timezone.now()
+    due = _placed_here(OutboundMessage.objects.using(using).filter(
+        status=OutboundMessage.STATUS_PENDING, next_attempt_at__lte=now,
+    ), using).order_by('next_attempt_at', 'id')
+    with transaction.atomic(using=using):
+        if connections[using].features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        messages = list(due[:batch_size])
+        OutboundMessage.objects.using(using).filter(id__in=[m.pk for m in messages]).update(
+            status=OutboundMessage.STATUS_SENDING, updated_at=now,
+        )
+    return messages
+
+
+def _record(messages, errors):
+    now = timezone.now()
+    max_attempts = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+    retry_delay = getattr(settings, 'NOTIFICATION_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+    for message in messages:
+        message.attempts += 1
+        message.updated_at = now
+        error = errors.get(message.pk)
+        if error is None:
+            message.status = OutboundMessage.STATUS_SENT
+            message.sent_at = now
+            message.last_error = ''
+        elif error.permanent or message.attempts >= max_attempts:
+            message.status = OutboundMessage.STATUS_FAILED
+            message.last_error = str(error)
+        else:
+            message.status = OutboundMessage.STATUS_PENDING
+            message.next_attempt_at = now + timedelta(seconds=retry_delay * 2 ** (message.attempts - 1))
+            message.last_error = str(error)
+    OutboundMessage.objects.bulk_update(
+        messages, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at', 'updated_at'],
+    )
+
+
+def dispatch(transport=None, batch_size=DEFAULT_BATCH_SIZE, limiter=None):
+    """
+    Отправляет одну пачку созревших сообщений. Возвращает (отправлено, ошибок);
+    (0, 0) — очередь пуста.
+    """
+    messages = claim(batch_size)
+    if not messages:
+        return 0, 0
+    transport = transport or get_transport()
+    if limiter:
+        limiter.acquire(len(messages))
+    try:
+        errors = transport.send_messages(messages)
+    except TransportError as exc:
+        # Транспорт отказал целиком (например, недоступен API): вся пачка — на повтор
+        errors = {message.pk: exc for message in messages}
+    _record(messages, errors)
+    sent = len(messages) - len(errors)
+    if errors:
+        logger.warning("Notifications: sent %d, failed %d of %d", sent, len(errors), len(messages))
+    else:
+        logger.info("Notifications: sent %d", sent)
+    return sent, len(errors)
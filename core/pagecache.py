@@ -0,0 +1,104 @@
+"""
+Кэш дашборда по организации.
+
+У каждой организации есть версия — отметка времени последнего изменения её
+клиентов или истории бонусов (в наносекундах). Она хранится в колонке
+``Organization.data_version`` строки организации в её базе (core/shards.py)
+и меняется тем же ``UPDATE``, что и счётчики core/counters.py, в транзакции
+записи: все процессы видят новую версию вместе с новыми данными. Версия входит
+в ключи кэша таблицы клиентов и «потрачено за месяц», а также в ETag и
+Last-Modified страницы, поэтому явно удалять старые записи не нужно: они
+просто перестают запрашиваться и вытесняются по таймауту.
+
+Кэш фрагментов — ``default`` из settings.CACHES. С LocMemCache у каждого
+процесса свои фрагменты, но устаревший фрагмент не отдаётся: версию процесс
+читает из БД вместе со страницей (``version``) или отдельным запросом
+(``read_version``). Частым чтениям без страницы (кэш балансов core/balances.py)
+хватает ``recent_version``: версия, запомненная в процессе не дольше
+``max_age`` секунд; запись в этом же процессе забывает её сразу после коммита.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from . import shards
+from .models import Organization
+
+FRAGMENT_TIMEOUT = 10 * 60
+
+# Организация -> (версия, time.monotonic() чтения), см. recent_version
+_recent = {}
+
+
+def next_version():
+    """Выражение для ``update(data_version=...)``: новая версия больше прежней."""
+    return Greatest(Value(time.time_ns()), F('data_version') + 1)
+
+
+def version(organization):
+    """Версия данных по строке организации из её базы (``shards.local_organization``)."""
+    return organization.data_version
+
+
+def read_version(organization_id):
+    """Текущая версия данных организации одним запросом по ключу."""
+    return (
+        Organization.objects.using(shards.database_for(organization_id))
+        .values_list('data_version', flat=True).get(pk=organization_id)
+    )
+
+
+def recent_version(organization_id, max_age):
+    """Версия, прочитанная этим процессом не раньше ``max_age`` секунд назад."""
+    now = time.monotonic()
+    recent = _recent.get(organization_id)
+    if recent is not None and now - recent[1] < max_age:
+        return recent[0]
+    value = read_version(organization_id)
+    _recent[organization_id] = (value, now)
+    return value
+
+
+def forget(organization_id=None):
+    """Забывает запомненную версию организации (без аргумента — все)."""
+    if organization_id is None:
+        _recent.clear()
+    else:
+        _recent.pop(organization_id, None)
+
+
+def forget_on_commit(organization_id, using):
+    """Запись этого процесса видна его ``recent_version`` сразу после коммита."""
+    transaction.on_commit(lambda: forget(organization_id), using=using)
+
+
+def bump(organization_id, using=None):
+    """Меняет версию организации в текущей транзакции записи."""
+    using = using or shards.database_for(organization_id, write=True)
+    Organization.objects.using(using).filter(id=organization_id).update(data_version=next_version())
+    forget_on_commit(organization_id, using)
+
+
+def last_modified(organization):
+    """Время последнего изменения данных организации (unix time, секунды)."""
+    return version(organization) // 10 ** 9
+
+
+def key(organization, name, *parts):
+    """Ключ кэша, привязанный к текущей версии организации."""
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return f'org:{organization.pk}:{name}:{version(organization)}:{digest}'
+
+
+def get_or_set(organization, name, parts, default, timeout=FRAGMENT_TIMEOUT):
+    """``cache.get_or_set`` по ключу ``key(...)``; ``default`` — вызываемый объект."""
+    return cache.get_or_set(key(organization, name, *parts), default, timeout)
+
+
+def etag(organization, *parts):
+    """ETag страницы: версия организации плюс всё, что отличает ответ (пользователь, параметры)."""
+    return '"%s"' % hashlib.md5(repr((version(organization),) + parts).encode()).hexdigest()
@@ -0,0 +1,140 @@
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def get_page_size():
+    return getattr(settings, 'DASHBOARD_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), ensure_ascii=False, default=_json_default).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Возвращает список значений курсора или None, если курсор битый."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def _cursor_values(queryset, fields, cursor):
+    """
+    Значения курсора, приведённые к типам полей ``fields``. None, если курсор
+    битый или подделан (не тот набор полей, значение не того типа): такой
+    запрос получает первую страницу, а не ошибку сервера.
+    """
+    values = decode_cursor(cursor)
+    if values is None or len(values) != len(fields):
+        return None
+    opts = queryset.model._meta
+    try:
+        values = [opts.get_field(field).to_python(value) for field, value in zip(fields, values)]
+    except (ValidationError, TypeError, ValueError):
+        return None
+    # Сравнение с NULL в условии _seek невозможно
+    return None if None in values else values
+
+
+class KeysetPage:
+    """Страница результатов с курсорами на соседние страницы."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _seek(fields, values, lookup):
+    # (a, b) > (x, y)  ->  a >= x AND (a > x OR (a = x AND b > y));
+    # первое условие даёт индексу диапазон по ведущему полю
+    condition = Q()
+    for i, field in enumerate(fields):
+        step = Q(**{f'{field}__{lookup}': values[i]})
+        for prev_field, prev_value in zip(fields[:i], values[:i]):
+            step &= Q(**{prev_field: prev_value})
+        condition |= step
+    return Q(**{f'{fields[0]}__{lookup}e': values[0]}) & condition
+
+
+def keyset_paginate(queryset, fields, after=None, before=None, page_size=None, descending=False):
+    """
+    Курсорная (keyset) пагинация по полям ``fields`` (по возрастанию, либо по
+    убыванию при ``descending=True``).
+
+    Последнее поле должно быть уникальным (обычно ``id``), чтобы порядок был
+    строгим. Читается не больше ``page_size + 1`` строк независимо от того,
+    насколько далеко пролистан список.
+    """
+    page_size = page_size or get_page_size()
+    fields = list(fields)
+    forward, backward = ('lt', 'gt') if descending else ('gt', 'lt')
+    forward_order = [f'-{f}' for f in fields] if descending else fields
+    backward_order = fields if descending else [f'-{f}' for f in fields]
+    after_values = _cursor_values(queryset, fields, after)
+    before_values = _cursor_values(queryset, fields, before)
+
+    if before_values is not None:
+        rows = list(
+            queryset.filter(_seek(fields, before_values, backward))
+            .order_by(*backward_order)[:page_size + 1]
+        )
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        rows.reverse()
+        prev_cursor = _cursor_for(rows[0], fields) if has_more and rows else None
+        next_cursor = _cursor_for(rows[-1], fields) if rows else None
+        return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+    if after_values is not None:
+        queryset = queryset.filter(_seek(fields, after_values, forward))
+
+    rows = list(queryset.order_by(*forward_order)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = _cursor_for(rows[-1], fields) if has_more else None
+    prev_cursor = _cursor_for(rows[0], fields) if after_values is not None and rows else None
+    return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def _cursor_for(obj, fields):
+    if isinstance(obj, dict):
+        return encode_cursor(obj[f] for f in fields)
+    return encode_cursor(getattr(obj, f) for f in fields)
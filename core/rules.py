@@ -0,0 +1,107 @@
+"""
+Правила бонусов организаций (``BonusRule``) и их ночной прогон
+``manage.py run_rules``.
+
+Каждый запуск правила на дату — массовая проводка core/batches.py с id,
+вычисленным из правила и даты (``uuid5``). Поэтому повторный прогон за тот
+же день продолжает прерванные проводки с места остановки и ничего не
+проводит дважды, а незавершённые подхватывает и ``run_batches``. Клиенты
+обрабатываются пачками: один UPDATE и один ``bulk_create`` истории на пачку.
+
+* ``birthday`` — начисление клиентам, у которых день рождения в этот день
+  (родившимся 29 февраля в невисокосный год — 28-го);
+* ``recurring`` — начисление всем клиентам раз в ``days`` дней начиная со
+  ``start_date``;
+* ``expiration`` — сгорание начислений старше ``days`` дней по FIFO
+  (core/expiration.py).
+"""
+import calendar
+import logging
+import uuid
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+
+from . import batches, expiration
+from .models import BonusRule, Organization
+
+logger = logging.getLogger(__name__)
+
+RULE_BATCH_NAMESPACE = uuid.UUID('0b8c9a52-4f5e-4a43-9d43-6f3c1f0e7a21')
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_STALE_MINUTES = 10
+
+DESCRIPTIONS = {
+    BonusRule.KIND_EXPIRATION: expiration.DESCRIPTION_EXPIRATION,
+    BonusRule.KIND_BIRTHDAY: 'Бонус ко дню рождения',
+    BonusRule.KIND_RECURRING: 'Начисление по расписанию',
+}
+
+
+def birthdays_on(day):
+    """Дни рождения (MM-DD), которые отмечаются в дату ``day``."""
+    days = [day.strftime('%m-%d')]
+    if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+        days.append('02-29')
+    return days
+
+
+def selection(rule, day):
+    """Выборка проводки правила на дату или None, если в этот день правило не срабатывает."""
+    if rule.kind == BonusRule.KIND_EXPIRATION and rule.days:
+        before = timezone.make_aware(datetime.combine(day - timedelta(days=rule.days), time.min))
+        return {'expire_before': before.isoformat()}
+    if not rule.amount or rule.amount <= 0:
+        return None
+    if rule.kind == BonusRule.KIND_BIRTHDAY:
+        return {'birthdays': birthdays_on(day)}
+    if rule.kind == BonusRule.KIND_RECURRING and rule.days:
+        start = rule.start_date or timezone.localdate(rule.created_at)
+        if day >= start and (day - start).days % rule.days == 0:
+            return {'all': True}
+    return None
+
+
+def batch_for(rule, day):
+    """Проводка правила на дату; None, если правило в этот день не срабатывает."""
+    rule_selection = selection(rule, day)
+    if rule_selection is None:
+        return None
+    batch_id = uuid.uuid5(RULE_BATCH_NAMESPACE, f'{rule.pk}:{day.isoformat()}')
+    batch, _ = batches.get_or_create_batch(
+        batch_id, rule.organization, rule.amount or Decimal(0),
+        dict(rule_selection, rule=rule.pk, date=day.isoformat()),
+        description=rule.description or DESCRIPTIONS[rule.kind],
+    )
+    return batch
+
+
+def run_organization(organization_id, day, chunk_size=DEFAULT_CHUNK_SIZE, stale_minutes=DEFAULT_STALE_MINUTES):
+    """
+    Выполняет активные правила организации на дату. Вызывается и в дочерних
+    процессах ``run_rules --workers``, поэтому возвращает простые значения:
+    список (id правила, тип, статус проводки, проведено, всего).
+    """
+    organization = Organization.objects.get(id=organization_id)
+    stale = timezone.now() - timedelta(minutes=stale_minutes)
+    results = []
+    for rule in organization.bonus_rules.filter(is_active=True).order_by('pk'):
+        rule.organization = organization
+        batch = batch_for(rule, day)
+        if batch is None:
+            continue
+        if batches.requeue_stale(batch, stale) and batches.claim(batch):
+            batches.run(batch, chunk_size)
+            logger.info(
+                "Rule %s (%s) for %s: posted %d of %d clients", rule.pk, rule.kind, day, batch.processed, batch.total,
+            )
+        results.append((rule.pk, rule.kind, batch.status, batch.processed, batch.total))
+    return results
+
+
+def organizations_with_rules():
+    return list(
+        BonusRule.objects.filter(is_active=True).order_by('organization_id')
+        .values_list('organization_id', flat=True).distinct()
+    )
@@ -0,0 +1,174 @@
+"""
+Поиск клиентов по телефону и имени.
+
+Телефон хранится в двух нормализованных колонках: ``phone_digits`` (поиск по
+началу номера) и ``phone_digits_reversed`` (поиск по последним N цифрам —
+префикс перевёрнутой строки). Имя хранится в ``name_search`` в нижнем
+регистре. Все три колонки проиндексированы вместе с организацией, поэтому
+поиск по началу — это диапазонное чтение индекса, а не LIKE '%x%'.
+
+Поиск подстроки в имени идёт через FTS5 (trigram) на SQLite и через pg_trgm
+на PostgreSQL. Индексы создаются после каждого migrate (см. CoreConfig.ready):
+SQLite пересоздаёт таблицу при части миграций и теряет триггеры, поэтому
+``ensure_search_indexes`` идемпотентна и при необходимости перестраивает FTS.
+"""
+import logging
+from collections import namedtuple
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+from .models import Client
+from .normalize import phone_digits, search_name
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'core_client_fts'
+# Минимальная длина подстроки для trigram-индекса
+MIN_SUBSTRING_LENGTH = 3
+DEFAULT_LIMIT = 50
+
+# Чем меньше rank, тем выше клиент в выдаче
+RANK_EXACT_PHONE = 0
+RANK_PHONE_SUFFIX = 1
+RANK_NAME_PREFIX = 1
+RANK_PHONE_PREFIX = 2
+RANK_NAME_SUBSTRING = 3
+
+SearchResult = namedtuple('SearchResult', ['client', 'rank'])
+
+_SQLITE_TRIGGERS = {
+    f'{FTS_TABLE}_ai': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON core_client BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, name_search) VALUES (new.id, new.name_search); END"
+    ),
+    f'{FTS_TABLE}_ad': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON core_client BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name_search) "
+        f"VALUES ('delete', old.id, old.name_search); END"
+    ),
+    f'{FTS_TABLE}_au': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name_search ON core_client BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name_search) "
+        f"VALUES ('delete', old.id, old.name_search); "
+        f"INSERT INTO {FTS_TABLE}(rowid, name_search) VALUES (new.id, new.name_search); END"
+    ),
+}
+
+_fts_available = {}
+
+
+def _install_sqlite_fts(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {row[0] for row in cursor.fetchall()}
+        if 'core_client' not in existing:
+            return False
+        if FTS_TABLE in existing and existing.issuperset(_SQLITE_TRIGGERS):
+            return True
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"name_search, content='core_client', content_rowid='id', tokenize='trigram')"
+            )
+        except Exception:
+            # Старый SQLite без FTS5/trigram — остаётся поиск по началу имени
+            logger.warning("SQLite FTS5 trigram tokenizer unavailable, name substring search disabled")
+            return False
+        for sql in _SQLITE_TRIGGERS.values():
+            cursor.execute(sql)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+def _install_pg_trgm(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS core_client_name_trgm_idx "
+            "ON core_client USING gin (name_search gin_trgm_ops)"
+        )
+    return True
+
+
+def ensure_search_indexes(using='default'):
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        _fts_available[using] = _install_sqlite_fts(connection)
+    elif connection.vendor == 'postgresql':
+        _fts_available[using] = _install_pg_trgm(connection)
+    else:
+        _fts_available[using] = False
+    return _fts_available[using]
+
+
+def ensure_search_indexes_after_migrate(sender, using='default', **kwargs):
+    ensure_search_indexes(using)
+
+
+def _has_substring_index(using):
+    if using not in _fts_available:
+        connection = connections[using]
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+                _fts_available[using] = cursor.fetchone() is not None
+        else:
+            _fts_available[using] = connection.vendor == 'postgresql'
+    return _fts_available[using]
+
+
+def _prefix_range(field, prefix):
+    # Диапазон вместо LIKE 'x%': индекс используется на любой СУБД
+    return {f'{field}__gte': prefix, f'{field}__lt': prefix + '\U0010ffff'}
+
+
+def _name_substring_filter(queryset, term):
+    using = queryset.db
+    vendor = connections[using].vendor
+    if _has_substring_index(using) and vendor == 'sqlite':
+        quoted = '"' + term.replace('"', '""') + '"'
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [quoted]
+        ))
+    # На PostgreSQL LIKE '%x%' по name_search обслуживается trigram-индексом
+    return queryset.filter(name_search__contains=term)
+
+
+def search_clients(org, query, limit=DEFAULT_LIMIT):
+    """
+    Ищет клиентов организации и возвращает список ``SearchResult``,
+    отсортированный по rank, затем по имени.
+
+    Цифровой запрос ищется как точный номер, как последние цифры номера и как
+    начало номера. Текстовый — как начало имени, затем как подстрока имени.
+    """
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    clients = Client.objects.filter(organization=org)
+    found = {}
+
+    def collect(queryset, rank):
+        remaining = limit - len(found)
+        if remaining <= 0:
+            return
+        for client in queryset.exclude(id__in=list(found)).order_by('name', 'id')[:remaining]:
+            found[client.id] = SearchResult(client, rank)
+
+    digits = phone_digits(query)
+    if digits and len(digits) * 2 >= len(query.replace(' ', '')):
+        collect(clients.filter(phone_digits=digits), RANK_EXACT_PHONE)
+        collect(clients.filter(**_prefix_range('phone_digits_reversed', digits[::-1])), RANK_PHONE_SUFFIX)
+        collect(clients.filter(**_prefix_range('phone_digits', digits)), RANK_PHONE_PREFIX)
+        if not digits.startswith('7'):
+            # Номер, набранный без кода страны
+            collect(clients.filter(**_prefix_range('phone_digits', '7' + digits)), RANK_PHONE_PREFIX)
+    else:
+        term = search_name(query)
+        collect(clients.filter(**_prefix_range('name_search', term)), RANK_NAME_PREFIX)
+        if len(term) >= MIN_SUBSTRING_LENGTH:
+            collect(_name_substring_filter(clients, term), RANK_NAME_SUBSTRING)
+
+    return sorted(found.values(), key=lambda r: (r.rank, r.client.name, r.client.id))
@@ -0,0 +1,270 @@
+"""
+Шардирование данных организаций по базам.
+
+Организации, пользователи, токены API, правила и сессии лежат в базе
+``default`` (каталог). Клиенты, история, архив, проводки, дневные итоги,
+шаблоны сообщений, очередь уведомлений и ключи идемпотентности
+(``TENANT_MODELS``) — в базе организации ``Organization.database``, одной из
+``settings.TENANT_DATABASES`` (файлы SQLite или схемы PostgreSQL, см.
+bonus_manager/settings.py). В базе организации лежит и копия её строки
+``Organization``: на неё ссылаются внешние ключи, в ней же счётчики
+core/counters.py (``local_organization``).
+
+``TenantRouter`` выбирает базу для моделей организации:
+
+* по ``organization_id`` объекта (сохранение клиента, проводки core/ledger.py,
+  связанные менеджеры вроде ``client.history``);
+* иначе по текущей организации: ``TenantMiddleware`` берёт её из
+  ``request.user.organization``, ``api.token_required`` — из токена, команды
+  управления оборачивают работу с организацией в ``use(organization_id)``.
+
+Без контекста запросы идут в ``default``: админка видит клиентов и историю
+только организаций этой базы.
+
+Перенос организации (``manage.py move_organization``) копирует данные на
+ходу, затем ненадолго останавливает запись (``move_state = frozen``,
+``OrganizationMoving`` и ответ 503), дописывает изменения и переключает
+базу. Размещение организаций кэшируется на ``PLACEMENT_TIMEOUT`` секунд,
+поэтому перед остановкой записи и удалением старых данных команда ждёт,
+пока все процессы его перечитают.
+
+Чтобы данные можно было переносить с сохранением id, каждая база выдаёт id
+из своего диапазона: ``reserve_ids`` после migrate сдвигает счётчики
+автоинкремента базы номер N в ``TENANT_DATABASES`` к N * ``ID_RANGE``.
+"""
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+
+from .models import Organization
+
+logger = logging.getLogger(__name__)
+
+TENANT_MODELS = frozenset({
+    'core.client', 'core.bonushistory', 'core.bonushistoryarchive', 'core.balancesnapshot', 'core.bonusbatch',
+    'core.dailystats', 'core.messagetemplate', 'core.outboundmessage', 'core.idempotencyrecord',
+})
+ID_RANGE = 10 ** 12
+DEFAULT_PLACEMENT_TIMEOUT = 5
+RETRY_AFTER = 10
+
+# (id организации, база) текущего контекста; middleware кладёт функцию,
+# которая читает организацию пользователя только при первом запросе к данным
+_current = ContextVar('tenant', default=None)
+
+
+class OrganizationMoving(Exception):
+    """Организация переносится в другую базу, запись временно остановлена."""
+
+    def __init__(self, organization_id):
+        super().__init__(f'Organization {organization_id} is being moved to another database')
+        self.organization_id = organization_id
+
+
+def databases():
+    return list(getattr(settings, 'TENANT_DATABASES', [DEFAULT_DB_ALIAS]))
+
+
+def is_tenant_model(model):
+    return model._meta.label_lower in TENANT_MODELS
+
+
+def _placement_key(organization_id):
+    return f'org:{organization_id}:placement'
+
+
+def placement_timeout():
+    return getattr(settings, 'SHARD_PLACEMENT_TIMEOUT', DEFAULT_PLACEMENT_TIMEOUT)
+
+
+def placement(organization_id):
+    """(база, состояние переноса) организации; из кэша не старше ``PLACEMENT_TIMEOUT``."""
+    key = _placement_key(organization_id)
+    value = cache.get(key)
+    if value is None:
+        value = (
+            Organization.objects.using(DEFAULT_DB_ALIAS).filter(pk=organization_id)
+            .values_list('database', 'move_state').first()
+        ) or (DEFAULT_DB_ALIAS, '')
+        cache.set(key, value, placement_timeout())
+    return value
+
+
+def set_placement(organization_id, database, move_state=''):
+    """Меняет размещение в каталоге и в кэше этого процесса; остальные увидят его по таймауту."""
+    Organization.objects.using(DEFAULT_DB_ALIAS).filter(pk=organization_id).update(
+        database=database, move_state=move_state,
+    )
+    cache.set(_placement_key(organization_id), (database, move_state), placement_timeout())
+
+
+def database_for(organization_id, write=False):
+    """База организации; для записи — OrganizationMoving, пока перенос её остановил."""
+    if len(databases()) == 1:
+        return DEFAULT_DB_ALIAS
+    database, move_state = placement(organization_id)
+    if write and move_state == Organization.MOVE_FROZEN:
+        raise OrganizationMoving(organization_id)
+    return database
+
+
+def local_organization(org):
+    """Строка организации из её базы: там актуальные счётчики core/counters.py."""
+    database = database_for(org.pk)
+    if database == (org._state.db or DEFAULT_DB_ALIAS):
+        return org
+    return Organization.objects.using(database).get(pk=org.pk)
+
+
+@contextmanager
+def use(organization_id=None, database=None):
+    """Запросы к данным организаций внутри блока идут в базу организации или в ``database``."""
+    token = _current.set((organization_id, database))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current():
+    """(id организации, база) текущего контекста; оба могут быть None."""
+    value = _current.get()
+    if value is None:
+        return None, None
+    return value() if callable(value) else value
+
+
+class TenantRouter:
+    def _database(self, model, hints, write):
+        if len(databases()) == 1:
+            return None
+        if not is_tenant_model(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if isinstance(instance, Organization):
+            # Связанные менеджеры организации: org.bonus_batches и т.п.
+            organization_id = instance.pk
+        else:
+            organization_id = getattr(instance, 'organization_id', None)
+        database = None
+        if organization_id is None:
+            organization_id, database = current()
+        if organization_id is not None:
+            return database_for(organization_id, write)
+        if database is None and instance is not None:
+            # Загруженный объект без organization_id (запись истории и т.п.) вне контекста
+            return instance._state.db
+        return database
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, hints, write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._database(model, hints, write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Строки каталога есть в каждой базе (копия организации) или связаны без FK в БД
+        if not is_tenant_model(obj1) or not is_tenant_model(obj2):
+            return True
+        return None
+
+
+class TenantMiddleware:
+    """Направляет запросы к данным организаций в базу организации пользователя."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _tenant(request):
+        # request.user читается лениво: только если запрос дошёл до данных организации
+        return lambda: (getattr(request.user, 'organization_id', None), None)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _current.set(self._tenant(request))
+        try:
+            return self.get_response(request)
+        finally:
+            _current.reset(token)
+
+    async def __acall__(self, request):
+        token = _current.set(self._tenant(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            _current.reset(token)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, OrganizationMoving):
+            return None
+        logger.warning("%s, request to %s refused", exception, request.path)
+        response = HttpResponse('Данные организации переносятся, повторите через несколько секунд.', status=503)
+        response['Retry-After'] = RETRY_AFTER
+        return response
+
+
+def sync_organization(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    """post_save: копия строки организации в её базе (без счётчиков — они ведутся там)."""
+    if using != DEFAULT_DB_ALIAS or instance.database == DEFAULT_DB_ALIAS:
+        return
+    Organization.objects.using(instance.database).update_or_create(
+        pk=instance.pk, defaults={'name': instance.name, 'database': instance.database},
+    )
+
+
+def delete_organization(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    """post_delete: удаляет копию организации вместе с её данными в её базе."""
+    if using != DEFAULT_DB_ALIAS or instance.database == DEFAULT_DB_ALIAS:
+        return
+    Organization.objects.using(instance.database).filter(pk=instance.pk).delete()
+    cache.delete(_placement_key(instance.pk))
+
+
+def _tenant_tables():
+    from django.apps import apps
+    return [
+        model._meta.db_table for model in apps.get_app_config('core').get_models()
+        if is_tenant_model(model) and model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField')
+    ]
+
+
+def reserve_ids(using):
+    """Сдвигает автоинкремент таблиц организаций базы ``using`` к началу её диапазона id."""
+    if using not in databases():
+        return
+    base = databases().index(using) * ID_RANGE
+    if not base:
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for table in _tenant_tables():
+            if connection.vendor == 'sqlite':
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, base])
+                elif row[0] < base:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [base, table])
+            elif connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f'SELECT last_value FROM {sequence}')
+                if cursor.fetchone()[0] < base:
+                    cursor.execute('SELECT setval(%s, %s)', [sequence, base])
+
+
+def reserve_ids_after_migrate(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    reserve_ids(using)
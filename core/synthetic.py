@@ -0,0 +1,94 @@
+"""
+Синтетические данные для нагрузочных тестов (``manage.py generate_data``).
+
+Организации ``Bench N`` с кассиром ``benchN`` (пароль ``bench``), клиентами
+и историей за последний год. Всё вставляется через ``bulk_create`` пачками,
+поэтому 100 тыс. клиентов и миллионы записей истории помещаются в память;
+счётчики организаций и дневные итоги пересчитываются в конце теми же
+функциями, что и ``reconcile_counters`` / ``rebuild_rollups``.
+"""
+import logging
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import counters, rollups, shards
+from .db import explicit_timestamps
+from .models import BonusHistory, Client, Organization, User
+
+logger = logging.getLogger(__name__)
+
+ORGANIZATION_PREFIX = 'Bench'
+USER_PREFIX = 'bench'
+PASSWORD = 'bench'
+DEFAULT_BATCH_SIZE = 5000
+
+FIRST_NAMES = ['Анна', 'Борис', 'Виктор', 'Галина', 'Дмитрий', 'Елена', 'Жанна', 'Зарина', 'Игорь', 'Карина',
+               'Лейла', 'Марат', 'Нурлан', 'Ольга', 'Пётр', 'Роза', 'Сергей', 'Тимур', 'Ульяна', 'Фарид']
+LAST_NAMES = ['Абенов', 'Белова', 'Волков', 'Гусева', 'Досымов', 'Ершова', 'Жуков', 'Захарова', 'Иванов',
+              'Касымова', 'Лебедев', 'Мухамедова', 'Нуриев', 'Орлова', 'Павлов', 'Рахимова', 'Сидоров']
+
+
+def phone_for(org_index, client_index):
+    return f'+7{org_index % 100:02d}{client_index:08d}'
+
+
+def _history(client, rng, count, now):
+    """Записи истории клиента от старых к новым; возвращает (записи, итоговый баланс)."""
+    balance = Decimal(0)
+    entries = []
+    dates = sorted(now - timedelta(seconds=rng.randrange(365 * 24 * 3600)) for _ in range(count))
+    for date in dates:
+        amount = Decimal(rng.randrange(100, 100000)) / 100
+        if balance >= amount and rng.random() < 0.4:
+            amount = -amount
+        balance += amount
+        entries.append(BonusHistory(
+            client=client, date=date, amount=amount,
+            description='Начисление' if amount > 0 else 'Списание', balance_after=balance,
+        ))
+    return entries, balance
+
+
+def generate_organization(org_index, clients, history_per_client, seed=0, batch_size=DEFAULT_BATCH_SIZE):
+    """Создаёт организацию с кассиром, клиентами и историей. Возвращает организацию."""
+    rng = random.Random(seed * 1000003 + org_index)
+    org = Organization.objects.create(name=f'{ORGANIZATION_PREFIX} {org_index}')
+    User.objects.create_user(f'{USER_PREFIX}{org_index}', password=PASSWORD, organization=org)
+    now = timezone.now()
+    using = shards.database_for(org.pk, write=True)
+
+    for start in range(0, clients, batch_size):
+        chunk = []
+        history = []
+        for i in range(start, min(start + batch_size, clients)):
+            client = Client(
+                organization=org, name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}',
+                phone=phone_for(org_index, i),
+            )
+            entries, client.balance = _history(client, rng, rng.randint(0, 2 * history_per_client), now)
+            client.fill_search_fields()
+            chunk.append(client)
+            history.extend(entries)
+        with transaction.atomic(using=using):
+            # bulk_create проставляет id клиентам (SQLite и PostgreSQL возвращают
+            # их из INSERT), и записи истории получают client_id при вставке
+            Client.objects.using(using).bulk_create(chunk)
+            # BonusHistory.date — auto_now_add, bulk_create затёр бы даты генератора
+            with explicit_timestamps(BonusHistory):
+                BonusHistory.objects.using(using).bulk_create(history, batch_size=batch_size)
+        logger.info("Organization %s: %d/%d clients generated", org.pk, start + len(chunk), clients)
+
+    counters.reconcile(org, fix=True)
+    rollups.rebuild([org.pk])
+    org.refresh_from_db()
+    return org
+
+
+def delete_generated():
+    """Удаляет все организации и пользователей, созданные генератором."""
+    User.objects.filter(username__startswith=USER_PREFIX, organization__name__startswith=ORGANIZATION_PREFIX).delete()
+    return Organization.objects.filter(name__startswith=f'{ORGANIZATION_PREFIX} ').delete()[0]
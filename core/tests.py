@@ -1,3 +1,1120 @@
-from django.test import TestCase
+import importlib.util
+import io
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import json
+import uuid
+from io import StringIO
+
+from bonus_manager.log import QueueListenerHandler
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    admin, analytics, api, archive, balances, batches, bulk, counters, ledger, message_templates, metrics, notifications,
+    pagecache, pagination, rollups, rules, shards,
+)
+from .models import (
+    BonusBatch, BonusHistory, BonusRule, Client, DailyStats, MessageTemplate, Organization, OutboundMessage, User,
+)
+
+# Полный проход по таблице: "SCAN core_client" (в т.ч. "SCAN ... USING INDEX")
+FULL_SCAN = re.compile(r'^SCAN (core_\w+)')
+TEMP_SORT = 'USE TEMP B-TREE'
+# Сессии из кэша включаются при общем кэше; в тестах один процесс, LocMemCache достаточно
+CACHED_DB_SESSIONS = 'django.contrib.sessions.backends.cached_db'
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite-specific')
+class QueryPlanTests(TestCase):
+    """Все запросы представлений к таблицам core должны идти по индексам."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        other = Organization.objects.create(name='Other')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        for org in (cls.org, other):
+            for i in range(30):
+                Client.objects.create(organization=org, name=f'Клиент {i:02d}', phone=f'+7700{org.pk}00{i:04d}')
+        cls.client_obj = Client.objects.filter(organization=cls.org).first()
+        for amount in (Decimal('100'), Decimal('-30'), Decimal('15')):
+            ledger.post_bonus(cls.client_obj, amount)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedQueries(self, queries, allow_sort=False):
+        checked = 0
+        for query in queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or 'core_' not in sql:
+                continue
+            checked += 1
+            for step in self.explain(sql):
+                match = FULL_SCAN.match(step)
+                if match and 'VIRTUAL TABLE' not in step:
+                    self.fail(f'Full scan of {match.group(1)}:\n{sql}\n{step}')
+                if TEMP_SORT in step and not allow_sort:
+                    self.fail(f'Sort without index:\n{sql}\n{step}')
+        self.assertGreater(checked, 0)
+
+    def capture(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = method(*args, **kwargs)
+        self.assertIn(response.status_code, (200, 302))
+        return ctx.captured_queries, response
+
+    def test_dashboard_first_page(self):
+        queries, _ = self.capture(self.client.get, reverse('dashboard'))
+        self.assertIndexedQueries(queries)
+
+    def test_dashboard_next_page(self):
+        with self.settings(DASHBOARD_PAGE_SIZE=10):
+            response = self.client.get(reverse('dashboard'))
+            cursor = response.context['clients'].next_cursor
+            queries, _ = self.capture(self.client.get, reverse('dashboard'), {'after': cursor})
+        self.assertIndexedQueries(queries)
+
+    def test_invalid_cursor_gives_first_page(self):
+        with self.settings(DASHBOARD_PAGE_SIZE=10):
+            first = self.client.get(reverse('dashboard')).context['clients']
+            cursors = [
+                pagination.encode_cursor(values)
+                for values in (['Клиент 05', 'x'], ['Клиент 05', [1]], ['Клиент 05', None], [1])
+            ]
+            # Не base64 и base64 от JSON-объекта вместо списка
+            for cursor in cursors + ['%%%', 'e30']:
+                for direction in ('after', 'before'):
+                    response = self.client.get(reverse('dashboard'), {direction: cursor})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(list(response.context['clients']), list(first))
+
+    def test_search_by_phone_suffix(self):
+        queries, response = self.capture(self.client.get, reverse('dashboard'), {'search': '0007'})
+        # Совпадения по диапазону индекса сортируются по имени, их немного
+        self.assertIndexedQueries(queries, allow_sort=True)
+        self.assertTrue(response.context['clients'])
+
+    def test_search_by_name(self):
+        queries, response = self.capture(self.client.get, reverse('dashboard'), {'search': 'иент 1'})
+        self.assertIndexedQueries(queries, allow_sort=True)
+        self.assertTrue(response.context['clients'])
+
+    def test_add_client_duplicate(self):
+        queries, response = self.capture(self.client.post, reverse('dashboard'), {
+            'add_client': '1', 'name': 'Дубликат', 'phone': self.client_obj.phone[2:], 'balance': '0',
+        })
+        self.assertIndexedQueries(queries)
+        self.assertTrue(response.context['add_form'].errors)
+
+    def test_add_bonus(self):
+        queries, _ = self.capture(self.client.post, reverse('dashboard'), {
+            'add_bonus': '1', 'client_id': self.client_obj.pk, 'amount': '5', 'type': 'accrual',
+        })
+        self.assertIndexedQueries(queries)
+
+    def test_history(self):
+        queries, _ = self.capture(self.client.get, reverse('history', args=[self.client_obj.pk]))
+        self.assertIndexedQueries(queries)
+
+    def test_history_reads_archive(self):
+        archive.archive_organization(self.org.pk, timezone.now() + timedelta(seconds=1))
+        with self.settings(HISTORY_PAGE_SIZE=2):
+            url = reverse('history_json', args=[self.client_obj.pk])
+            first = self.client.get(url).json()
+            queries, response = self.capture(self.client.get, url, {'after': first['next']})
+        self.assertIndexedQueries(queries)
+        self.assertEqual(len(first['entries']) + len(response.json()['entries']), 3)
+        self.assertTrue(archive.verify(self.client_obj))
+
+    def test_history_json_next_page(self):
+        with self.settings(HISTORY_PAGE_SIZE=2):
+            data = self.client.get(reverse('history_json', args=[self.client_obj.pk])).json()
+            queries, response = self.capture(
+                self.client.get, reverse('history_json', args=[self.client_obj.pk]), {'after': data['next']}
+            )
+        self.assertIndexedQueries(queries)
+        self.assertEqual(len(response.json()['entries']), 1)
+
+
+@override_settings(SESSION_ENGINE=CACHED_DB_SESSIONS)
+class DashboardCacheTests(TestCase):
+    """Таблица клиентов и условный GET дашборда, см. core/pagecache.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        cls.client_obj = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        # Первый ответ выдаёт CSRF-cookie, без неё ETag не ставится
+        self.client.get(reverse('dashboard'))
+
+    def test_not_modified(self):
+        response = self.client.get(reverse('dashboard'))
+        self.assertIn('ETag', response)
+        with self.assertNumQueries(2):  # пользователь, организация; сессия — из кэша
+            response = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_invalidates_page_and_table(self):
+        etag = self.client.get(reverse('dashboard'))['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('dashboard'), {
+                'add_bonus': '1', 'client_id': self.client_obj.pk, 'amount': '250', 'type': 'accrual',
+            })
+        # Страница с сообщением о постановке уведомления в очередь не кэшируется браузером
+        self.assertNotIn('ETag', self.client.get(reverse('dashboard')))
+        response = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '250')
+
+    def test_edited_templates_replace_cached_ones(self):
+        message_templates.get_for_user(self.user)
+        with self.assertNumQueries(0):
+            message_templates.get_for_user(self.user)
+        self.client.post(reverse('dashboard'), {
+            'edit_templates': '1', 'accrual_template': '[имя], +[сумма], всего [баланс]',
+            'deduction_template': '-[сумма]', 'reset_template': '0',
+        })
+        self.client.post(reverse('dashboard'), {
+            'add_bonus': '1', 'client_id': self.client_obj.pk, 'amount': '250', 'type': 'accrual',
+        })
+        self.assertEqual(OutboundMessage.objects.get().text, 'Анна, +250, всего 250.00')
+
+    def test_conflict_shown_as_error(self):
+        conflict = ledger.LedgerConflict('kept changing')
+        for action in ('reset_balance', 'delete_client'):
+            with mock.patch.object(ledger, action, side_effect=conflict):
+                response = self.client.post(
+                    reverse('dashboard'), {action: '1', 'client_id': self.client_obj.pk}, follow=True,
+                )
+            self.assertContains(response, 'всё время меняется')
+        self.assertTrue(Client.objects.filter(pk=self.client_obj.pk).exists())
+
+    def test_write_in_another_process(self):
+        etag = self.client.get(reverse('dashboard'))['ETag']
+        # Запись в другом воркере со своим LocMemCache: версия доходит через БД
+        with mock.patch.object(pagecache, 'cache', LocMemCache('other-worker', {})):
+            ledger.post_bonus(self.client_obj, Decimal('250'))
+        response = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, '250')
+
+
+@override_settings(SESSION_ENGINE=CACHED_DB_SESSIONS)
+class SessionTests(TestCase):
+    """Сессии cached_db и очистка просроченных, см. SESSION_BACKEND в settings."""
+
+    def test_operation_does_not_write_session(self):
+        org = Organization.objects.create(name='Shop')
+        user = User.objects.create_user('cashier', password='secret', organization=org)
+        client_obj = Client.objects.create(organization=org, name='Анна', phone='+77001234567')
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('dashboard'), {
+                'add_bonus': '1', 'client_id': client_obj.pk, 'amount': '10', 'type': 'accrual',
+            })
+            self.client.get(reverse('dashboard'))
+        self.assertFalse([q['sql'] for q in queries if 'django_session' in q['sql']])
+
+    def test_purge_sessions(self):
+        store = SessionStore()
+        store.set_expiry(-1)
+        store.create()
+        SessionStore().create()
+        call_command('purge_sessions', batch_size=1, stdout=StringIO())
+        self.assertEqual(Session.objects.count(), 1)
+
+
+class ApiTests(TestCase):
+    """JSON API для касс, см. core/api.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        other = Organization.objects.create(name='Other')
+        cls.anna = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567', balance=100)
+        cls.stranger = Client.objects.create(organization=other, name='Борис', phone='+77007654321')
+        _, cls.key = api.create_token(cls.org, 'Касса 1')
+
+    def post_operations(self, operations, **headers):
+        return self.client.post(
+            reverse('api_operations'), json.dumps({'operations': operations}),
+            content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.key}', **headers,
+        )
+
+    def test_token_required(self):
+        response = self.client.get(reverse('api_client_lookup'), {'phone': '7001234567'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_lookup_by_phone(self):
+        response = self.client.get(
+            reverse('api_client_lookup'), {'phone': '(700) 123-45-67'}, HTTP_AUTHORIZATION=f'Token {self.key}'
+        )
+        self.assertEqual(response.json()['client']['id'], self.anna.pk)
+
+    def test_operations_batch(self):
+        response = self.post_operations([
+            {'phone': '7001234567', 'type': 'accrual', 'amount': '50'},
+            {'client_id': self.anna.pk, 'type': 'deduction', 'amount': '30'},
+            {'client_id': self.stranger.pk, 'type': 'reset'},
+        ])
+        results = response.json()['results']
+        self.assertEqual([r.get('balance') for r in results[:2]], ['150.00', '120.00'])
+        self.assertEqual(results[2], {'error': 'client not found'})
+
+    def test_idempotency_key_replays_response(self):
+        operations = [{'client_id': self.anna.pk, 'type': 'accrual', 'amount': '10'}]
+        first = self.post_operations(operations, HTTP_IDEMPOTENCY_KEY='abc')
+        second = self.post_operations(operations, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.anna.refresh_from_db()
+        self.assertEqual(self.anna.balance, Decimal('110'))
+        other = self.post_operations([], HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(other.status_code, 422)
+
+
+@override_settings(ROOT_URLCONF='bonus_manager.urls_async')
+class AsyncViewTests(TestCase):
+    """Асинхронные представления (core/async_views.py) отдают то же, что и синхронные."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        cls.client_obj = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+        ledger.post_bonus(cls.client_obj, Decimal('40'))
+        _, cls.key = api.create_token(cls.org, 'Касса 1')
+
+    def setUp(self):
+        cache.clear()
+        self.async_client.force_login(self.user)
+
+    async def test_dashboard(self):
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertContains(response, 'Анна')
+
+    async def test_history_json(self):
+        response = await self.async_client.get(reverse('history_json', args=[self.client_obj.pk]))
+        self.assertEqual(response.json()['entries'][0]['amount'], '40.00')
+
+    async def test_history_of_other_organization(self):
+        other = await Organization.objects.acreate(name='Other')
+        stranger = await Client.objects.acreate(organization=other, name='Борис', phone='+77007654321')
+        response = await self.async_client.get(reverse('history', args=[stranger.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_api_lookup(self):
+        response = await self.async_client.get(
+            reverse('api_client_lookup'), {'phone': '7001234567'}, AUTHORIZATION=f'Token {self.key}'
+        )
+        self.assertEqual(response.json()['client']['balance'], '40.00')
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_QUERY_WARNING_THRESHOLD=100)
+class MetricsTests(TestCase):
+    """Замеры запросов и /metrics/, см. core/metrics.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.client.force_login(self.user)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('dashboard'))
+        content = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret').content.decode()
+        self.assertIn('bonus_http_requests_total{view="dashboard",status="200"} 1', content)
+        queries = re.search(r'bonus_http_request_db_queries_total\{view="dashboard"\} (\d+)', content)
+        self.assertGreater(int(queries.group(1)), 0)
+        template_time = re.search(r'bonus_http_request_template_seconds_total\{view="dashboard"\} ([\d.e-]+)', content)
+        self.assertGreater(float(template_time.group(1)), 0)
+
+    def test_metrics_endpoint_closed_by_default(self):
+        # За прокси REMOTE_ADDR локальный у всех запросов: он сам по себе не даёт доступа
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_endpoint_wrong_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_metrics_endpoint_allowed_ips(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+    def test_many_queries_warning(self):
+        with self.settings(METRICS_QUERY_WARNING_THRESHOLD=1), self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.client.get(reverse('dashboard'))
+        self.assertIn('Possible N+1 in dashboard', logs.output[0])
+
+    def test_logging_through_queue_listener(self):
+        self.assertTrue([h for h in logging.getLogger().handlers if isinstance(h, QueueListenerHandler)])
+
+        emitted = []
+
+        class Recorder(logging.Handler):
+            def emit(self, record):
+                emitted.append((self.format(record), threading.current_thread()))
+
+        handler = QueueListenerHandler([Recorder()])
+        # Отдельный логгер без родителя: запись не уходит в корневой
+        logger = logging.Logger('queue-test')
+        logger.addHandler(handler)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.error('Failed for client %s', 42, exc_info=True)
+        # Останавливает фоновый поток, дописав очередь
+        handler.close()
+        [(text, thread)] = emitted
+        # Сообщение и трассировка форматируются в потоке QueueListener
+        self.assertTrue(text.startswith('Failed for client 42\nTraceback'))
+        self.assertIn('ValueError: boom', text)
+        self.assertIsNot(thread, threading.current_thread())
+
+
+class FlakyTransport(notifications.BaseTransport):
+    def __init__(self, error):
+        self.error = error
+
+    def send(self, phone, text):
+        raise self.error
+
+
+class NotificationTests(TestCase):
+    """Очередь уведомлений, см. core/notifications.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        cls.client_obj = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+
+    def setUp(self):
+        notifications.LocalTransport.outbox.clear()
+
+    def test_dashboard_only_enqueues(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('dashboard'), {
+            'add_bonus': '1', 'client_id': self.client_obj.pk, 'amount': '50', 'type': 'accrual',
+        })
+        message = OutboundMessage.objects.get()
+        self.assertEqual((message.phone, message.status), ('+77001234567', OutboundMessage.STATUS_PENDING))
+        self.assertIn('50', message.text)
+        self.assertEqual(notifications.LocalTransport.outbox, [])
+
+        self.assertEqual(notifications.dispatch(notifications.LocalTransport()), (1, 0))
+        self.assertEqual(notifications.LocalTransport.outbox, [('+77001234567', message.text)])
+        self.assertEqual(OutboundMessage.objects.get().status, OutboundMessage.STATUS_SENT)
+        self.assertEqual(notifications.dispatch(notifications.LocalTransport()), (0, 0))
+
+    @override_settings(NOTIFICATION_TRANSPORT='', TESTING=False)
+    def test_transport_required(self):
+        self.assertEqual([error.id for error in notifications.check_transport()], ['core.E001'])
+        with self.assertRaises(ImproperlyConfigured):
+            notifications.get_transport()
+        with self.settings(NOTIFICATION_TRANSPORT=notifications.LOCAL_TRANSPORT):
+            self.assertEqual([error.id for error in notifications.check_transport()], ['core.W001'])
+
+    def test_local_outbox_is_capped(self):
+        transport = notifications.LocalTransport()
+        with mock.patch.object(notifications.LocalTransport, 'max_outbox', 2):
+            for i in range(5):
+                transport.send('+77001234567', str(i))
+        self.assertEqual([text for _, text in notifications.LocalTransport.outbox], ['3', '4'])
+
+    @override_settings(NOTIFICATION_MAX_ATTEMPTS=2, NOTIFICATION_RETRY_DELAY=60)
+    def test_retry_then_fail(self):
+        message = notifications.enqueue(self.client_obj, 'Привет')
+        transport = FlakyTransport(notifications.TransportError('timeout'))
+        self.assertEqual(notifications.dispatch(transport), (0, 1))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboundMessage.STATUS_PENDING, 1))
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        # Отложенное сообщение ещё не созрело
+        self.assertEqual(notifications.dispatch(transport), (0, 0))
+
+        OutboundMessage.objects.update(next_attempt_at=timezone.now())
+        notifications.dispatch(transport)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.last_error), (OutboundMessage.STATUS_FAILED, 'timeout'))
+
+    def test_permanent_error_is_not_retried(self):
+        message = notifications.enqueue(self.client_obj, 'Привет')
+        notifications.dispatch(FlakyTransport(notifications.TransportError('HTTP 400', permanent=True)))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboundMessage.STATUS_FAILED, 1))
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        slept = []
+        limiter = notifications.RateLimiter(10, clock=lambda: now[0], sleep=slept.append)
+        limiter.acquire(10)
+        self.assertEqual(slept, [])
+        limiter.acquire(5)
+        self.assertEqual(slept, [0.5])
+
+
+class AnalyticsTests(TestCase):
+    """Отчёты по истории, см. core/analytics.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        cls.anna = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+        cls.boris = Client.objects.create(organization=cls.org, name='Борис', phone='+77007654321')
+        for client, amount in ((cls.anna, '100'), (cls.anna, '-40'), (cls.boris, '25.50')):
+            ledger.post_bonus(client, Decimal(amount))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_report_and_incremental_refresh(self):
+        state = analytics.refresh(self.org.pk)
+        month = analytics.monthly(state)[-1]
+        self.assertEqual((month['operations'], month['active'], month['new']), (3, 2, 2))
+        self.assertEqual(month['liability'], Decimal('85.50'))
+
+        ledger.post_bonus(self.boris, Decimal('10'))
+        with self.assertNumQueries(2):  # только новые записи: архив и живая таблица
+            state = analytics.refresh(self.org.pk)
+        self.assertEqual(analytics.monthly(state), analytics.monthly(analytics.refresh(self.org.pk, full=True)))
+        summary = analytics.summary(state, timezone.localdate())
+        self.assertEqual((summary['operations'], summary['accrued'], summary['redeemed']),
+                         (4, Decimal('135.50'), Decimal('40.00')))
+
+        later = timezone.localdate() + timedelta(days=100)
+        dormant = analytics.dormant(state, later, days=90)
+        self.assertEqual([row['client'] for row in dormant['clients']], [self.anna, self.boris])
+
+    def test_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('analytics'))
+        self.assertContains(response, '85,50')  # ru-ru: запятая в дробях
+
+
+class RulesTests(TestCase):
+    """Сгорание по FIFO и начисления по правилам, см. core/rules.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.anna = Client.objects.create(organization=cls.org, name='Анна', phone='+77001234567')
+        cls.boris = Client.objects.create(
+            organization=cls.org, name='Борис', phone='+77007654321', birthday=date(1992, 2, 29),
+        )
+
+    def post(self, client, amount, days_ago):
+        entry = ledger.post_bonus(client, Decimal(amount))
+        BonusHistory.objects.filter(id=entry.id).update(date=timezone.now() - timedelta(days=days_ago))
+
+    def test_expiration_is_fifo_and_idempotent(self):
+        self.post(self.anna, '100', 400)
+        self.post(self.anna, '50', 200)
+        self.post(self.anna, '-120', 100)  # гасит 100 из первого начисления и 20 из второго
+        self.post(self.anna, '70', 10)
+        BonusRule.objects.create(organization=self.org, kind=BonusRule.KIND_EXPIRATION, days=180)
+
+        day = timezone.localdate()
+        rules.run_organization(self.org.pk, day)
+        self.anna.refresh_from_db()
+        self.assertEqual(self.anna.balance, Decimal('70'))
+        self.assertEqual(BonusHistory.objects.filter(client=self.anna, amount=Decimal('-30')).count(), 1)
+
+        rules.run_organization(self.org.pk, day)
+        rules.run_organization(self.org.pk, day + timedelta(days=1))
+        self.anna.refresh_from_db()
+        self.assertEqual(self.anna.balance, Decimal('70'))
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('70'))
+
+    def test_birthday_on_feb_28_in_common_year(self):
+        BonusRule.objects.create(organization=self.org, kind=BonusRule.KIND_BIRTHDAY, amount=Decimal('500'))
+        results = rules.run_organization(self.org.pk, date(2027, 2, 28))
+        self.assertEqual([result[2:] for result in results], [(BonusBatch.STATUS_DONE, 1, 1)])
+        self.boris.refresh_from_db()
+        self.assertEqual(self.boris.balance, Decimal('500'))
+        self.assertEqual(rules.run_organization(self.org.pk, date(2027, 3, 1))[0][3], 0)
+
+
+class AdminTests(TestCase):
+    """Админка больших таблиц: без N+1 и полного COUNT, изменения через ledger."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.admin = User.objects.create_superuser('root', password='secret')
+        cls.clients = [
+            ledger.create_client(Client(organization=cls.org, name=f'Клиент {i}', phone=f'+7700000{i:04d}'))
+            for i in range(5)
+        ]
+        for client in cls.clients:
+            ledger.post_bonus(client, Decimal('100'))
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_history_changelist_has_no_per_row_queries(self):
+        url = reverse('admin:core_bonushistory_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Клиент 4')
+        ledger.post_bonus(self.clients[0], Decimal('5'))
+        with self.assertNumQueries(len(queries)):
+            self.client.get(url)
+        self.assertFalse([q for q in queries if 'COUNT(*)' in q['sql'] and 'LIMIT' not in q['sql']])
+
+        response = self.client.get(url, {'client__id__exact': self.clients[1].pk})
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+
+    def test_estimated_count_for_unfiltered_list(self):
+        paginator = admin.EstimatedCountPaginator(Client.objects.order_by('id'), 100)
+        paginator.limit = 2
+        self.assertEqual(paginator.count, 5)
+        paginator = admin.EstimatedCountPaginator(Client.objects.filter(balance__gt=0).order_by('id'), 100)
+        paginator.limit = 2
+        self.assertEqual(paginator.count, 2)
+
+    def test_search_by_phone_suffix(self):
+        response = self.client.get(reverse('admin:core_client_changelist'), {'q': '0003'})
+        self.assertEqual([c.name for c in response.context['cl'].result_list], ['Клиент 3'])
+
+    def test_bulk_reset_keeps_counters(self):
+        self.client.post(reverse('admin:core_client_changelist'), {
+            'action': 'reset_balances', '_selected_action': [c.pk for c in self.clients[:2]],
+        })
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('300'))
+        self.client.post(reverse('admin:core_client_changelist'), {
+            'action': 'delete_clients', '_selected_action': [self.clients[2].pk],
+        })
+        org = Organization.objects.get(pk=self.org.pk)
+        self.assertEqual((org.client_count, org.total_balance), (4, Decimal('200')))
+
+    def test_bulk_actions_report_conflicts(self):
+        url = reverse('admin:core_client_changelist')
+        busy = self.clients[1]
+        conflict = ledger.LedgerConflict('kept changing')
+        with mock.patch.object(ledger, 'reset_balance', side_effect=[None, conflict]):
+            response = self.client.post(url, {
+                'action': 'reset_balances', '_selected_action': [c.pk for c in self.clients[:2]],
+            }, follow=True)
+        self.assertContains(response, 'Обнулён баланс 1 клиентов.')
+        self.assertContains(response, f'Баланс не обнулён (баланс всё время меняется, повторите позже): {busy}.')
+
+        with mock.patch.object(ledger, 'delete_client', side_effect=conflict):
+            response = self.client.post(url, {'action': 'delete_clients', '_selected_action': [busy.pk]}, follow=True)
+        self.assertContains(response, 'Удалено 0 клиентов.')
+        self.assertContains(response, f'Не удалены (баланс всё время меняется, повторите позже): {busy}.')
+
+
+class BalanceLookupTests(TestCase):
+    """Кэш балансов /api/balance/, см. core/balances.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.anna = ledger.create_client(Client(organization=cls.org, name='Анна', phone='+77001234567'))
+        _, cls.key = api.create_token(cls.org, 'Касса 1')
+
+    def setUp(self):
+        cache.clear()
+        balances.clear()
+
+    def lookup(self, phone):
+        return self.client.get(reverse('api_balance_lookup'), {'phone': phone}, HTTP_AUTHORIZATION=f'Token {self.key}')
+
+    def test_cached_until_ledger_write(self):
+        self.assertEqual(self.lookup('7001234567').json(), {'id': self.anna.pk, 'balance': '0.00'})
+        # Ни токена, ни версии организации, ни клиента из БД
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lookup('(700) 123-45-67').json()['balance'], '0.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.post_bonus(self.anna, Decimal('150'))
+        self.assertEqual(self.lookup('7001234567').json()['balance'], '150.00')
+
+    @override_settings(BALANCE_VERSION_TTL=60)
+    def test_write_in_another_process(self):
+        self.assertEqual(self.lookup('7001234567').json()['balance'], '0.00')
+        # Колбэки коммита не выполняются: этот процесс о проводке не знает,
+        # как если бы её провёл другой воркер
+        ledger.post_bonus(self.anna, Decimal('150'))
+        self.assertEqual(self.lookup('7001234567').json()['balance'], '0.00')
+        # Через BALANCE_VERSION_TTL версия перечитывается из БД
+        with self.settings(BALANCE_VERSION_TTL=0):
+            self.assertEqual(self.lookup('7001234567').json()['balance'], '150.00')
+
+    def test_unknown_phone_until_client_created(self):
+        self.assertEqual(self.lookup('7000000000').status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.create_client(Client(organization=self.org, name='Борис', phone='+77000000000'))
+        self.assertEqual(self.lookup('7000000000').status_code, 200)
+
+    def test_lru_eviction(self):
+        lru = balances.BalanceCache(max_entries=2)
+        lru.set('a', 1, Decimal(1), 0)
+        lru.set('b', 2, Decimal(2), 0)
+        lru.get('a', 0)
+        lru.set('c', 3, Decimal(3), 0)
+        self.assertIsNone(lru.get('b', 0))
+        self.assertEqual(lru.get('a', 0), (1, Decimal(1)))
+        self.assertIsNone(lru.get('a', 1))
+
+
+@skipUnless('shard1' in settings.DATABASES, 'run with DB_SHARDS=shard1')
+class ShardTests(TestCase):
+    """Размещение данных организаций по базам и их перенос, см. core/shards.py."""
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        balances.clear()
+
+    def test_data_routed_to_organization_database(self):
+        org = Organization.objects.create(name='Shard', database='shard1')
+        user = User.objects.create_user('cashier', password='secret', organization=org)
+        anna = ledger.create_client(Client(organization=org, name='Анна', phone='+77001234567'))
+        ledger.post_bonus(anna, Decimal('100'))
+
+        self.assertGreaterEqual(anna.pk, shards.ID_RANGE)
+        self.assertFalse(Client.objects.using('default').filter(organization=org).exists())
+        self.assertEqual(BonusHistory.objects.using('shard1').filter(client=anna).count(), 1)
+        self.assertEqual(Organization.objects.using('shard1').get(pk=org.pk).total_balance, Decimal('100'))
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, 'Анна')
+        self.assertEqual(response.context['total_balance'], Decimal('100'))
+
+    def test_exports_from_organization_database(self):
+        org = Organization.objects.create(name='Shard', database='shard1')
+        user = User.objects.create_user('cashier', password='secret', organization=org)
+        anna = ledger.create_client(Client(organization=org, name='Анна', phone='+77001234567'))
+        ledger.post_bonus(anna, Decimal('100'))
+        self.client.force_login(user)
+
+        # Файл отдаётся потоком уже после TenantMiddleware
+        content = b''.join(self.client.get(reverse('export_clients')).streaming_content).decode('utf-8-sig')
+        self.assertIn('+77001234567', content)
+        content = b''.join(self.client.get(reverse('export_history')).streaming_content).decode('utf-8-sig')
+        self.assertIn('100.00', content)
+
+    def test_move_organization(self):
+        org = Organization.objects.create(name='Shop')
+        user = User.objects.create_user('cashier', password='secret', organization=org)
+        message_templates.get_for_user(user)
+        clients = [
+            ledger.create_client(Client(organization=org, name=f'Клиент {i}', phone=f'+7700000000{i}'))
+            for i in range(3)
+        ]
+        for client in clients:
+            ledger.post_bonus(client, Decimal('50'))
+
+        call_command('move_organization', org.pk, 'shard1', grace=0, chunk_size=2, stdout=StringIO())
+
+        org.refresh_from_db()
+        self.assertEqual((org.database, org.move_state), ('shard1', ''))
+        self.assertFalse(Client.objects.using('default').filter(organization=org).exists())
+        self.assertFalse(MessageTemplate.objects.using('default').filter(user=user).exists())
+        moved = Organization.objects.using('shard1').get(pk=org.pk)
+        self.assertEqual((moved.client_count, moved.total_balance), (3, Decimal('150')))
+        with shards.use(org.pk):
+            self.assertEqual(BonusHistory.objects.filter(client__organization=org).count(), 3)
+            self.assertTrue(MessageTemplate.objects.filter(user=user).exists())
+        # Новые записи идут в новую базу и получают id из её диапазона
+        ledger.post_bonus(Client.objects.using('shard1').get(pk=clients[0].pk), Decimal('10'))
+        self.assertGreaterEqual(BonusHistory.objects.using('shard1').latest('id').pk, shards.ID_RANGE)
+
+    def test_writes_refused_while_frozen(self):
+        org = Organization.objects.create(name='Shop')
+        anna = ledger.create_client(Client(organization=org, name='Анна', phone='+77001234567'))
+        _, key = api.create_token(org, 'Касса 1')
+        shards.set_placement(org.pk, 'default', Organization.MOVE_FROZEN)
+
+        with self.assertRaises(shards.OrganizationMoving):
+            ledger.post_bonus(anna, Decimal('10'))
+        response = self.client.post(
+            reverse('api_operations'), json.dumps({'operations': [{'client_id': anna.pk, 'type': 'accrual', 'amount': '10'}]}),
+            content_type='application/json', HTTP_AUTHORIZATION=f'Token {key}',
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(shards.RETRY_AFTER))
+        # Чтение продолжается
+        self.assertEqual(self.client.get(
+            reverse('api_balance_lookup'), {'phone': '7001234567'}, HTTP_AUTHORIZATION=f'Token {key}',
+        ).status_code, 200)
+
+    def test_notifications_around_move(self):
+        org = Organization.objects.create(name='Shop')
+        anna = ledger.create_client(Client(organization=org, name='Анна', phone='+77001234567'))
+        notifications.enqueue(anna, 'Начислено 10')
+        notifications.LocalTransport.outbox.clear()
+
+        # Запись остановлена: очередь в старой базе не трогается
+        shards.set_placement(org.pk, 'default', Organization.MOVE_FROZEN)
+        call_command('send_notifications', stdout=StringIO())
+        self.assertEqual(notifications.LocalTransport.outbox, [])
+        self.assertEqual(OutboundMessage.objects.using('default').get().status, OutboundMessage.STATUS_PENDING)
+
+        # После переключения копия в старой базе ещё есть, но отправка — только из новой
+        shards.set_placement(org.pk, 'default')
+        call_command('move_organization', org.pk, 'shard1', grace=0, keep_source=True, stdout=StringIO())
+        call_command('send_notifications', stdout=StringIO())
+        call_command('send_notifications', stdout=StringIO())
+        self.assertEqual(notifications.LocalTransport.outbox, [('+77001234567', 'Начислено 10')])
+        self.assertEqual(OutboundMessage.objects.using('shard1').get().status, OutboundMessage.STATUS_SENT)
+        self.assertEqual(OutboundMessage.objects.using('default').get().status, OutboundMessage.STATUS_PENDING)
+
+
+class LedgerTests(TestCase):
+    """Проводки core/ledger.py: баланс и история меняются вместе."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.anna = ledger.create_client(Client(organization=cls.org, name='Анна', phone='+77001234567'))
+
+    def balance(self):
+        return Client.objects.get(pk=self.anna.pk).balance
+
+    def test_daily_rollups_follow_postings(self):
+        bob = ledger.create_client(Client(organization=self.org, name='Борис', phone='+77001234568', balance=50))
+        ledger.post_bonus(self.anna, Decimal('100'))
+        ledger.post_bonus(self.anna, Decimal('-40'))
+        ledger.post_many(self.org.pk, [self.anna.pk, bob.pk], Decimal('-10'))
+        ledger.reset_balance(bob)
+        # Итоги дня старше месяца в «потрачено за месяц» не входят
+        today = timezone.localdate()
+        DailyStats.objects.create(organization=self.org, day=today - timedelta(days=40), spent=Decimal('999'))
+
+        stats = DailyStats.objects.get(organization=self.org, day=today)
+        self.assertEqual((stats.accrued, stats.spent, stats.operations), (Decimal('100'), Decimal('100'), 5))
+        self.assertEqual(rollups.spent_since(self.org, today - timedelta(days=30)), Decimal('100'))
+
+        call_command('rebuild_rollups', '--org', str(self.org.pk), stdout=StringIO())
+        stats = DailyStats.objects.get(organization=self.org)
+        self.assertEqual((stats.accrued, stats.spent, stats.operations), (Decimal('100'), Decimal('100'), 5))
+
+    def test_counters_follow_ledger_and_reconcile(self):
+        bob = ledger.create_client(Client(organization=self.org, name='Борис', phone='+77001234568', balance=50))
+        ledger.post_bonus(self.anna, Decimal('100'))
+        ledger.post_many(self.org.pk, [self.anna.pk, bob.pk], Decimal('-30'))
+        ledger.reset_balance(self.anna)
+        org = Organization.objects.get(pk=self.org.pk)
+        self.assertEqual((org.client_count, org.total_balance), (2, Decimal('20')))
+        ledger.delete_client(bob)
+        org = Organization.objects.get(pk=self.org.pk)
+        self.assertEqual((org.client_count, org.total_balance), (1, Decimal('0')))
+
+        # Изменение в обход ledger находит и исправляет reconcile_counters
+        Client.objects.filter(pk=self.anna.pk).update(balance=Decimal('7'))
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn(f'Organization {self.org.pk}: total_balance stored=0.00 actual=7', out.getvalue())
+        call_command('reconcile_counters', '--fix', stdout=StringIO())
+        self.assertEqual(counters.reconcile(Organization.objects.get(pk=self.org.pk)), {})
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('7'))
+
+    def test_rebuild_rollups_after_archiving(self):
+        for amount in ('100', '-40', '25.50'):
+            ledger.post_bonus(self.anna, Decimal(amount))
+        recorded = list(DailyStats.objects.values_list('day', 'accrued', 'spent', 'operations'))
+        # Последняя запись остаётся в живой таблице: день есть в обеих
+        last = BonusHistory.objects.latest('id')
+        archive.archive_organization(self.org.pk, last.date)
+        self.assertEqual(BonusHistory.objects.count(), 1)
+
+        self.assertEqual(rollups.rebuild([self.org.pk]), 1)
+        self.assertEqual(list(DailyStats.objects.values_list('day', 'accrued', 'spent', 'operations')), recorded)
+        self.assertEqual(recorded[0][1:], (Decimal('125.50'), Decimal('40.00'), 3))
+
+    def test_accrual_and_deduction(self):
+        accrual = ledger.post_bonus(self.anna, Decimal('100'))
+        deduction = ledger.post_bonus(self.anna, Decimal('-30.50'))
+        self.assertEqual((accrual.balance_after, accrual.description), (Decimal('100'), ledger.DESCRIPTION_ACCRUAL))
+        self.assertEqual((deduction.balance_after, deduction.description), (Decimal('69.50'), ledger.DESCRIPTION_DEDUCTION))
+        self.assertEqual(self.anna.balance, Decimal('69.50'))
+        self.assertEqual(self.balance(), Decimal('69.50'))
+        self.assertEqual(
+            list(self.anna.history.order_by('id').values_list('amount', flat=True)), [Decimal('100'), Decimal('-30.50')],
+        )
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('69.50'))
+
+    def test_overdraft_refused(self):
+        ledger.post_bonus(self.anna, Decimal('10'))
+        with self.assertRaises(ledger.InsufficientBalance):
+            ledger.post_bonus(self.anna, Decimal('-10.01'))
+        self.assertEqual(self.balance(), Decimal('10'))
+        self.assertEqual(self.anna.history.count(), 1)
+        ledger.post_bonus(self.anna, Decimal('-10'))
+        self.assertEqual(self.balance(), Decimal('0'))
+
+    def racing_update(self, races):
+        """QuerySet.update, перед которым «другая касса» начисляет клиенту 5 (``races`` раз)."""
+        original = QuerySet.update
+        anna_pk = self.anna.pk
+
+        def update(queryset, **kwargs):
+            if queryset.model is Client and races:
+                races.pop()
+                original(Client.objects.filter(pk=anna_pk), balance=F('balance') + 5)
+            return original(queryset, **kwargs)
+        return mock.patch.object(QuerySet, 'update', update)
+
+    def test_reset_retries_when_balance_changes(self):
+        ledger.post_bonus(self.anna, Decimal('100'))
+        with self.racing_update([1]):
+            entry = ledger.reset_balance(self.anna)
+        # Сброшен баланс вместе с параллельным начислением
+        self.assertEqual((entry.amount, entry.balance_after), (Decimal('-105'), Decimal('0')))
+        self.assertEqual(self.balance(), Decimal('0'))
+
+    def test_reset_gives_up_after_max_attempts(self):
+        ledger.post_bonus(self.anna, Decimal('100'))
+        with self.racing_update([1] * ledger.RESET_MAX_ATTEMPTS), self.assertRaises(ledger.LedgerConflict):
+            ledger.reset_balance(self.anna)
+        self.assertEqual(self.anna.history.count(), 1)
+
+    def test_failed_history_insert_rolls_back_balance(self):
+        original = QuerySet.create
+
+        def create(queryset, **kwargs):
+            if queryset.model is BonusHistory:
+                raise IntegrityError('history insert failed')
+            return original(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'create', create), self.assertRaises(IntegrityError):
+            ledger.post_bonus(self.anna, Decimal('100'))
+        self.assertEqual(self.balance(), Decimal('0'))
+        self.assertFalse(self.anna.history.exists())
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('0'))
+
+
+class ImportExportTests(TestCase):
+    """Импорт клиентов из CSV/XLSX и экспорт в CSV, см. core/bulk.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        ledger.create_client(Client(organization=cls.org, name='Анна', phone='+77001234567'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def upload(self, name, content):
+        response = self.client.post(reverse('import_clients'), {'file': SimpleUploadedFile(name, content)})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        return [str(message) for message in get_messages(response.wsgi_request)]
+
+    def phones(self):
+        return dict(Client.objects.filter(organization=self.org).values_list('phone', 'balance'))
+
+    def test_csv_with_duplicates_and_bad_rows(self):
+        content = (
+            'Имя;Телефон;Баланс\n'
+            'Борис;(700) 765-43-21;1 500,50\n'
+            'Анна;+7 700 123 45 67;10\n'  # уже есть в организации
+            'Борис 2;7007654321;5\n'  # повтор номера в файле
+            'Вера;+77000000001;NaN\n'
+            'Глеб;12;1\n'
+        ).encode()
+        messages = self.upload('clients.csv', content)
+        self.assertIn('добавлено 1, дубликатов 2, с ошибками 2', messages[0])
+        self.assertEqual(self.phones()['+77007654321'], Decimal('1500.50'))
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).client_count, 2)
+
+    def test_cp1251_csv(self):
+        self.upload('clients.csv', 'name,phone\nЖанна Ёлкина,+77001112233\n'.encode('cp1251'))
+        self.assertEqual(Client.objects.get(phone='+77001112233').name, 'Жанна Ёлкина')
+
+    def test_unreadable_files_are_reported(self):
+        for name, content in [
+            ('clients.csv', 'имя,телефон\nАнна,+77001112233\n'.encode('utf-16')),
+            ('clients.xlsx', b'not a zip archive'),
+        ]:
+            messages = self.upload(name, content)
+            self.assertTrue(messages[0].startswith('Не удалось прочитать файл'), messages)
+        self.assertEqual(len(self.phones()), 1)
+
+    def test_bad_balance_values(self):
+        for value in ('NaN', 'sNaN', 'Infinity', 'abc', '1e9'):
+            with self.assertRaises(ValueError):
+                bulk._parse_balance(value)
+        self.assertEqual(bulk._parse_balance('1 234,5'), Decimal('1234.50'))
+
+    @skipUnless(importlib.util.find_spec('openpyxl'), 'XLSX import requires openpyxl')
+    def test_xlsx(self):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(['Name', 'Phone', 'Balance'])
+        sheet.append(['Борис', 7007654321, 12.5])
+        sheet.append(['Анна', '+77001234567', 1])
+        content = io.BytesIO()
+        workbook.save(content)
+        messages = self.upload('clients.xlsx', content.getvalue())
+        self.assertIn('добавлено 1, дубликатов 1', messages[0])
+        self.assertEqual(self.phones()['+77007654321'], Decimal('12.50'))
+
+    def test_export_clients(self):
+        response = self.client.get(reverse('export_clients'))
+        rows = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(rows[0], ','.join(bulk.CLIENT_EXPORT_HEADER))
+        self.assertEqual(rows[1].split(',')[1:], ['Анна', '+77001234567', '0.00'])
+
+
+class BatchBonusTests(TestCase):
+    """Массовые проводки: дашборд ставит в очередь, run_batches выполняет, см. core/batches.py."""
+    # run_batches обходит все базы из TENANT_DATABASES
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='Shop')
+        cls.user = User.objects.create_user('cashier', password='secret', organization=cls.org)
+        cls.clients = [
+            ledger.create_client(Client(organization=cls.org, name=f'Клиент {i}', phone=f'+7700000000{i}'))
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def post_batch(self, batch_id):
+        return self.client.post(reverse('batch_bonus'), {
+            'batch_id': batch_id, 'amount': '10', 'type': 'accrual', 'target': 'all',
+        })
+
+    def entries(self):
+        return list(
+            BonusHistory.objects.filter(client__organization=self.org).order_by('client_id')
+            .values_list('client_id', flat=True)
+        )
+
+    def test_request_queues_batch_and_replay_is_idempotent(self):
+        batch_id = '0b9a2c1e-8f43-4d6a-9a57-3c2f1e0d4b6a'
+        response = self.post_batch(batch_id)
+        self.assertRedirects(response, reverse('batch_status', args=[batch_id]))
+        batch = BonusBatch.objects.get()
+        self.assertEqual(batch.status, BonusBatch.STATUS_PENDING)
+        self.assertEqual(self.entries(), [])
+
+        self.post_batch(batch_id)
+        self.assertEqual(BonusBatch.objects.count(), 1)
+        call_command('run_batches', stdout=StringIO())
+        self.post_batch(batch_id)
+        call_command('run_batches', stdout=StringIO())
+
+        self.assertEqual(self.entries(), [client.pk for client in self.clients])
+        self.assertEqual(self.client.get(reverse('batch_status_json', args=[batch_id])).json(), {
+            'id': batch_id, 'status': BonusBatch.STATUS_DONE, 'total': 3, 'processed': 3, 'skipped': 0,
+        })
+        self.assertContains(self.client.get(reverse('batch_status', args=[batch_id])), 'Завершена')
+
+    def test_deduction_skips_clients_without_enough_bonuses(self):
+        for client, amount in zip(self.clients, ('5', '0', '20')):
+            if Decimal(amount):
+                ledger.post_bonus(client, Decimal(amount))
+        batch_id = str(uuid.uuid4())
+        self.client.post(reverse('batch_bonus'), {
+            'batch_id': batch_id, 'amount': '10', 'type': 'deduction', 'target': 'all',
+        })
+        call_command('run_batches', stdout=StringIO())
+
+        balances = list(Client.objects.filter(organization=self.org).order_by('id').values_list('balance', flat=True))
+        self.assertEqual(balances, [Decimal('5'), Decimal('0'), Decimal('10')])
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).total_balance, Decimal('15'))
+        self.assertEqual(self.client.get(reverse('batch_status_json', args=[batch_id])).json(), {
+            'id': batch_id, 'status': BonusBatch.STATUS_DONE, 'total': 3, 'processed': 1, 'skipped': 2,
+        })
+        self.assertContains(self.client.get(reverse('batch_status', args=[batch_id])), 'Пропущено')
+
+    def test_interrupted_batch_resumes(self):
+        batch, _ = batches.get_or_create_batch(uuid.uuid4(), self.org, Decimal('10'), {'all': True})
+        # Процесс упал после первой пачки
+        self.assertTrue(batches.claim(batch))
+        ledger.post_many(self.org.pk, [self.clients[0].pk], batch.amount, batch=batch)
+        BonusBatch.objects.filter(pk=batch.pk).update(processed=1, updated_at=timezone.now() - timedelta(hours=1))
+
+        call_command('run_batches', stale_minutes=10, stdout=StringIO())
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.processed, batch.total), (BonusBatch.STATUS_DONE, 3, 3))
+        self.assertEqual(self.entries(), [client.pk for client in self.clients])
+        self.assertEqual(Client.objects.get(pk=self.clients[0].pk).balance, Decimal('10'))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'the source file is made with the SQLite backup API')
+class CopyFromSqliteTests(TransactionTestCase):
+    """Перенос данных из файла SQLite, см. manage.py copy_from_sqlite."""
+
+    def setUp(self):
+        # Размещение организаций кэшируется по id, а id после flush повторяются
+        cache.clear()
+
+    def test_history_linked_to_batch(self):
+        org = Organization.objects.create(name='Shop')
+        client = ledger.create_client(Client(organization=org, name='Анна', phone='+77001234567'))
+        batch, _ = batches.get_or_create_batch(uuid.uuid4(), org, Decimal('10'), {'all': True})
+        ledger.post_many(org.pk, [client.pk], batch.amount, batch=batch)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'source.sqlite3')
+            connection.ensure_connection()
+            with closing(sqlite3.connect(path)) as source:
+                connection.connection.backup(source)
+            call_command('flush', interactive=False, verbosity=0)
+            call_command('copy_from_sqlite', path, stdout=StringIO())
+            # Исходный файл открыт только для чтения и не переведён в WAL
+            with closing(sqlite3.connect(path)) as source:
+                self.assertEqual(source.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            self.assertFalse(os.path.exists(path + '-wal'))
+
+        entry = BonusHistory.objects.get()
+        self.assertEqual((entry.client_id, entry.batch_id), (client.pk, batch.pk))
+        self.assertEqual(Client.objects.get().balance, Decimal('10'))
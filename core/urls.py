@@ -1,11 +1,28 @@
 from django.urls import path
+from . import api, metrics
 from .views import *
-from .views import dashboard, history, logout_view, register
+from .views import (
+    analytics_report, batch_bonus, batch_status, batch_status_json, dashboard, export_clients, export_history,
+    history, history_json, import_clients, logout_view, register,
+)
 
 urlpatterns = [
     path('', dashboard, name='dashboard'),
     path('dashboard/', dashboard, name='dashboard'),
     path('history/<int:client_id>/', history, name='history'),
+    path('history/<int:client_id>/json/', history_json, name='history_json'),
+    path('clients/import/', import_clients, name='import_clients'),
+    path('clients/export/', export_clients, name='export_clients'),
+    path('history/export/', export_history, name='export_history'),
+    path('analytics/', analytics_report, name='analytics'),
+    path('batches/', batch_bonus, name='batch_bonus'),
+    path('batches/<uuid:batch_id>/', batch_status, name='batch_status'),
+    path('batches/<uuid:batch_id>/json/', batch_status_json, name='batch_status_json'),
+    path('api/clients/', api.client_lookup, name='api_client_lookup'),
+    path('api/balance/', api.balance_lookup, name='api_balance_lookup'),
+    path('api/clients/<int:client_id>/history/', api.client_history, name='api_client_history'),
+    path('api/operations/', api.operations, name='api_operations'),
+    path('metrics/', metrics.metrics_view, name='metrics'),
     path('logout/', logout_view, name='logout'),
     path('register/', register, name='register'),
 ]
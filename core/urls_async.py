@@ -0,0 +1,18 @@
+"""Те же маршруты, что и core/urls.py, но чтение страниц и API — асинхронными представлениями."""
+from django.urls import path
+
+from . import async_views
+from .urls import urlpatterns as sync_urlpatterns
+
+ASYNC_VIEWS = {
+    'dashboard': async_views.dashboard,
+    'history': async_views.history,
+    'history_json': async_views.history_json,
+    'api_client_lookup': async_views.api_client_lookup,
+    'api_client_history': async_views.api_client_history,
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), ASYNC_VIEWS.get(pattern.name, pattern.callback), name=pattern.name)
+    for pattern in sync_urlpatterns
+]
@@ -1,27 +1,102 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Sum
-from datetime import datetime
+from django.conf import settings
+from django.contrib import messages
+from django.http import Http404, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
+from django.db import IntegrityError
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
 from dateutil.relativedelta import relativedelta
-from .models import Client, BonusHistory, MessageTemplate, Organization
-from .forms import AddClientForm, BonusForm, TemplateForm
-import urllib.parse
+from .models import BonusBatch, Client, BonusHistory, Organization
+from .forms import AddClientForm, BatchBonusForm, BonusForm, ImportClientsForm, TemplateForm
+from . import analytics, archive, batches, bulk, ledger, message_templates, notifications, pagecache, rollups, shards
+from .normalize import is_valid_phone, normalize_phone
+from .pagination import KeysetPage, get_page_size, keyset_paginate
+from .search import search_clients
 import logging
 from django.contrib.auth import logout
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+HISTORY_FIELDS = ('id', 'date', 'amount', 'description', 'balance_after')
+DEFAULT_HISTORY_PAGE_SIZE = 50
 
-@login_required
-def dashboard(request):
-    clients = Client.objects.all()
-    total_balance = clients.aggregate(total=Sum('balance'))['total'] or 0
-    logger.debug(
-        f"User {request.user.username} (is_superuser={request.user.is_superuser}, "
-        f"is_staff={request.user.is_staff}) accessed dashboard"
+
+def _client_table(request, org, local, search_query):
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+
+    def render_table():
+        if search_query:
+            # Поиск отдаёт одну страницу лучших совпадений
+            page = KeysetPage([result.client for result in search_clients(org, search_query, get_page_size())])
+        else:
+            # Клиенты выводятся постранично, сортировка по имени и id
+            page = keyset_paginate(
+                Client.objects.filter(organization=org), ('name', 'id'), after=after, before=before,
+            )
+        return render_to_string('core/_client_table.html', {'clients': page, 'search_query': search_query})
+
+    # Таблица одинакова для всех пользователей организации и кэшируется
+    # до следующего изменения её клиентов, см. core/pagecache.py
+    return mark_safe(pagecache.get_or_set(
+        local, 'clients', (search_query, after, before, get_page_size()), render_table
+    ))
+
+
+def _render_dashboard(request, org, local, search_query, context):
+    if 'client_table' not in context:
+        context['client_table'] = _client_table(request, org, local, search_query)
+    context.update({
+        'client_count': local.client_count,
+        'total_balance': local.total_balance,
+        'batch_form': BatchBonusForm(),
+    })
+    return render(request, 'core/dashboard.html', context)
+
+
+def _dashboard_etag(request, local, search_query):
+    """
+    ETag страницы дашборда или None, если ответ нельзя отдавать из кэша
+    браузера (есть одноразовые сообщения или ещё нет CSRF-cookie).
+    """
+    csrf_secret = request.META.get('CSRF_COOKIE')
+    if request.method != 'GET' or not csrf_secret or len(messages.get_messages(request)):
+        return None
+    return pagecache.etag(
+        local, request.user.pk, csrf_secret, timezone.localdate(),
+        search_query, request.GET.get('after'), request.GET.get('before'),
     )
 
+
+def _dashboard_spent(org, local):
+    month_start = timezone.localdate() - relativedelta(months=1)
+    return pagecache.get_or_set(local, 'spent', (month_start,), lambda: rollups.spent_since(org, month_start))
+
+
+def _not_modified(request, local, etag):
+    """Ответ 304, если у браузера актуальная версия страницы, иначе None."""
+    if not etag:
+        return None
+    return get_conditional_response(request, etag=etag, last_modified=pagecache.last_modified(local))
+
+
+def _with_validators(response, local, etag):
+    if etag:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(pagecache.last_modified(local))
+        # Браузер хранит страницу, но каждый раз сверяет её с сервером
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _dashboard_gate(request):
+    """Ответ вместо дашборда (суперпользователь, нет организации) или None."""
     user = request.user
     if user.is_superuser:
         logger.debug("Superuser redirected to admin")
@@ -29,40 +104,61 @@ def dashboard(request):
 
     # Проверка наличия организации
     if not user.organization:
-        logger.debug(f"User {user.username} has no organization")
+        logger.debug("User %s has no organization", user.username)
         return render(
             request,
             'core/no_organization.html',
             {'message': 'Вам нужно обратиться к администратору для назначения организации.'}
         )
+    return None
+
+
+POST_ACTIONS = ('add_client', 'add_bonus', 'reset_balance', 'delete_client', 'edit_templates')
+
+
+def _notify(request, client, message):
+    # Запрос только ставит сообщение в очередь, отправляет воркер (core/notifications.py)
+    notifications.enqueue(client, message)
+    messages.info(request, f'Сообщение для {client.name} поставлено в очередь отправки.')
+
+
+def _post_action(request):
+    return next((action for action in POST_ACTIONS if action in request.POST), 'unknown')
+
 
+@login_required
+def dashboard(request):
+    logger.debug(
+        "User %s (is_superuser=%s, is_staff=%s) accessed dashboard",
+        request.user.username, request.user.is_superuser, request.user.is_staff,
+    )
+
+    response = _dashboard_gate(request)
+    if response is not None:
+        return response
+
+    user = request.user
     org = user.organization
+    # Счётчики и версия данных — в строке организации в её базе, см. core/shards.py
+    local = shards.local_organization(org)
     search_query = request.GET.get('search', '')
-    clients = Client.objects.filter(organization=org)
-    if search_query:
-        clients = clients.filter(Q(name__icontains=search_query) | Q(phone__icontains=search_query))
-
-    today = datetime.now()
-    month_start = today - relativedelta(months=1)
-    spent = abs(
-        BonusHistory.objects.filter(
-            client__organization=org,
-            date__gte=month_start,
-            amount__lt=0
-        ).aggregate(total=Sum('amount'))['total'] or 0
-    )
+
+    # Условный GET: пока данные организации не менялись, браузер получает 304
+    etag = _dashboard_etag(request, local, search_query)
+    response = _not_modified(request, local, etag)
+    if response is not None:
+        return response
+
+    spent = _dashboard_spent(org, local)
 
     add_form = AddClientForm()
     bonus_form = BonusForm()
-    template, _ = MessageTemplate.objects.get_or_create(user=user)
+    template = message_templates.get_for_user(user)
     template_form = TemplateForm(instance=template)
 
-    # Извлечение данных WhatsApp из сессии
-    wa_url = request.session.pop('wa_url', None)
-    wa_message = request.session.pop('wa_message', None)
-
     if request.method == 'POST':
-        logger.debug(f"POST request received: {request.POST}")
+        # Логируем только тип действия: в POST есть CSRF-токен и данные клиентов
+        logger.debug("POST %s by %s", _post_action(request), user.username)
 
         # Добавление клиента
         if 'add_client' in request.POST:
@@ -70,64 +166,50 @@ def dashboard(request):
             if add_form.is_valid():
                 client = add_form.save(commit=False)
                 client.organization = org
-                client.phone = (
-                    client.phone.replace(' ', '')
-                    .replace('(', '')
-                    .replace(')', '')
-                    .replace('-', '')
-                )
-
-                if not client.phone.startswith('+7'):
-                    client.phone = '+7' + client.phone
+                client.phone = normalize_phone(client.phone)
 
-                if len(client.phone) != 12:
+                if not is_valid_phone(client.phone):
                     add_form.add_error('phone', 'Номер телефона должен быть в формате +7XXXXXXXXXX')
                     context = {
-                        'clients': clients, 'add_form': add_form, 'bonus_form': BonusForm(),
+                        'add_form': add_form, 'bonus_form': BonusForm(),
                         'template_form': template_form, 'spent': spent, 'business_name': org.name,
                         'search_query': search_query,
                     }
-                    return render(request, 'core/dashboard.html', context)
+                    return _render_dashboard(request, org, local, search_query, context)
 
-                # ✅ Проверка на дубликат
-                existing_client = Client.objects.filter(phone=client.phone, organization=org).first()
-                if existing_client:
+                # ✅ Проверка на дубликат: уникальный индекс (organization, phone)
+                try:
+                    ledger.create_client(client)
+                except IntegrityError:
                     add_form.add_error(
                         'phone',
                         f'Клиент с номером {client.phone} уже существует. '
                         f'Добавьте бонус этому клиенту.'
                     )
                     context = {
-                        'clients': clients, 'add_form': add_form, 'bonus_form': BonusForm(),
+                        'add_form': add_form, 'bonus_form': BonusForm(),
                         'template_form': template_form, 'spent': spent, 'business_name': org.name,
                         'search_query': search_query,
                     }
-                    return render(request, 'core/dashboard.html', context)
-
-                # Сохраняем клиента
-                client.save()
-                logger.debug(f"Client {client.name} created with phone {client.phone}")
+                    return _render_dashboard(request, org, local, search_query, context)
 
-                template, _ = MessageTemplate.objects.get_or_create(user=user)
-                message = template.accrual_template.replace('[имя]', client.name).replace(
-                    '[сумма]', str(client.balance)
-                ).replace('[баланс]', str(client.balance))
+                logger.info("Client %s created in organization %s", client.pk, org.pk)
 
-                encoded_message = urllib.parse.quote(message)
-                wa_url = f"https://wa.me/{client.phone[1:]}?text={encoded_message}"
+                message = message_templates.render(
+                    template.accrual_template,
+                    name=client.name, amount=client.balance, balance=client.balance,
+                )
 
-                # Сохраняем данные в сессии
-                request.session['wa_url'] = wa_url
-                request.session['wa_message'] = message
+                _notify(request, client, message)
                 return redirect('dashboard')
 
             else:
                 context = {
-                    'clients': clients, 'add_form': add_form, 'bonus_form': bonus_form,
+                    'add_form': add_form, 'bonus_form': bonus_form,
                     'template_form': template_form, 'spent': spent, 'business_name': org.name,
-                    'search_query': search_query, 'total_balance': total_balance,
+                    'search_query': search_query,
                 }
-                return render(request, 'core/dashboard.html', context)
+                return _render_dashboard(request, org, local, search_query, context)
 
         # Добавление бонуса
         elif 'add_bonus' in request.POST:
@@ -140,106 +222,95 @@ def dashboard(request):
                 if typ == 'deduction':
                     amount = -amount
 
-                old_balance = client.balance
-                client.balance += amount
-                client.save()
+                # Баланс и история пишутся одной проводкой, см. core/ledger.py
+                try:
+                    ledger.post_bonus(client, amount)
+                except ledger.InsufficientBalance:
+                    messages.error(request, f'Недостаточно бонусов: баланс клиента {client.name} меньше {-amount}.')
+                    return redirect('dashboard')
 
-                desc = 'Начисление' if amount > 0 else 'Списание'
-                BonusHistory.objects.create(
-                    client=client, amount=amount, description=desc, balance_after=client.balance
-                )
+                logger.info("Bonus %s applied to client %s", amount, client.pk)
 
-                logger.debug(f"Bonus {amount} applied to client {client.name}")
-
-                template = MessageTemplate.objects.get(user=user)
                 if amount > 0:
                     msg_template = template.accrual_template
-                    sum_str = str(amount)
                 else:
                     msg_template = template.deduction_template
-                    sum_str = str(-amount)
-
-                message = msg_template.replace('[имя]', client.name).replace(
-                    '[сумма]', sum_str
-                ).replace('[баланс]', str(client.balance))
 
-                encoded_message = urllib.parse.quote(message)
-                wa_url = f"https://wa.me/{client.phone[1:]}?text={encoded_message}"
+                message = message_templates.render(
+                    msg_template, name=client.name, amount=abs(amount), balance=client.balance,
+                )
 
-                request.session['wa_url'] = wa_url
-                request.session['wa_message'] = message
+                _notify(request, client, message)
                 return redirect('dashboard')
 
             else:
                 context = {
-                    'clients': clients, 'add_form': add_form, 'bonus_form': bonus_form,
+                    'add_form': add_form, 'bonus_form': bonus_form,
                     'template_form': template_form, 'spent': spent, 'business_name': org.name,
                     'search_query': search_query,
                 }
-                return render(request, 'core/dashboard.html', context)
+                return _render_dashboard(request, org, local, search_query, context)
 
         # Обнуление баланса
         elif 'reset_balance' in request.POST:
             client_id = request.POST.get('client_id')
             client = get_object_or_404(Client, id=client_id, organization=org)
-            old_balance = client.balance
-            client.balance = 0
-            client.save()
-
-            BonusHistory.objects.create(
-                client=client, amount=-old_balance, description='Обнуление', balance_after=0
-            )
-
-            logger.debug(f"Balance reset for client {client.name}")
+            try:
+                entry = ledger.reset_balance(client)
+            except ledger.LedgerConflict:
+                messages.error(request, f'Баланс клиента {client.name} всё время меняется, обнуление не выполнено. Повторите позже.')
+                return redirect('dashboard')
 
-            template = MessageTemplate.objects.get(user=user)
-            message = template.reset_template.replace('[имя]', client.name).replace('[баланс]', '0')
+            logger.info("Balance reset for client %s", client.pk)
 
-            encoded_message = urllib.parse.quote(message)
-            wa_url = f"https://wa.me/{client.phone[1:]}?text={encoded_message}"
+            message = message_templates.render(
+                template.reset_template, name=client.name, amount=-entry.amount, balance=0,
+            )
 
-            request.session['wa_url'] = wa_url
-            request.session['wa_message'] = message
+            _notify(request, client, message)
             return redirect('dashboard')
 
         # Удаление клиента
         elif 'delete_client' in request.POST:
             client_id = request.POST.get('client_id')
             client = get_object_or_404(Client, id=client_id, organization=org)
-            client.delete()
-            logger.debug(f"Client {client.name} deleted")
+            try:
+                ledger.delete_client(client)
+            except ledger.LedgerConflict:
+                messages.error(request, f'Баланс клиента {client.name} всё время меняется, клиент не удалён. Повторите позже.')
+                return redirect('dashboard')
+            logger.info("Client %s deleted from organization %s", client_id, org.pk)
             return redirect('dashboard')
 
         # Редактирование шаблонов
         elif 'edit_templates' in request.POST:
-            template, _ = MessageTemplate.objects.get_or_create(user=user)
             template_form = TemplateForm(request.POST, instance=template)
             if template_form.is_valid():
                 template_form.save()
-                logger.debug(f"Templates updated for user {user.username}")
+                logger.info("Templates updated for user %s", user.username)
                 return redirect('dashboard')
             else:
                 context = {
-                    'clients': clients, 'add_form': add_form, 'bonus_form': bonus_form,
+                    'add_form': add_form, 'bonus_form': bonus_form,
                     'template_form': template_form, 'spent': spent, 'business_name': org.name,
                     'search_query': search_query,
                 }
-                return render(request, 'core/dashboard.html', context)
+                return _render_dashboard(request, org, local, search_query, context)
 
     # Контекст по умолчанию
     context = {
-        'clients': clients, 'add_form': add_form, 'bonus_form': bonus_form,
+        'add_form': add_form, 'bonus_form': bonus_form,
         'template_form': template_form, 'spent': spent, 'business_name': org.name,
-        'search_query': search_query, 'wa_url': wa_url, 'wa_message': wa_message,
+        'search_query': search_query,
     }
-    return render(request, 'core/dashboard.html', context)
+    return _with_validators(_render_dashboard(request, org, local, search_query, context), local, etag)
 
 
 @login_required
 def history(request, client_id):
     logger.debug(
-        f"User {request.user.username} (is_superuser={request.user.is_superuser}, "
-        f"is_staff={request.user.is_staff}) accessed history for client_id {client_id}"
+        "User %s (is_superuser=%s, is_staff=%s) accessed history for client_id %s",
+        request.user.username, request.user.is_superuser, request.user.is_staff, client_id,
     )
 
     if request.user.is_superuser:
@@ -248,7 +319,7 @@ def history(request, client_id):
 
     org = request.user.organization
     if not org:
-        logger.debug(f"User {request.user.username} has no organization in history view")
+        logger.debug("User %s has no organization in history view", request.user.username)
         return render(
             request,
             'core/no_organization.html',
@@ -256,10 +327,166 @@ def history(request, client_id):
         )
 
     client = get_object_or_404(Client, id=client_id, organization=org)
-    history = client.history.all().order_by('-date')
+    history = _history_page(request, client)
     return render(request, 'core/history.html', {'history': history, 'client': client})
 
 
+def _history_page(request, client):
+    # Новые записи первыми, курсор по (date, id); старые записи — из архива
+    return archive.history_page(
+        client.id, HISTORY_FIELDS,
+        after=request.GET.get('after'),
+        page_size=getattr(settings, 'HISTORY_PAGE_SIZE', DEFAULT_HISTORY_PAGE_SIZE),
+    )
+
+
+@login_required
+def history_json(request, client_id):
+    if request.user.is_superuser:
+        return JsonResponse({'error': 'superuser'}, status=403)
+
+    org = request.user.organization
+    if not org:
+        return JsonResponse({'error': 'no organization'}, status=403)
+
+    client = get_object_or_404(Client.objects.only('id', 'name'), id=client_id, organization=org)
+    page = _history_page(request, client)
+    return JsonResponse({
+        'client': {'id': client.id, 'name': client.name},
+        'entries': page.items,
+        'next': page.next_cursor,
+    })
+
+
+def _organization_or_403(request):
+    if request.user.is_superuser or not request.user.organization:
+        return None
+    return request.user.organization
+
+
+@login_required
+@require_POST
+def import_clients(request):
+    org = _organization_or_403(request)
+    if org is None:
+        return HttpResponseForbidden()
+
+    form = ImportClientsForm(request.POST, request.FILES)
+    if not form.is_valid():
+        messages.error(request, 'Выберите файл для импорта.')
+        return redirect('dashboard')
+
+    upload = form.cleaned_data['file']
+    try:
+        result = bulk.import_clients(org, bulk.read_rows(upload, upload.name))
+    except bulk.ImportFormatError as e:
+        messages.error(request, f'Не удалось прочитать файл: {e}')
+        return redirect('dashboard')
+
+    logger.info(
+        "User %s imported clients: created=%d duplicates=%d invalid=%d",
+        request.user.username, result.created, result.duplicates, result.invalid,
+    )
+    messages.success(
+        request,
+        f'Импорт завершён: добавлено {result.created}, дубликатов {result.duplicates}, '
+        f'с ошибками {result.invalid}.'
+    )
+    for error in result.errors[:10]:
+        messages.warning(request, f'Строка {error}')
+    return redirect('dashboard')
+
+
+@login_required
+def export_clients(request):
+    org = _organization_or_403(request)
+    if org is None:
+        return HttpResponseForbidden()
+    response = StreamingHttpResponse(bulk.export_clients(org), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="clients.csv"'
+    return response
+
+
+@login_required
+def export_history(request):
+    org = _organization_or_403(request)
+    if org is None:
+        return HttpResponseForbidden()
+    response = StreamingHttpResponse(bulk.export_history(org), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="history.csv"'
+    return response
+
+
+@login_required
+@require_POST
+def batch_bonus(request):
+    org = _organization_or_403(request)
+    if org is None:
+        return HttpResponseForbidden()
+
+    form = BatchBonusForm(request.POST)
+    if not form.is_valid():
+        for errors in form.errors.values():
+            messages.error(request, ' '.join(errors))
+        return redirect('dashboard')
+
+    try:
+        batch, created = batches.get_or_create_batch(
+            form.cleaned_data['batch_id'], org, form.signed_amount(), form.selection(), user=request.user
+        )
+    except BonusBatch.DoesNotExist:
+        raise Http404
+    # Проводку выполняет manage.py run_batches --loop, запрос только ставит её в очередь
+    if created:
+        logger.info("User %s queued batch %s", request.user.username, batch.id)
+        messages.success(request, 'Массовая проводка поставлена в очередь.')
+    else:
+        # Повторная отправка той же формы
+        messages.info(request, f'Эта проводка уже создана, статус: {batch.get_status_display().lower()}.')
+    return redirect('batch_status', batch_id=batch.id)
+
+
+def _batch_or_404(request, batch_id):
+    return get_object_or_404(BonusBatch, id=batch_id, organization=request.user.organization)
+
+
+@login_required
+def batch_status(request, batch_id):
+    if _organization_or_403(request) is None:
+        return HttpResponseForbidden()
+    return render(request, 'core/batch_status.html', {'batch': _batch_or_404(request, batch_id)})
+
+
+@login_required
+def batch_status_json(request, batch_id):
+    if _organization_or_403(request) is None:
+        return HttpResponseForbidden()
+    batch = _batch_or_404(request, batch_id)
+    return JsonResponse({
+        'id': batch.id, 'status': batch.status, 'total': batch.total, 'processed': batch.processed,
+        'skipped': batch.skipped,
+    })
+
+
+@login_required
+def analytics_report(request):
+    org = _organization_or_403(request)
+    if org is None:
+        return HttpResponseForbidden()
+    try:
+        days = max(int(request.GET.get('dormant_days', analytics.DEFAULT_DORMANT_DAYS)), 1)
+    except ValueError:
+        days = analytics.DEFAULT_DORMANT_DAYS
+    try:
+        report = analytics.report(org, dormant_days=days)
+    except analytics.AnalyticsUnavailable as e:
+        logger.warning("Analytics unavailable: %s", e)
+        report = None
+    return render(request, 'core/analytics.html', {
+        'business_name': org.name, 'total_balance': shards.local_organization(org).total_balance, 'report': report,
+    })
+
+
 def logout_view(request):
     logout(request)
     return redirect('register')